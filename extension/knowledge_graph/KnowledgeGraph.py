@@ -1,4 +1,5 @@
 from collections import defaultdict
+import numpy as np
 from .Triple import Triple
 
 class KnowledgeGraph:
@@ -13,15 +14,19 @@ class KnowledgeGraph:
         # self.adj[relation][subject] = {object_1, object_2, ..., object_n}
         self.adj_inv = defaultdict(lambda: defaultdict(set))
         # self.adj_inv[relation][object] = {subject_1, subject_2, ..., subject_n}
-        self.time_index = defaultdict(list) # <--------
         self.adj_by_time = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
         self.adj_inv_by_time = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
         self.relations = set()
         self.entities = set()
 
+        # Duplicate (s, r, o, t) triples are skipped
+        seen = set()
         for triple in triples:
             if not isinstance(triple, Triple):
                 triple = Triple.from_tuple(triple)
+            if triple in seen:
+                continue
+            seen.add(triple)
             self.triples.append(triple)
 
             s, r, o = triple.subject, triple.relation, triple.object
@@ -32,7 +37,6 @@ class KnowledgeGraph:
             
             if triple.timestamp is not None:
                 t = triple.timestamp
-                self.time_index[t].append(triple)
                 self.adj_by_time[t][r][s].add(o)
                 self.adj_inv_by_time[t][r][o].add(s)
 
@@ -43,6 +47,96 @@ class KnowledgeGraph:
         self.relations = list(self.relations)
         self.entities = list(self.entities)
 
+        # Frozen tuple versions of adj / adj_inv, and the subjects of each relation (in the order of adj),
+        # to draw a random neighbor or subject without first turning a set into a list
+        # (see `GeneralizedRule._bind_triple_variables`). The tuples follow the iteration order of the sets,
+        # so a draw picks the same entity as it would from list(set).
+        self.adj_tuples = {r: {s: tuple(objects) for s, objects in by_subject.items()}
+                           for r, by_subject in self.adj.items()}
+        self.adj_inv_tuples = {r: {o: tuple(subjects) for o, subjects in by_object.items()}
+                               for r, by_object in self.adj_inv.items()}
+        self.relation_subjects = {r: tuple(by_subject) for r, by_subject in self.adj.items()}
+
+        # The possible sampling moves of each entity, prebuilt once since the KG does not change:
+        # self.out_triples[s] = [Triple(s, r, o), ...] and self.in_triples[o] = [Triple(s, r, o), ...],
+        # in the order of self.outgoing / self.incoming (see `get_possible_moves`).
+        # Equal moves are the same (pooled) Triple object, e.g., the outgoing and incoming move of a fact,
+        # or the moves of a fact that holds at several timestamps (see `_pooled_triple`)
+        triple_pool = {(t.subject, t.relation, t.object): t for t in self.triples
+                       if t.timestamp is None and not t.reversed}
+        self.out_triples = {s: [self._pooled_triple(triple_pool, s, r, o) for r, o in edges]
+                            for s, edges in self.outgoing.items()}
+        self.in_triples = {o: [self._pooled_triple(triple_pool, s, r, o) for r, s in edges]
+                           for o, edges in self.incoming.items()}
+
+        # Entities are also interned to contiguous integer IDs (in order of first appearance) for the path sampler.
+        # Its moves are laid out per direction as flat CSR-style lists over these IDs: the moves of entity i are
+        # out_moves[out_indptr[i]:out_indptr[i + 1]] (same order as out_triples), with the IDs of the entities
+        # they lead to in out_neighbors and their timestamps in out_times (None if none). Same for in_*.
+        # These are plain lists since the sampler reads them one element at a time.
+        self.id2ent = list(dict.fromkeys(e for t in self.triples for e in (t.subject, t.object)))
+        self.ent2id = {entity: i for i, entity in enumerate(self.id2ent)}
+        self.out_indptr, self.out_moves, self.out_neighbors, self.out_times = self._to_csr(self.out_triples, 'object')
+        self.in_indptr, self.in_moves, self.in_neighbors, self.in_times = self._to_csr(self.in_triples, 'subject')
+        # Whether any move carries a timestamp at all (if not, the sampler can skip temporal filtering)
+        self.moves_have_times = any(t is not None for t in self.out_times)
+
+        # NumPy versions of the above for the batched sampler (see `sample_bottom_rules_batch`):
+        # (indptr, neighbor_ids, times) per direction with NaN for missing timestamps, and for every triple
+        # its (subject_id, object_id) and timestamp, plus the indices of the triples that have a timestamp.
+        self.out_arrays = self._to_arrays(self.out_indptr, self.out_neighbors, self.out_times)
+        self.in_arrays = self._to_arrays(self.in_indptr, self.in_neighbors, self.in_times)
+        self.triple_ids = np.array([(self.ent2id[t.subject], self.ent2id[t.object]) for t in self.triples],
+                                   dtype=np.int32).reshape(-1, 2)
+        self.triple_timestamps = np.array([np.nan if t.timestamp is None else t.timestamp for t in self.triples],
+                                          dtype=np.float64)
+        self.timed_triple_indices = np.flatnonzero(~np.isnan(self.triple_timestamps))
+        # The triples that have a timestamp (in the order of self.triples), i.e., the possible head triples
+        # when sampling with a temporal window
+        self.triples_with_ts = [t for t in self.triples if t.timestamp is not None]
+
+        # Time index as sorted arrays: the timestamped triples ordered by time (stable, so ingestion order
+        # within one timestamp is kept), and their timestamps in a parallel float64 array.
+        # A time range [t_min, t_max] then maps to the contiguous slice found by two binary searches.
+        self.triples_by_time = sorted((t for t in self.triples if t.timestamp is not None),
+                                      key=lambda t: t.timestamp)
+        self.triple_times = np.array([t.timestamp for t in self.triples_by_time], dtype=np.float64)
+        # The distinct timestamps (sorted), i.e., the keys of adj_by_time
+        self.timestamps = np.unique(self.triple_times)
+
+    @staticmethod
+    def _pooled_triple(triple_pool, s, r, o):
+        """
+        Returning the (untimed) Triple(s, r, o) from the pool, creating and adding it first if needed.
+        """
+        triple = triple_pool.get((s, r, o))
+        if triple is None:
+            triple = triple_pool[(s, r, o)] = Triple(s, r, o)
+        return triple
+
+    def _to_csr(self, moves_by_entity, neighbor_field):
+        """
+        Flatten {entity: [Triple, ...]} into (indptr, moves, neighbor_ids, times) lists over the integer entity IDs,
+        where the neighbor of a move is its `neighbor_field` ('object' or 'subject').
+        """
+        indptr = [0]
+        moves = []
+        for entity in self.id2ent:
+            moves.extend(moves_by_entity.get(entity, ()))
+            indptr.append(len(moves))
+        neighbors = [self.ent2id[getattr(move, neighbor_field)] for move in moves]
+        times = [move.timestamp for move in moves]
+        return indptr, moves, neighbors, times
+
+    @staticmethod
+    def _to_arrays(indptr, neighbors, times):
+        """
+        Convert (indptr, neighbor_ids, times) lists from `_to_csr` into NumPy arrays (NaN for missing timestamps).
+        """
+        return (np.array(indptr, dtype=np.int64),
+                np.array(neighbors, dtype=np.int32),
+                np.array([np.nan if t is None else t for t in times], dtype=np.float64))
+
     def size(self):
         """
         Return the number of triples in the KG.
@@ -64,8 +158,10 @@ class KnowledgeGraph:
     def has_fact(self, s, r, o):
         """
         Quickly check if a specific triple (s, r, o) is in the KG (ignoring time).
+        Looked up with .get, so that checking an unknown (r, s) does not add empty entries to adj.
         """
-        return o in self.adj[r][s]
+        by_subject = self.adj.get(r)
+        return by_subject is not None and o in by_subject.get(s, ())
 
     # ---------------------
     # Time-indexed queries:
@@ -74,20 +170,16 @@ class KnowledgeGraph:
         """
         Return a list of all triples that have exactly this timestamp.
         """
-        return self.time_index.get(timestamp, [])
+        return self.get_triples_in_interval(timestamp, timestamp)
 
     def get_triples_in_interval(self, start_time, end_time):
         """
-        Return a list of all triples whose timestamps fall in [start_time, end_time].
-        Note: This naive approach loops over ALL timestamps. If you have a very
-        large number of distinct timestamps, consider storing them in a sorted structure
-        and performing a binary search-based range query instead.
+        Return a list of all triples whose timestamps fall in [start_time, end_time] (ordered by time).
+        Binary search over the sorted timestamps, so O(log N) plus the size of the result.
         """
-        result = []
-        for t in self.time_index:
-            if start_time <= t <= end_time:
-                result.extend(self.time_index[t])
-        return result
+        lo = np.searchsorted(self.triple_times, start_time, side='left')
+        hi = np.searchsorted(self.triple_times, end_time, side='right')
+        return self.triples_by_time[lo:hi]
 
     def has_fact_temporal(self, s, r, o, timestamp=None, tolerance=0):
         """
@@ -96,21 +188,19 @@ class KnowledgeGraph:
         If timestamp is None, we fall back to a plain 'has_fact' check.
         Otherwise, we do a range search over [timestamp - tolerance, timestamp + tolerance].
         
-        For integer timestamps, you can iterate from int(timestamp - tol) to int(timestamp + tol).
-        For float timestamps, you might do a naive loop over all distinct times. 
+        The distinct timestamps in that range are found by binary search in self.timestamps,
+        and only those are checked in the time-indexed adjacency.
         """
         if timestamp is None:
             return self.has_fact(s, r, o)
 
-        # If tolerance=0, we only check the exact timestamp adjacency
-        # If tolerance>0, we do a naive range check over all times in time_index
-        # Note that this can be expensive if we have many distinct timestamps.
         t_min = timestamp - tolerance
         t_max = timestamp + tolerance
         
-        # Storing sorted timestamps in a list for efficient range queries:
-        for t in self.time_index:
-            if t_min <= t <= t_max:
-                if o in self.adj_by_time[t][r][s]:
-                    return True
+        lo = np.searchsorted(self.timestamps, t_min, side='left')
+        hi = np.searchsorted(self.timestamps, t_max, side='right')
+        for t in self.timestamps[lo:hi].tolist():
+            by_subject = self.adj_by_time[t].get(r)
+            if by_subject is not None and o in by_subject.get(s, ()):
+                return True
         return False
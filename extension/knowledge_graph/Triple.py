@@ -1,7 +1,7 @@
 from dataclasses import dataclass, field
 from typing import Optional
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Triple:
     subject: str
     relation: str
@@ -1,20 +1,23 @@
 from dataclasses import dataclass, field
-from typing import List, Tuple, Set, Optional
+from typing import List, Tuple, Optional
 from ..knowledge_graph import KnowledgeGraph, Triple
 
-@dataclass
+@dataclass(slots=True)
 class BottomRule:
     head: Triple
     start_from: str  # "subject" or "object"
     body: List[Triple] = field(default_factory=list)
     steps: List[str] = field(default_factory=list)  # 'forward' or 'backward'
     is_cyclical: bool = False
-    visited: Set[str] = field(default_factory=set)
+    visited: List[str] = field(init=False)  # short, so a list (linear scan) is cheaper than a set
+    # Cached result of `get_chained` (reset whenever a triple is added)
+    _chained: Optional[Tuple[Tuple[str, str, str], Tuple[Tuple[str, str, str], ...]]] = field(
+        init=False, default=None, repr=False, compare=False)
     current_time: Optional[float] = None  # NEW: track the last-known timestamp in the path
 
     def __post_init__(self):
         # Initializing visited with the two nodes from the head triple.
-        self.visited = {self.head.subject, self.head.object}
+        self.visited = [self.head.subject, self.head.object]
         # If the head triple has a timestamp, we store it
         if self.head.timestamp is not None:
             self.current_time = self.head.timestamp
@@ -26,6 +29,7 @@ class BottomRule:
         """
         self.body.append(triple)
         self.steps.append(step)
+        self._chained = None
         if triple.timestamp is not None: # <--- NEW
             self.current_time = triple.timestamp
 
@@ -50,19 +54,26 @@ class BottomRule:
         Body:
           - For each body edge, if the step is 'forward', use tuple(edge);
             if 'backward', use tuple(edge.flipped()).
+        The chain is computed once and then cached until the next `add_triple`.
         """
-        # Adjusting the Head
-        head_for_chain = tuple(self.head) if self.start_from == 'object' else tuple(self.head.flipped())
-
-        # Adjusting the Body
-        body_for_chain = []
-        for step, edge in zip(self.steps, self.body):
-            if step == 'forward':
-                body_for_chain.append(tuple(edge))
+        if self._chained is None:
+            # Adjusting the Head (flipping without creating a flipped Triple)
+            head = self.head
+            if self.start_from == 'object':
+                head_for_chain = (head.subject, head.relation, head.object)
             else:
-                body_for_chain.append(tuple(edge.flipped()))
-
-        return head_for_chain, body_for_chain
+                head_for_chain = (head.object, head.relation, head.subject)
+
+            # Adjusting the Body
+            body_for_chain = tuple(
+                (edge.subject, edge.relation, edge.object) if step == 'forward'
+                else (edge.object, edge.relation, edge.subject)
+                for step, edge in zip(self.steps, self.body)
+            )
+            self._chained = (head_for_chain, body_for_chain)
+
+        head_for_chain, body_for_chain = self._chained
+        return head_for_chain, list(body_for_chain)
 
     def get_flattened_nodes(self):
         """
@@ -1,8 +1,11 @@
 import random
-from typing import Optional
-from ..knowledge_graph import KnowledgeGraph, Triple
+import numpy as np
+from typing import List, Optional
+from ..knowledge_graph import KnowledgeGraph
 from .BottomRule import BottomRule
 
+_EMPTY = ()
+
 def pick_step_direction(direction_allowed):
     """
     Decide whether the next step is 'forward' or 'backward'.
@@ -24,18 +27,13 @@ def get_possible_moves(kg: KnowledgeGraph, current_node: str, step_direction: st
     :param kg: KnowledgeGraph instance
     :param current_node: The current entity node
     :param step_direction: 'forward' or 'backward'
-    :return: List of Triples (subject, relation, object, [timestamp]).
+    :return: List of Triples (subject, relation, object, [timestamp]), or an empty tuple.
     """
+    # Returning the prebuilt list of the KG (shared, so it must not be modified)
     if step_direction == 'forward':
-        return [
-            Triple.from_tuple((current_node, r, o))
-            for (r, o) in kg.outgoing.get(current_node, [])
-        ]
+        return kg.out_triples.get(current_node, _EMPTY)
     else:
-        return [
-            Triple.from_tuple((s, r, current_node))
-            for (r, s) in kg.incoming.get(current_node, [])
-        ]
+        return kg.in_triples.get(current_node, _EMPTY)
 
 
 def filter_valid_moves(bottom_rule: BottomRule, 
@@ -51,29 +49,23 @@ def filter_valid_moves(bottom_rule: BottomRule,
     :param is_last_step: Boolean indicating if it's the last step
     :return: List of filtered valid moves
     """
-    filtered_possible_moves = []
+    # Only the other head node may be revisited, and only in the last step (closing a cycle)
+    visited = bottom_rule.visited
+    if is_last_step:
+        cycle_target = bottom_rule.head.object if bottom_rule.start_from == 'subject' else bottom_rule.head.subject
+    else:
+        cycle_target = None
 
-    for move in possible_moves:
-        if step_direction == 'forward':
-            next_node = move.object
-            if next_node in bottom_rule.visited:
-                if is_last_step:
-                    if bottom_rule.start_from == 'subject' and next_node == bottom_rule.head.object:
-                        filtered_possible_moves.append(move)
-                    elif bottom_rule.start_from == 'object' and next_node == bottom_rule.head.subject:
-                        filtered_possible_moves.append(move)
-            else:
-                filtered_possible_moves.append(move)
-        else:
-            prev_node = move.subject
-            if prev_node in bottom_rule.visited:
-                if is_last_step:
-                    if bottom_rule.start_from == 'subject' and prev_node == bottom_rule.head.object:
-                        filtered_possible_moves.append(move)
-                    elif bottom_rule.start_from == 'object' and prev_node == bottom_rule.head.subject:
-                        filtered_possible_moves.append(move)
-            else:
-                filtered_possible_moves.append(move)
+    if step_direction == 'forward':
+        filtered_possible_moves = [
+            move for move in possible_moves
+            if move.object not in visited or move.object == cycle_target
+        ]
+    else:
+        filtered_possible_moves = [
+            move for move in possible_moves
+            if move.subject not in visited or move.subject == cycle_target
+        ]
     return filtered_possible_moves
 
 
@@ -100,12 +92,11 @@ def sample_bottom_rule(kg: KnowledgeGraph,
     # -------------------
     # 1) Picking the HEAD triple
     # -------------------
-    # Filter to triples with timestamps when temporal_window is set
+    # Restricting to the triples with timestamps (precomputed by the KG) when temporal_window is set
     if temporal_window is not None:
-        valid_head_triples = [t for t in kg.triples if t.timestamp is not None]
-        if not valid_head_triples:
+        if not kg.triples_with_ts:
             return None
-        head_triple = random.choice(valid_head_triples)
+        head_triple = random.choice(kg.triples_with_ts)
     else:
         head_triple = random.choice(kg.triples)
     
@@ -128,58 +119,200 @@ def sample_bottom_rule(kg: KnowledgeGraph,
         return bottom_rule
     
     # Else, loop for taking steps
+    # The walk itself runs on integer entity IDs, with the visited nodes kept in a short list
+    # (a linear scan over at most n + 1 small integers is cheaper than hashing for such short paths)
+    current_id = kg.ent2id[current_node]
+    head_ids = (kg.ent2id[head_triple.subject], kg.ent2id[head_triple.object])
+    # Only this node may be revisited, and only in the last step (closing a cycle)
+    closing_id = head_ids[1] if start_from == 'subject' else head_ids[0]
+    visited_ids = list(head_ids)
     for step_id in range(n - 1): 
 
         # 3A) We must first decide whether we are going to go forward or backward!
         step_direction = pick_step_direction(direction_allowed)
 
-        # 3B) Get a list of all possible moves in a (subj, rel, obj) format 
-        possible_moves = get_possible_moves(kg, current_node, step_direction)
-        if not possible_moves:
+        # 3B) Get the slice of all possible moves in the chosen direction
+        if step_direction == 'forward':
+            indptr, moves, neighbors, times = kg.out_indptr, kg.out_moves, kg.out_neighbors, kg.out_times
+        else:
+            indptr, moves, neighbors, times = kg.in_indptr, kg.in_moves, kg.in_neighbors, kg.in_times
+        start, end = indptr[current_id], indptr[current_id + 1]
+        if start == end:
             return None
 
-        # 3C) We then filter out this list to ensure straigth paths
+        # 3C) We then filter out the moves to previously visited nodes to ensure straight paths
         is_last_step = (step_id == (n - 2))
-        filtered_moves = filter_valid_moves(bottom_rule, possible_moves, step_direction, is_last_step)
-        if not filtered_moves:
+        valid_moves = [
+            i for i, neighbor in enumerate(neighbors[start:end], start)
+            if neighbor not in visited_ids or (is_last_step and neighbor == closing_id)
+        ]
+        if not valid_moves:
             return None
-        
+
         # Temporal filtering: if we have current_time in the bottom_rule,
         # we discard any moves with timestamps that go backwards or exceed the window.
-        valid_moves = []
-        for move in filtered_moves:
-            if bottom_rule.current_time is not None and move.timestamp is not None:
-                # Non-decreasing time
-                if move.timestamp < bottom_rule.current_time:
-                    continue
-                # Checking time window
-                if temporal_window is not None:
-                    dt = move.timestamp - bottom_rule.current_time
-                    if dt > temporal_window:
-                        continue
-            valid_moves.append(move)
+        # (As in the original sampler, the moves are built from the untimed outgoing / incoming edges,
+        # so this is skipped unless the KG's moves carry timestamps.)
+        current_time = bottom_rule.current_time
+        if current_time is not None and kg.moves_have_times:
+            # Non-decreasing time, and checking the time window (moves without a timestamp are not constrained)
+            max_gap = float('inf') if temporal_window is None else temporal_window
+            valid_moves = [i for i in valid_moves if times[i] is None or 0 <= times[i] - current_time <= max_gap]
+            if not valid_moves:
+                return None
 
-        if not valid_moves:
-            return None
-
-        # 3D) Now, we can pick one triple from possible_moves at random, add that to our bottom-rule
+        # 3D) Now, we can pick one of the valid moves at random, add that to our bottom-rule
+        move_index = random.choice(valid_moves)
+        triple = moves[move_index]
+        bottom_rule.add_triple(triple, step_direction)
+        current_id = neighbors[move_index]
+        visited_ids.append(current_id)
         if step_direction == 'forward':
-            triple = random.choice(valid_moves) # (current_node, relation, next_node)
-            bottom_rule.add_triple(triple, step_direction)
             # Updating the current node: Move forward to the tail
-            bottom_rule.visited.add(triple.object) # next_node
             current_node = triple.object # next_node
         else:
-            triple = random.choice(valid_moves) # (prev_node, relation, current_node)
-            bottom_rule.add_triple(triple, step_direction)
             # Updating the current node: Move backward to the head
-            bottom_rule.visited.add(triple.subject) # prev_node
             current_node = triple.subject # prev_node
+        bottom_rule.visited.append(current_node)
 
     # ---------------------------------
     # 4) Check if cyclic bottom rule, and add it as an attribute
     # ---------------------------------
-    if current_node == bottom_rule.head.object or current_node == bottom_rule.head.subject:
+    if current_id in head_ids:
         bottom_rule.is_cyclical = True
 
     return bottom_rule
+
+
+def sample_bottom_rules_batch(kg: KnowledgeGraph,
+                              n: int = 2,
+                              batch_size: int = 1000,
+                              direction_allowed: str = "both",
+                              temporal_window: Optional[float] = None,
+                              cyclic_only: bool = False,
+                              rng: Optional[np.random.Generator] = None) -> List[BottomRule]:
+    """
+    Sample up to batch_size bottom rules of length n at once, following the same procedure as
+    `sample_bottom_rule`, but advancing all paths together with NumPy (one vectorized step at a time).
+    Paths that hit a dead end are dropped, so only the successful samples are returned.
+
+    :param kg: KnowledgeGraph
+    :param n: total number of edges for the resulting bottom rules (the HEAD triple counts as 1).
+    :param batch_size: number of paths to sample.
+    :param direction_allowed: "both", "forward-only", or "backward-only"
+    :param temporal_window: If not None, imposes a maximum gap between consecutive timestamps.
+    :param cyclic_only: If True, only cyclic bottom rules are sampled: the last step is picked among the moves
+                        closing the cycle (paths without such a move are dropped).
+    :param rng: NumPy random generator (by default, one seeded from the `random` module, so that
+                `random.seed` makes the batches reproducible as well).
+    :return: List of the sampled BottomRule objects.
+    """
+    if n < 1:
+        raise ValueError("n must be >= 1")
+    if direction_allowed not in ("both", "forward-only", "backward-only"):
+        raise ValueError(f"Unsupported direction_allowed: {direction_allowed}")
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+
+    # 1) Picking the HEAD triples (only the ones with timestamps if temporal_window is set)
+    if temporal_window is not None:
+        if not len(kg.timed_triple_indices):
+            return []
+        heads = kg.timed_triple_indices[rng.integers(len(kg.timed_triple_indices), size=batch_size)]
+    else:
+        if not kg.triples:
+            return []
+        heads = rng.integers(len(kg.triples), size=batch_size)
+    head_ids = kg.triple_ids[heads]
+
+    # 2) Deciding the start nodes (a self-loop head always starts from its subject)
+    from_subject = (rng.random(batch_size) < 0.5) | (head_ids[:, 0] == head_ids[:, 1])
+    current = np.where(from_subject, head_ids[:, 0], head_ids[:, 1])
+    closing = np.where(from_subject, head_ids[:, 1], head_ids[:, 0])
+    current_time = kg.triple_timestamps[heads]
+
+    # 3) Expanding all paths with (n - 1) edges; visited holds the nodes of each path (-1 = not yet)
+    visited = np.full((batch_size, n + 1), -1, dtype=np.int32)
+    visited[:, :2] = head_ids
+    moves = np.zeros((batch_size, n - 1), dtype=np.int64)
+    forward = np.zeros((batch_size, n - 1), dtype=bool)
+    rows = np.arange(batch_size)
+    max_gap = np.inf if temporal_window is None else temporal_window
+    for step_id in range(n - 1):
+        if direction_allowed == "both":
+            step_forward = rng.random(len(rows)) < 0.5
+        else:
+            step_forward = np.full(len(rows), direction_allowed == "forward-only")
+        is_last_step = (step_id == (n - 2))
+
+        # Enumerating the possible moves of all paths as flat arrays (grouped by path), where owners[i]
+        # is the (index in rows of the) path of move i, and positions[i] its index in the KG move arrays
+        owners, positions, neighbors, times = [], [], [], []
+        for (indptr, all_neighbors, all_times), in_direction in ((kg.out_arrays, step_forward),
+                                                                 (kg.in_arrays, ~step_forward)):
+            paths = np.flatnonzero(in_direction)
+            starts = indptr[current[rows[paths]]]
+            degrees = indptr[current[rows[paths]] + 1] - starts
+            direction_positions = np.repeat(starts - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+            owners.append(np.repeat(paths, degrees))
+            positions.append(direction_positions)
+            neighbors.append(all_neighbors[direction_positions])
+            times.append(all_times[direction_positions])
+        by_path = np.argsort(np.concatenate(owners), kind='stable')
+        owners = np.concatenate(owners)[by_path]
+        positions = np.concatenate(positions)[by_path]
+        neighbors = np.concatenate(neighbors)[by_path]
+        times = np.concatenate(times)[by_path]
+
+        # Filtering out moves to previously visited nodes (except closing a cycle in the last step).
+        # If only cyclic paths are wanted, the last step has to close the cycle, so it is picked among those moves
+        # (instead of picking any move and rejecting the path afterwards)
+        path_rows = rows[owners]
+        is_valid = ~(neighbors[:, None] == visited[path_rows]).any(axis=1)
+        if is_last_step:
+            if cyclic_only:
+                is_valid = neighbors == closing[path_rows]
+            else:
+                is_valid |= neighbors == closing[path_rows]
+        # Temporal filtering: non-decreasing time within the window (unconstrained without timestamps)
+        gaps = times - current_time[path_rows]
+        is_valid &= np.isnan(gaps) | ((gaps >= 0) & (gaps <= max_gap))
+
+        # Picking one of the valid moves of each path uniformly at random (paths without one die)
+        valid_counts = np.bincount(owners[is_valid], minlength=len(rows))
+        alive = valid_counts > 0
+        picks = (rng.random(len(rows)) * valid_counts).astype(np.int64)
+        valid_positions = np.flatnonzero(is_valid)
+        first_valid = np.searchsorted(owners[valid_positions], np.arange(len(rows)))
+        chosen = valid_positions[first_valid[alive] + picks[alive]]
+
+        rows, step_forward = rows[alive], step_forward[alive]
+        moves[rows, step_id] = positions[chosen]
+        forward[rows, step_id] = step_forward
+        current[rows] = neighbors[chosen]
+        visited[rows, step_id + 2] = neighbors[chosen]
+        chosen_times = times[chosen]
+        has_time = ~np.isnan(chosen_times)
+        current_time[rows[has_time]] = chosen_times[has_time]
+
+    # 4) Decoding the surviving paths into BottomRule objects
+    bottom_rules = []
+    is_cyclical = (current[rows] == head_ids[rows, 0]) | (current[rows] == head_ids[rows, 1])
+    if n == 1:
+        is_cyclical[:] = False
+    if cyclic_only:
+        rows, is_cyclical = rows[is_cyclical], is_cyclical[is_cyclical]
+    for row, cyclical in zip(rows.tolist(), is_cyclical.tolist()):
+        bottom_rule = BottomRule(kg.triples[heads[row]], 'subject' if from_subject[row] else 'object')
+        for move, step_forward in zip(moves[row].tolist(), forward[row].tolist()):
+            if step_forward:
+                triple = kg.out_moves[move]
+                bottom_rule.add_triple(triple, 'forward')
+                bottom_rule.visited.append(triple.object)
+            else:
+                triple = kg.in_moves[move]
+                bottom_rule.add_triple(triple, 'backward')
+                bottom_rule.visited.append(triple.subject)
+        bottom_rule.is_cyclical = cyclical
+        bottom_rules.append(bottom_rule)
+    return bottom_rules
@@ -1,11 +1,21 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, InitVar
 from typing import List, Tuple, Dict, Set, Any, Optional
+import math
+import re
 import random
 from ..knowledge_graph import Triple, KnowledgeGraph
 from ..path_sampling import BottomRule
 
+# With a minimum confidence, the confidence bound is checked after every this many sampling attempts
+# (see `calculate_confidences_batch`)
+CONFIDENCE_CHECK_INTERVAL = 32
 
-@dataclass
+# The variables of a generalized rule: the head variables X and Y, and the auxiliary variables A2, A3, ...
+# Every other term is a constant (an entity), even if its name happens to start with an "A"
+VARIABLE_PATTERN = re.compile(r"X|Y|A\d+")
+
+
+@dataclass(slots=True)
 class GeneralizedRule:
     bottom_rule: BottomRule
     rule_type: str  # "AC1", "AC2", or "C"
@@ -23,11 +33,24 @@ class GeneralizedRule:
     body_groundings_count: int = field(init=False, default=0)
     head_groundings_count: int = field(init=False, default=0)
 
+    # Cached canonical string of the rule (see `to_logical_string`)
+    _canonical: Optional[str] = field(init=False, default=None, repr=False, compare=False)
+
     # Storing timestamps from the bottom rule for reference
     head_timestamp: Optional[float] = field(init=False, default=None)
     body_timestamps: List[Optional[float]] = field(init=False, default_factory=list)
 
-    def __post_init__(self):
+    # The body as prepared for confidence sampling once per rule (see `_sample_body_grounding`):
+    # its constants, and per body triple its (subject, relation, object, timestamp to check it at)
+    _body_constants: Dict[str, str] = field(init=False, default_factory=dict, repr=False, compare=False)
+    _body_bind_plan: List[Tuple[str, str, str, Optional[float]]] = field(
+        init=False, default_factory=list, repr=False, compare=False)
+
+    # The generalization parts shared by all rules of the bottom rule (see `_base_generalization`),
+    # computed here if not given
+    base_generalization: InitVar[Optional[Tuple[List[str], Dict[str, str], List[Triple]]]] = None
+
+    def __post_init__(self, base_generalization):
         if self.bottom_rule is None:
             self.node_mappings = {}
             self.generalized_head = None
@@ -44,28 +67,10 @@ class GeneralizedRule:
         if self.rule_type != "AC1" and self.AC1_rule_variant is not None:
             raise ValueError("AC1_rule_variant should only be specified for AC1 rules")
 
-        flattened_nodes = self.bottom_rule.get_flattened_nodes()
-        
-        self.node_mappings = dict.fromkeys(flattened_nodes)
-        self.node_mappings[flattened_nodes[0]] = "Y"
-        self.node_mappings[flattened_nodes[1]] = "X"
-
-        # First two nodes are mapped to "Y" and "X"
-        # Rest of the nodes are numbered with A{n+1}, i.e., starting from A2
-        A_index = 2
-        for unique_node_index, node in enumerate(self.node_mappings):
-            if unique_node_index == 0:
-                self.node_mappings[node] = "Y"
-            elif unique_node_index == 1:
-                self.node_mappings[node] = "X"
-            else:
-                ### Took this part out as it is nicely handled in the next step anyways
-                # if self.bottom_rule.is_cyclical and len(self.node_mappings) == unique_node_index + 1:
-                #     continue
-                # else:
-                while f"A{A_index}" in self.node_mappings.values():
-                    A_index += 1
-                self.node_mappings[node] = f"A{A_index}"
+        if base_generalization is None:
+            base_generalization = _base_generalization(self.bottom_rule)
+        flattened_nodes, base_mappings, base_body = base_generalization
+        self.node_mappings = dict(base_mappings)
 
         # Now, further adjusting the dictionary based on the rule type
         if self.rule_type == "C":
@@ -97,6 +102,9 @@ class GeneralizedRule:
             self.node_mappings[self.bottom_rule.head.object],
             timestamp=None # <---
         )
+        # Only the body triples of the nodes that became constants differ from the shared base body
+        constant_nodes = {node for node in (flattened_nodes[0], flattened_nodes[1], flattened_nodes[-1])
+                          if self.node_mappings[node] != base_mappings[node]}
         self.generalized_body = [
             Triple(
                 self.node_mappings[triple.subject],
@@ -104,50 +112,49 @@ class GeneralizedRule:
                 self.node_mappings[triple.object],
                 timestamp=None # <---
             )
-            for triple in self.bottom_rule.body
+            if triple.subject in constant_nodes or triple.object in constant_nodes else base_triple
+            for triple, base_triple in zip(self.bottom_rule.body, base_body)
         ]
 
         # Just storing the original timestamps for reference
         self.head_timestamp = self.bottom_rule.head.timestamp
         self.body_timestamps = [t.timestamp for t in self.bottom_rule.body]
 
-    def calculate_confidence(self, kg: KnowledgeGraph, sample_size: int = 500, pc: float = 1.0) -> float:
+        # Preparing the body for confidence sampling, so that no str() / constant checks or timestamp
+        # searches are repeated per sampling attempt
+        self._body_constants = {
+            term: term
+            for triple in self.generalized_body for term in (triple.subject, triple.object)
+            if self._is_constant(str(term))
+        }
+        self._body_bind_plan = [
+            (triple.subject, triple.relation, triple.object,
+             self._find_original_timestamp(triple.subject, triple.relation, triple.object))
+            for triple in self.generalized_body
+        ]
+
+    def calculate_confidence(self, kg: KnowledgeGraph, sample_size: int = 500, pc: float = 1.0,
+                             min_conf: Optional[float] = None) -> float:
         """
         Calculate approximate confidence based on sampling.
         
         :param kg: Knowledge Graph to sample from
         :param sample_size: Number of body groundings to sample
         :param pc: Pessimistic constant for confidence smoothing (Laplace-like)
+        :param min_conf: If given, the sampling stops early once the confidence clearly can't reach it
+                         (see `calculate_confidences_batch`)
         :return: Confidence score between 0 and 1
         """
-        # Reset counters
-        self.body_groundings_count = 0
-        self.head_groundings_count = 0
-        
-        # Get the variables that need to be bound
-        variable_bindings = self._get_variable_bindings()
-        
-        # Sampling body groundings
-        for _ in range(sample_size):
-            # Try to find a valid body grounding
-            grounding = self._sample_body_grounding(kg, variable_bindings)
-            if not grounding:
-                continue
-                
-            self.body_groundings_count += 1
-            
-            # Check if this grounding makes the head true
-            if self._check_head_grounding(kg, grounding):
-                self.head_groundings_count += 1
-        
-        # Calculate confidence with smoothing
-        if self.body_groundings_count > 0:
-            self.confidence = (self.head_groundings_count + pc) / (self.body_groundings_count + pc)
-        else:
-            self.confidence = 0.0
-            
+        calculate_confidences_batch([self], kg, sample_size=sample_size, pc=pc, min_conf=min_conf)
         return self.confidence
 
+    def body_signature(self) -> Tuple[Tuple[Triple, ...], Tuple[Optional[float], ...]]:
+        """
+        The generalized body together with the timestamps it is checked against.
+        Rules with the same signature have the same body groundings (see `calculate_confidences_batch`).
+        """
+        return tuple(self.generalized_body), tuple(self.body_timestamps)
+
     def _get_variable_bindings(self) -> Set[str]:
         """
         Get all variables that need to be bound when sampling.
@@ -160,20 +167,20 @@ class GeneralizedRule:
             subj_str = str(triple.subject)
             obj_str = str(triple.object)
             
-            if not subj_str.startswith('A') and not self._is_constant(subj_str):
+            if not self._is_constant(subj_str):
                 variables.add(subj_str)
-            if not obj_str.startswith('A') and not self._is_constant(obj_str):
+            if not self._is_constant(obj_str):
                 variables.add(obj_str)
                 
         # Add auxiliary variables (A2, A3, etc.)
-        aux_vars = {str(v) for v in self.node_mappings.values() if str(v).startswith('A')}
+        aux_vars = {str(v) for v in self.node_mappings.values() if not self._is_constant(str(v))}
         variables.update(aux_vars)
         
         return variables
 
     def _is_constant(self, value: str) -> bool:
         """Check if a value is a constant (not a variable)."""
-        return not (value.startswith('A') or value in {'X', 'Y'})
+        return VARIABLE_PATTERN.fullmatch(value) is None
 
     def _sample_body_grounding(self, kg: KnowledgeGraph, variables: Set[str]) -> Optional[Dict[str, Any]]:
         """
@@ -182,18 +189,12 @@ class GeneralizedRule:
         """
         max_attempts = 50  # Prevent infinite loops
         for _ in range(max_attempts):
-            grounding = {}
-            
             # First bind any constants
-            for triple in self.generalized_body:
-                if self._is_constant(str(triple.subject)):
-                    grounding[str(triple.subject)] = triple.subject
-                if self._is_constant(str(triple.object)):
-                    grounding[str(triple.object)] = triple.object
+            grounding = dict(self._body_constants)
             
             # Try to bind all required variables
             success = True
-            for triple in self.generalized_body:
+            for triple in self._body_bind_plan:
                 if not self._bind_triple_variables(kg, triple, grounding):
                     success = False
                     break
@@ -203,24 +204,20 @@ class GeneralizedRule:
                 
         return None
 
-    def _bind_triple_variables(self, kg: KnowledgeGraph, triple: Triple, grounding: Dict[str, str]) -> bool:
+    def _bind_triple_variables(self, kg: KnowledgeGraph, triple: Tuple[str, str, str, Optional[float]],
+                               grounding: Dict[str, str]) -> bool:
         """
-        Bind subject/object of 'triple' to actual entities in 'kg'
-        so that triple is satisfied. If triple has a known timestamp in the original
-        bottom rule, you can optionally call kg.has_fact_temporal(...) here.
+        Bind subject/object of 'triple' (an entry of the body's binding plan) to actual entities in 'kg'
+        so that triple is satisfied. If the triple has a known timestamp in the original
+        bottom rule, a fully bound triple is checked with kg.has_fact_temporal(...).
         """
-        subj_key = triple.subject
-        obj_key = triple.object
-        r = triple.relation
+        subj_key, r, obj_key, original_t = triple
 
         # Case 1: Both subject and object are already bound
         if subj_key in grounding and obj_key in grounding:
             s_bound = grounding[subj_key]
             o_bound = grounding[obj_key]
-            # If the original triple from bottom rule had a timestamp, we can attempt a temporal check
-            # We first find the matching bottom-rule triple to get its timestamp
-            # (In principle, we can store some index, but let's do a simple approach)
-            original_t = self._find_original_timestamp(subj_key, r, obj_key)
+            # If the original triple from bottom rule had a timestamp, we do a temporal check
             if original_t is not None:
                 return kg.has_fact_temporal(s_bound, r, o_bound, timestamp=original_t, tolerance=0)
             else:
@@ -228,33 +225,34 @@ class GeneralizedRule:
 
         # Case 2: Subject is bound, object needs binding
         elif subj_key in grounding:
-            possible_objects = kg.adj[triple.relation].get(grounding[subj_key], set())
+            possible_objects = kg.adj_tuples.get(r, {}).get(grounding[subj_key], ())
             if not possible_objects:
                 return False
-            grounding[obj_key] = random.choice(list(possible_objects))
+            grounding[obj_key] = possible_objects[random.randrange(len(possible_objects))]
             return True
 
         # Case 3: Object is bound, subject needs binding
         elif obj_key in grounding:
-            possible_subjects = kg.adj_inv[triple.relation].get(grounding[obj_key], set())
+            possible_subjects = kg.adj_inv_tuples.get(r, {}).get(grounding[obj_key], ())
             if not possible_subjects:
                 return False
-            grounding[subj_key] = random.choice(list(possible_subjects))
+            grounding[subj_key] = possible_subjects[random.randrange(len(possible_subjects))]
             return True
 
         # Case 4: Neither is bound
         else:
             # Pick a random subject that has this relation
-            if not kg.adj[triple.relation]:
+            subjects = kg.relation_subjects.get(r, ())
+            if not subjects:
                 return False
-            random_subject = random.choice(list(kg.adj[triple.relation].keys()))
+            random_subject = subjects[random.randrange(len(subjects))]
             grounding[subj_key] = random_subject
             
             # Then pick a random object for that subject
-            possible_objects = kg.adj[triple.relation][random_subject]
+            possible_objects = kg.adj_tuples[r][random_subject]
             if not possible_objects:
                 return False
-            grounding[obj_key] = random.choice(list(possible_objects))
+            grounding[obj_key] = possible_objects[random.randrange(len(possible_objects))]
             return True
 
     def _find_original_timestamp(self, subj_var: str, relation: str, obj_var: str) -> Optional[float]:
@@ -307,6 +305,13 @@ class GeneralizedRule:
             return kg.has_fact(head_subj, head_rel, head_obj)
 
     def to_logical_string(self) -> str:
+        """
+        Canonical string of the rule, used as its key for duplicate detection.
+        Computed once and cached, since the rule does not change after construction.
+        """
+        if self._canonical is not None:
+            return self._canonical
+
         # Head
         head_triple = self.bottom_rule.head
         head_str = f"{head_triple.relation}({self.node_mappings[head_triple.subject]}, {self.node_mappings[head_triple.object]})"
@@ -318,9 +323,10 @@ class GeneralizedRule:
             body_parts.append(part)
 
         if body_parts:
-            return f"{head_str} <- {', '.join(body_parts)}"
+            self._canonical = f"{head_str} <- {', '.join(body_parts)}"
         else:
-            return head_str
+            self._canonical = head_str
+        return self._canonical
 
     def __str__(self) -> str:
         if self.bottom_rule is None:
@@ -351,6 +357,93 @@ class GeneralizedRule:
         return f"{head_str} <- {body_str}"
 
 
+def calculate_confidences_batch(rules: List[GeneralizedRule], kg: KnowledgeGraph,
+                                sample_size: int = 500, pc: float = 1.0,
+                                min_conf: Optional[float] = None) -> None:
+    """
+    Calculate the approximate confidence of rules sharing the same body (i.e., the same `body_signature`),
+    e.g., AC2 rules that only differ in the constant of their head.
+    The body groundings are sampled once, and every sampled grounding is checked against each rule's head.
+    
+    :param rules: Rules with the same body signature
+    :param kg: Knowledge Graph to sample from
+    :param sample_size: Number of body groundings to sample
+    :param pc: Pessimistic constant for confidence smoothing (Laplace-like)
+    :param min_conf: If given, the confidence bound is checked every CONFIDENCE_CHECK_INTERVAL attempts, and
+                     the sampling stops early once the upper bound of every rule's confidence is below min_conf
+                     (see `confidence_upper_bound`). The confidences are then based on the groundings so far.
+    """
+    # Reset counters
+    for rule in rules:
+        rule.body_groundings_count = 0
+        rule.head_groundings_count = 0
+
+    # The body (and so the variables that need to be bound) is the same for all the rules
+    sampler = rules[0]
+    variable_bindings = sampler._get_variable_bindings()
+
+    # Sampling body groundings
+    for attempt in range(1, sample_size + 1):
+        # Try to find a valid body grounding
+        grounding = sampler._sample_body_grounding(kg, variable_bindings)
+        if grounding:
+            for rule in rules:
+                rule.body_groundings_count += 1
+
+                # Check if this grounding makes the head true
+                if rule._check_head_grounding(kg, grounding):
+                    rule.head_groundings_count += 1
+
+        # Stopping early if none of the rules can reach the minimum confidence
+        if min_conf is not None and attempt % CONFIDENCE_CHECK_INTERVAL == 0 and all(
+                confidence_upper_bound(rule.head_groundings_count, rule.body_groundings_count, pc) < min_conf
+                for rule in rules):
+            break
+
+    # Calculate confidence with smoothing
+    for rule in rules:
+        if rule.body_groundings_count > 0:
+            rule.confidence = (rule.head_groundings_count + pc) / (rule.body_groundings_count + pc)
+        else:
+            rule.confidence = 0.0
+
+
+def confidence_upper_bound(head_count: int, body_count: int, pc: float = 1.0, z: float = 1.96) -> float:
+    """
+    Upper bound (normal approximation, 95% by default) of a confidence estimated from body_count sampled
+    body groundings, of which head_count made the head true. 1.0 if no body grounding was found yet.
+    """
+    if body_count == 0:
+        return 1.0
+    p_hat = (head_count + pc) / (body_count + pc)
+    return p_hat + z * math.sqrt(p_hat * max(0.0, 1.0 - p_hat) / body_count)
+
+
+def _base_generalization(bottom_rule: BottomRule) -> Tuple[List[str], Dict[str, str], List[Triple]]:
+    """
+    Return the parts of the generalization that all rules of a BottomRule share: its flattened nodes,
+    the mapping of its nodes to variables (without any constants), and the body generalized with that mapping.
+    """
+    flattened_nodes = bottom_rule.get_flattened_nodes()
+
+    # The unique nodes (in order) are mapped to "Y" and "X" (the first two),
+    # and the rest are numbered by their position with A{i}, i.e., starting from A2
+    node_mappings = {
+        node: ("Y", "X")[index] if index < 2 else f"A{index}"
+        for index, node in enumerate(dict.fromkeys(flattened_nodes))
+    }
+    body = [
+        Triple(
+            node_mappings[triple.subject],
+            triple.relation,
+            node_mappings[triple.object],
+            timestamp=None
+        )
+        for triple in bottom_rule.body
+    ]
+    return flattened_nodes, node_mappings, body
+
+
 def generalize_bottom_rule(bottom_rule: BottomRule) -> List[GeneralizedRule]:
     """
     From a single BottomRule instance, generate the possible rules:
@@ -361,16 +454,17 @@ def generalize_bottom_rule(bottom_rule: BottomRule) -> List[GeneralizedRule]:
         print("BottomRule is None")
         return []
 
+    base_generalization = _base_generalization(bottom_rule)
     if bottom_rule.is_cyclical:
         # 3 rules: C, AC1 with Y as constant, and AC1 with X as constant.
         return [
-            GeneralizedRule(bottom_rule, "AC1", "Y_as_constant"),
-            GeneralizedRule(bottom_rule, "AC1", "X_as_constant"),
-            GeneralizedRule(bottom_rule, "C")
+            GeneralizedRule(bottom_rule, "AC1", "Y_as_constant", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule, "AC1", "X_as_constant", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule, "C", base_generalization=base_generalization)
         ]
     else:
         # 2 rules: AC1 and AC2
         return [
-            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC1"),
-            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC2")
+            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC1", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC2", base_generalization=base_generalization)
         ]
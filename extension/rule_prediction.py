@@ -1,10 +1,47 @@
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, List, Sequence, Tuple, Optional
 from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from operator import itemgetter
 import heapq
+from bisect import bisect_right, insort
+import numpy as np
 from .knowledge_graph import KnowledgeGraph, Triple
 from .rule_generalization.GeneralizedRule_withConf import GeneralizedRule
 
+# Opcodes of the body steps of a grounding plan (see `GroundingPlan`)
+CHECK = 0            # both terms bound: keeping the groundings whose triple is in the KG
+EXPAND_OBJECTS = 1   # subject bound: appending each object of the subject to the groundings
+EXPAND_SUBJECTS = 2  # object bound: appending each subject of the object to the groundings
+FAIL = 3             # neither term bound: no grounding can be completed
+
+
+@dataclass(frozen=True, slots=True)
+class GroundingPlan:
+    """
+    How a rule is grounded for the queries of one direction (binding the head subject to predict tails,
+    or the head object to predict heads), computed once when the rule is added (see `_grounding_plan`).
+    A grounding is a tuple of entities that starts with the query entity, and each body step that binds a new term
+    appends its entity, so every term has a fixed position in the groundings of a query direction,
+    and extending a grounding appends to a short tuple instead of copying a dict.
+    Since the plan does not include the head relation, rules with the same body (and head terms) have equal plans,
+    and predict the same candidates for a query entity.
+    """
+    # The queried and the predicted head term if they are constants, None for variables
+    query_constant: Optional[str]
+    predicted_constant: Optional[str]
+    # The (opcode, relation, subject_position, object_position) steps of the body
+    program: Tuple[Tuple[int, str, int, int], ...]
+    # Position of the predicted head term in the completed groundings (None if the body never binds it)
+    predicted_position: Optional[int]
+
+
 class RulePrediction:
+    # Maximum number of (grounding plan, entity) pairs whose predicted candidates are memoized per direction
+    candidate_cache_size = 200_000
+    # Maximum number of queries whose predictions are memoized per direction
+    query_cache_size = 100_000
+
     def __init__(self, rules: Dict[str, GeneralizedRule], kg: KnowledgeGraph):
         """
         Initializing the prediction engine with learned rules and the knowledge graph.
@@ -12,24 +49,127 @@ class RulePrediction:
         :param rules: Dictionary of learned rules (from AnyBURL)
         :param kg: Knowledge graph containing training data
         """
-        self.rules = rules
         self.training_kg = kg
         
-        # Indexing rules by head relation for faster lookup during prediction
+        # Indexing rules by head relation for faster lookup during prediction, in descending order of confidence.
+        # In parallel, the sort keys (negated confidences) of each relation are kept, so that new rules
+        # can be inserted at their position by binary search (see `add_rules`)
         self.rules_by_relation = defaultdict(list)
-        for rule in rules.values():
-            # Grouping rules under the key of their head relation
-            self.rules_by_relation[rule.generalized_head.relation].append(rule)
+        self._sorted_keys_by_relation = defaultdict(list)
+
+        # Indexing the rules of each relation also by the term in the queried head position:
+        # rules with a variable there apply to every query, rules with a constant only to queries of that entity
+        self.tail_rules = defaultdict(list)
+        self.head_rules = defaultdict(list)
+
+        # The candidates a rule predicts for a query entity only depend on its grounding plan and the (static)
+        # training KG, so they are memoized per (plan, entity) with an LRU cache, and computed only once for all
+        # rules with the same body. Distinct plans are numbered (by `_plan_ids`, for cheap cache keys),
+        # and the plan numbers of each rule are kept by id(rule) as a (tail plan, head plan) pair
+        self._plans = []
+        self._plan_ids = {}
+        self._rule_plans = {}
+        self._tail_candidates = lru_cache(maxsize=self.candidate_cache_size)(self._predict_candidates)
+        self._head_candidates = lru_cache(maxsize=self.candidate_cache_size)(self._predict_candidates)
+
+        # The predictions of a whole query are memoized as well, per (entity, relation, k, query time, tolerance),
+        # until rules are added (see `add_rules`)
+        self._tail_queries = lru_cache(maxsize=self.query_cache_size)(self._predict_tail_query)
+        self._head_queries = lru_cache(maxsize=self.query_cache_size)(self._predict_head_query)
+
+        # Number of rules indexed so far (breaks ties between equal confidences in the order the rules were added)
+        self._num_indexed = 0
+        self.rules = {}
+        self.add_rules(rules)
+
+    def add_rules(self, new_rules: Dict[str, GeneralizedRule]) -> None:
+        """
+        Adding (newly learned) rules to the prediction engine, without re-sorting the rules already indexed.
+        A rule whose canonical string is already known replaces the previous version of it.
+        Rules of equal confidence are applied in the order they were added.
         
-        # Sorting rules by confidence for each relation in descending order
-        for relation in self.rules_by_relation:
-            self.rules_by_relation[relation].sort(key=lambda x: x.confidence, reverse=True)
+        :param new_rules: Dictionary of rules keyed by their canonical string (as returned by AnyBURL)
+        """
+        for rule_str, rule in new_rules.items():
+            old_rule = self.rules.get(rule_str)
+            if old_rule is not None:
+                self._remove_rule(old_rule)
+            self.rules[rule_str] = rule
+
+            relation = rule.generalized_head.relation
+            sort_key = -rule.confidence
+            # Inserting after the rules of equal confidence (bisect_right), like a stable sort would
+            keys = self._sorted_keys_by_relation[relation]
+            index = bisect_right(keys, sort_key)
+            keys.insert(index, sort_key)
+            self.rules_by_relation[relation].insert(index, rule)
+
+            rank = (sort_key, self._num_indexed)
+            self._num_indexed += 1
+            insort(self.tail_rules[self._head_term_key(rule, "subject")], (rank, rule), key=itemgetter(0))
+            insort(self.head_rules[self._head_term_key(rule, "object")], (rank, rule), key=itemgetter(0))
+            head = rule.generalized_head
+            self._rule_plans[id(rule)] = (
+                self._plan_id(_grounding_plan(rule.generalized_body, head.subject, head.object)),
+                self._plan_id(_grounding_plan(rule.generalized_body, head.object, head.subject))
+            )
+
+        # The new rules may change the predictions of any query
+        if new_rules:
+            self._tail_queries.cache_clear()
+            self._head_queries.cache_clear()
+
+    def _remove_rule(self, rule: GeneralizedRule) -> None:
+        """
+        Removing a rule from all the indexes (used when a rule is replaced by a newer version of it).
+        """
+        relation = rule.generalized_head.relation
+        index = next(i for i, other in enumerate(self.rules_by_relation[relation]) if other is rule)
+        del self.rules_by_relation[relation][index]
+        del self._sorted_keys_by_relation[relation][index]
+        for rules_by_head_term, position in ((self.tail_rules, "subject"), (self.head_rules, "object")):
+            bucket = rules_by_head_term[self._head_term_key(rule, position)]
+            bucket[:] = [pair for pair in bucket if pair[1] is not rule]
+        # The memoized candidates are kept, since they are keyed by the plans, which outlive the rule
+        del self._rule_plans[id(rule)]
+
+    def _plan_id(self, plan: GroundingPlan) -> int:
+        """
+        The number of a grounding plan, where equal plans get the same number.
+        """
+        plan_id = self._plan_ids.get(plan)
+        if plan_id is None:
+            plan_id = self._plan_ids[plan] = len(self._plans)
+            self._plans.append(plan)
+        return plan_id
+
+    @staticmethod
+    def _head_term_key(rule: GeneralizedRule, position: str) -> Tuple[str, Optional[str]]:
+        """
+        The key of a rule in the index of the given queried head position ("subject" or "object"):
+        (relation, constant), where the constant is None for the rules with a variable in the position.
+        """
+        term = getattr(rule.generalized_head, position)
+        return (rule.generalized_head.relation, None if term in ("X", "Y") else term)
+    
+    def _applicable_rules(self, rules_by_head_term: Dict[Tuple[str, Optional[str]], List[Tuple[Tuple[float, int], GeneralizedRule]]],
+                          relation: str, entity: str) -> List[GeneralizedRule]:
+        """
+        Retrieving the rules that can be applied to a query of the given relation and entity,
+        in descending order of confidence (the same order as in rules_by_relation).
+        """
+        variable_rules = rules_by_head_term.get((relation, None), [])
+        constant_rules = rules_by_head_term.get((relation, entity))
+        if constant_rules is None:
+            return [rule for _, rule in variable_rules]
+        return [rule for _, rule in heapq.merge(variable_rules, constant_rules, key=itemgetter(0))]
     
     def predict_tail(self, subject: str, relation: str, k: int = 10,
                      query_time: Optional[float] = None, tolerance: float = 0.0) -> List[Tuple[str, float]]:
         """
         Predicting top-k tail entities for a given (subject, relation) pair.
         Optionally, enforcing temporal consistency with a given query time.
+        Repeated queries return the memoized list of predictions (which is shared, so it should not be modified).
         
         :param subject: Subject entity
         :param relation: Relation
@@ -38,39 +178,48 @@ class RulePrediction:
         :param tolerance: Tolerance for temporal matching.
         :return: List of (predicted_object, confidence) tuples, sorted by confidence.
         """
+        return self._tail_queries(subject, relation, k, query_time, tolerance)
+
+    def _predict_tail_query(self, subject: str, relation: str, k: int,
+                            query_time: Optional[float], tolerance: float) -> List[Tuple[str, float]]:
+        """
+        Predicting the top-k tail entities of a query (see `predict_tail`), without the memoization.
+        """
         # Creating a mapping from candidate objects to a list of confidence scores
         candidates = defaultdict(list)
-        # Retrieving rules that are applicable for the specified relation
-        applicable_rules = self.rules_by_relation.get(relation, [])
+        # Retrieving rules that are applicable for the specified relation and subject
+        applicable_rules = self._applicable_rules(self.tail_rules, relation, subject)
+        if not applicable_rules:
+            # Returning right away for queries without rules (e.g., relations that no rule predicts)
+            return []
+        
+        # The best confidences of the first k + 1 candidates (see `_top_k_settled`)
+        leading = []
         
         # Iterating over each applicable rule to generate predictions
-        for rule in applicable_rules:
+        for i, rule in enumerate(applicable_rules):
+            # Stopping once the less confident rules can no longer change the top-k
+            if (i and rule.confidence < applicable_rules[i - 1].confidence
+                    and _top_k_settled(leading, k, rule.confidence)):
+                break
             # Applying the rule to predict tail entities given the subject
             predictions = self._apply_rule_tail(rule, subject, query_time, tolerance)
             for obj, conf in predictions:
+                if obj not in candidates and len(leading) <= k:
+                    leading.append(conf)
                 # Collecting confidence scores for each candidate object
                 candidates[obj].append(conf)
         
-        # Aggregating confidences using the maximum strategy as described in the paper
-        aggregated = []
-        for obj, confidences in candidates.items():
-            # Sorting confidences in descending order
-            sorted_conf = sorted(confidences, reverse=True)
-            # Creating a tuple of confidences padded with zeros for lexicographic comparison
-            conf_tuple = tuple(sorted_conf + [0] * (k - len(sorted_conf)))
-            aggregated.append((obj, conf_tuple))
-        
-        # Selecting the top-k predictions based on the aggregated confidence tuples
-        top_k = heapq.nlargest(k, aggregated, key=lambda x: x[1])
-        
-        # Returning predictions with their highest confidence score
-        return [(obj, conf_tuple[0]) for obj, conf_tuple in top_k]
+        # Aggregating confidences using the maximum strategy as described in the paper,
+        # and selecting the top-k predictions (with their highest confidence score)
+        return _top_k(candidates, k)
     
     def predict_head(self, relation: str, object: str, k: int = 10,
                      query_time: Optional[float] = None, tolerance: float = 0.0) -> List[Tuple[str, float]]:
         """
         Predicting top-k head entities for a given (relation, object) pair.
         Optionally, enforcing temporal consistency with a given query time.
+        Repeated queries return the memoized list of predictions (which is shared, so it should not be modified).
         
         :param relation: Relation
         :param object: Object entity
@@ -79,32 +228,67 @@ class RulePrediction:
         :param tolerance: Tolerance for temporal matching.
         :return: List of (predicted_subject, confidence) tuples, sorted by confidence.
         """
+        return self._head_queries(relation, object, k, query_time, tolerance)
+
+    def _predict_head_query(self, relation: str, object: str, k: int,
+                            query_time: Optional[float], tolerance: float) -> List[Tuple[str, float]]:
+        """
+        Predicting the top-k head entities of a query (see `predict_head`), without the memoization.
+        """
         # Creating a mapping from candidate subjects to a list of confidence scores
         candidates = defaultdict(list)
-        # Retrieving rules that are applicable for the specified relation
-        applicable_rules = self.rules_by_relation.get(relation, [])
+        # Retrieving rules that are applicable for the specified relation and object
+        applicable_rules = self._applicable_rules(self.head_rules, relation, object)
+        if not applicable_rules:
+            # Returning right away for queries without rules (e.g., relations that no rule predicts)
+            return []
+        
+        # The best confidences of the first k + 1 candidates (see `_top_k_settled`)
+        leading = []
         
         # Iterating over each applicable rule to generate head predictions
-        for rule in applicable_rules:
+        for i, rule in enumerate(applicable_rules):
+            # Stopping once the less confident rules can no longer change the top-k
+            if (i and rule.confidence < applicable_rules[i - 1].confidence
+                    and _top_k_settled(leading, k, rule.confidence)):
+                break
             # Applying the rule to predict head entities given the object
             predictions = self._apply_rule_head(rule, object, query_time, tolerance)
             for subj, conf in predictions:
+                if subj not in candidates and len(leading) <= k:
+                    leading.append(conf)
                 # Collecting confidence scores for each candidate subject
                 candidates[subj].append(conf)
         
-        # Aggregating confidences using the maximum strategy
-        aggregated = []
-        for subj, confidences in candidates.items():
-            # Sorting confidences in descending order
-            sorted_conf = sorted(confidences, reverse=True)
-            # Creating a tuple of confidences padded with zeros for lexicographic comparison
-            conf_tuple = tuple(sorted_conf + [0] * (k - len(sorted_conf)))
-            aggregated.append((subj, conf_tuple))
+        # Aggregating confidences using the maximum strategy,
+        # and selecting the top-k predictions (with their highest confidence score)
+        return _top_k(candidates, k)
+    
+    def predict_tail_batch(self, subjects: Sequence[str], relations: Sequence[str], k: int = 10,
+                           query_times: Optional[Sequence[float]] = None,
+                           tolerance: float = 0.0) -> List[List[Tuple[str, float]]]:
+        """
+        Predicting top-k tail entities for many (subject, relation) pairs at once.
+        Repeated queries are only predicted once (and share their list of predictions), and the queries are
+        predicted grouped by relation, so the rules of a relation are applied to all of its queries in a row.
         
-        # Selecting the top-k predictions based on the aggregated confidence tuples
-        top_k = heapq.nlargest(k, aggregated, key=lambda x: x[1])
-        # Returning predictions with their highest confidence score
-        return [(subj, conf_tuple[0]) for subj, conf_tuple in top_k]
+        :param subjects: Subject entity of each query
+        :param relations: Relation of each query
+        :param k: Number of predictions to return per query
+        :param query_times: Optional timestamp of each query to filter its predictions (see `predict_tail`).
+        :param tolerance: Tolerance for temporal matching.
+        :return: For each query, the list of (predicted_object, confidence) tuples, sorted by confidence.
+        """
+        if query_times is None:
+            query_times = [None] * len(subjects)
+        queries = list(zip(subjects, relations, query_times))
+        unique_queries = sorted(dict.fromkeys(queries), key=lambda query: query[1])
+        predictions = {
+            (subject, relation, query_time): self.predict_tail(subject, relation, k=k, query_time=query_time,
+                                                               tolerance=tolerance)
+            for subject, relation, query_time in unique_queries
+        }
+        return [predictions[query] for query in queries]
     
     def _apply_rule_tail(self, rule: GeneralizedRule, subject: str,
                           query_time: Optional[float], tolerance: float) -> List[Tuple[str, float]]:
@@ -119,37 +303,7 @@ class RulePrediction:
         :return: List of (predicted_tail, confidence) tuples.
         """
         predictions = []
-        grounding = {}
-        
-        # Binding the provided subject to the appropriate variable in the rule head
-        if rule.generalized_head.subject == "Y":
-            grounding["Y"] = subject
-        elif rule.generalized_head.subject == "X":
-            grounding["X"] = subject
-        else:  # Handling a constant in the head subject position
-            if rule.generalized_head.subject != subject:
-                # Returning empty if the constant does not match the query subject
-                return []
-            grounding[subject] = subject
-        
-        # Attempting to complete the grounding using the rule body
-        completed_groundings = self._complete_grounding(rule, grounding)
-        
-        # Extracting predictions from each completed grounding
-        for grounding in completed_groundings:
-            if rule.generalized_head.object == "X":
-                if "X" in grounding:
-                    candidate = grounding["X"]
-                else:
-                    continue
-            elif rule.generalized_head.object == "Y":
-                if "Y" in grounding:
-                    candidate = grounding["Y"]
-                else:
-                    continue
-            else:
-                candidate = rule.generalized_head.object
-            
+        for candidate in self._tail_candidates(self._rule_plans[id(rule)][0], subject):
             # If temporal filtering is requested, verifying the predicted fact's timestamp
             if query_time is not None:
                 if not self.training_kg.has_fact_temporal(subject,
@@ -175,37 +329,7 @@ class RulePrediction:
         :return: List of (predicted_head, confidence) tuples.
         """
         predictions = []
-        grounding = {}
-        
-        # Binding the provided object to the appropriate variable in the rule head
-        if rule.generalized_head.object == "Y":
-            grounding["Y"] = object
-        elif rule.generalized_head.object == "X":
-            grounding["X"] = object
-        else:  # Handling a constant in the head object position
-            if rule.generalized_head.object != object:
-                # Returning empty if the constant does not match the query object
-                return []
-            grounding[object] = object
-        
-        # Attempting to complete the grounding using the rule body
-        completed_groundings = self._complete_grounding(rule, grounding)
-        
-        # Iterating over each completed grounding to extract the head prediction
-        for grounding in completed_groundings:
-            if rule.generalized_head.subject == "X":
-                if "X" in grounding:
-                    candidate = grounding["X"]
-                else:
-                    continue
-            elif rule.generalized_head.subject == "Y":
-                if "Y" in grounding:
-                    candidate = grounding["Y"]
-                else:
-                    continue
-            else:
-                candidate = rule.generalized_head.subject
-            
+        for candidate in self._head_candidates(self._rule_plans[id(rule)][1], object):
             # If temporal filtering is requested, verifying the predicted fact's timestamp
             if query_time is not None:
                 if not self.training_kg.has_fact_temporal(candidate,
@@ -218,64 +342,164 @@ class RulePrediction:
             predictions.append((candidate, rule.confidence))
         return predictions
     
-    def _complete_grounding(self, rule: GeneralizedRule, partial_grounding: Dict[str, str]) -> List[Dict[str, str]]:
+    def _predict_candidates(self, plan_id: int, entity: str) -> Tuple[str, ...]:
+        """
+        Grounding a rule (given by the number of its grounding plan for the query direction) for a query entity,
+        and extracting the predicted entities (one per completed grounding).
+        Memoized as `_tail_candidates` and `_head_candidates`.
+        
+        :param plan_id: The number of the grounding plan (see `_plan_id`).
+        :param entity: The entity provided in the query (the subject for tail, the object for head queries).
+        :return: Tuple of the predicted entities.
+        """
+        plan = self._plans[plan_id]
+        
+        # Returning empty if a constant in the queried head position does not match the query entity
+        if plan.query_constant is not None and plan.query_constant != entity:
+            return ()
+        
+        # Attempting to complete the grounding of the provided entity using the rule body
+        completed_groundings = self._complete_grounding(plan.program, (entity,))
+        
+        # Extracting the prediction from each completed grounding
+        if plan.predicted_constant is not None:
+            return (plan.predicted_constant,) * len(completed_groundings)
+        position = plan.predicted_position
+        if position is None:
+            return ()
+        return tuple(grounding[position] for grounding in completed_groundings)
+    
+    def _complete_grounding(self, program: Tuple[Tuple[int, str, int, int], ...],
+                            partial_grounding: Tuple[str, ...]) -> List[Tuple[str, ...]]:
         """
         Completing a partial grounding using the rule body.
         Iteratively binding variables by matching rule body triples with facts in the KG.
         
-        :param rule: The generalized rule being applied.
-        :param partial_grounding: A dictionary with some variables already bound.
-        :return: A list of fully completed groundings (each a dict mapping variable names to entities).
+        :param program: The body steps of the rule for the query direction (see `GroundingPlan`).
+        :param partial_grounding: A tuple holding the query entity.
+        :return: A list of fully completed groundings (tuples of the entities bound to the terms, in binding order).
                  Returning an empty list if no valid completions exist.
         """
-        def _bind_variables(triple: Triple, current_grounding: Dict[str, str]) -> List[Dict[str, str]]:
-            """
-            Binding variables for a given triple in the rule body and a current grounding using the knowledge graph.
-            
-            :param triple: A triple (subject, relation, object) from the rule body.
-            :param current_grounding: Current mapping of variables to entities.
-            :return: A list of extended groundings with additional variable bindings.
-            """
-            new_groundings = []
-            subj = str(triple.subject)
-            obj = str(triple.object)
-            
-            # Handling the case when both subject and object are already bound
-            if subj in current_grounding and obj in current_grounding:
-                # Checking if the fact exists in the knowledge graph
-                if self.training_kg.has_fact(current_grounding[subj], triple.relation, current_grounding[obj]):
-                    new_groundings.append(current_grounding.copy())
-            
-            # Handling the case when the subject is bound
-            elif subj in current_grounding:
-                # Iterating over all possible objects linked to the bound subject
-                for possible_obj in self.training_kg.adj[triple.relation].get(current_grounding[subj], []):
-                    new_grounding = current_grounding.copy()
-                    new_grounding[obj] = possible_obj
-                    new_groundings.append(new_grounding)
-                    
-            # Handling the case when the object is bound
-            elif obj in current_grounding:
-                # Iterating over all possible subjects linked to the bound object
-                for possible_subj in self.training_kg.adj_inv[triple.relation].get(current_grounding[obj], []):
-                    new_grounding = current_grounding.copy()
-                    new_grounding[subj] = possible_subj
-                    new_groundings.append(new_grounding)
-
-            return new_groundings
-
         # Initializing the list of current groundings with the provided partial grounding
         current_groundings = [partial_grounding]
         
-        # Iterating over each triple in the rule body to extend the grounding
-        for body_triple in rule.generalized_body:
-            new_groundings = []
-            for grounding in current_groundings:
-                # Extending the current grounding using available facts
-                new_groundings.extend(_bind_variables(body_triple, grounding))
-            current_groundings = new_groundings
+        # Running each body step for all groundings at once (they all bind the same terms,
+        # so which terms of a triple are bound is decided by the plan, not per grounding)
+        for opcode, relation, subj, obj in program:
+            if opcode == CHECK:
+                # Keeping the groundings whose fact exists in the knowledge graph
+                rel_adj = self.training_kg.adj.get(relation, {})
+                current_groundings = [grounding for grounding in current_groundings
+                                      if grounding[obj] in rel_adj.get(grounding[subj], ())]
+            elif opcode == EXPAND_OBJECTS:
+                # Binding the object to all possible objects linked to the bound subject
+                rel_adj = self.training_kg.adj.get(relation, {})
+                current_groundings = [grounding + (possible_obj,) for grounding in current_groundings
+                                      for possible_obj in rel_adj.get(grounding[subj], ())]
+            elif opcode == EXPAND_SUBJECTS:
+                # Binding the subject to all possible subjects linked to the bound object
+                rel_adj_inv = self.training_kg.adj_inv.get(relation, {})
+                current_groundings = [grounding + (possible_subj,) for grounding in current_groundings
+                                      for possible_subj in rel_adj_inv.get(grounding[obj], ())]
+            else:
+                current_groundings = []
+
             if not current_groundings:
                 # Stopping early if no valid groundings can be formed
                 break
                 
         return current_groundings
+
+
+def _grounding_plan(body: List[Triple], query_term: str, predicted_term: str) -> GroundingPlan:
+    """
+    Compiling a rule body to the grounding plan (see `GroundingPlan`) for queries binding the query_term of the head.
+    Each term gets the position at which it is bound (the query term first), and each body triple becomes
+    an (opcode, relation, subject_position, object_position) step, where a newly bound term is appended.
+    
+    :param body: The generalized body of the rule.
+    :param query_term: The head term bound by the query.
+    :param predicted_term: The other head term, i.e., the one to predict.
+    :return: The grounding plan.
+    """
+    positions = {query_term: 0}
+    program = []
+    for triple in body:
+        subj = positions.get(triple.subject)
+        obj = positions.get(triple.object)
+        if subj is not None and obj is not None:
+            program.append((CHECK, triple.relation, subj, obj))
+        elif subj is not None:
+            obj = positions[triple.object] = len(positions)
+            program.append((EXPAND_OBJECTS, triple.relation, subj, obj))
+        elif obj is not None:
+            subj = positions[triple.subject] = len(positions)
+            program.append((EXPAND_SUBJECTS, triple.relation, subj, obj))
+        else:
+            program.append((FAIL, triple.relation, -1, -1))
+            break
+    return GroundingPlan(
+        query_constant=None if query_term in ("X", "Y") else query_term,
+        predicted_constant=None if predicted_term in ("X", "Y") else predicted_term,
+        program=tuple(program),
+        predicted_position=positions.get(predicted_term)
+    )
+
+
+def _top_k(candidates: Dict[str, List[float]], k: int) -> List[Tuple[str, float]]:
+    """
+    Selecting the top-k candidates under the maximum aggregation strategy, i.e., comparing their confidences
+    sorted in descending order (padded with zeros) lexicographically, where equal candidates keep the order
+    in which they were predicted.
+    Only candidates whose best confidence reaches the k-th largest one can make it into the top-k, so these
+    are found with a partition over the best confidences first, and only they are compared by all their confidences
+    (if their best confidences are not already distinct).
+    
+    :param candidates: Mapping from candidates to the confidences of their predictions (in order of first prediction).
+    :param k: Number of predictions to return.
+    :return: List of (candidate, highest_confidence) tuples, best first.
+    """
+    if k <= 0 or not candidates:
+        return []
+    names = list(candidates)
+    confidences = list(candidates.values())
+    best = np.fromiter(map(max, confidences), dtype=np.float64, count=len(confidences))
+    survivors = list(range(len(names)))
+    if len(names) > k:
+        kth_best = np.partition(best, len(names) - k)[len(names) - k]
+        survivors = np.flatnonzero(best >= kth_best).tolist()
+
+    # If their best confidences are all distinct, these alone decide the ranking,
+    # which is the common case, so the padded confidences are only compared when there are ties
+    survivor_best = best[survivors]
+    if len(np.unique(survivor_best)) == len(survivor_best):
+        order = np.argsort(-survivor_best, kind='stable')[:k].tolist()
+        return [(names[survivors[i]], float(survivor_best[i])) for i in order]
+
+    def padded_confidences(i):
+        sorted_conf = sorted(confidences[i], reverse=True)
+        return sorted_conf + [0] * (k - len(sorted_conf))
+
+    # The sort is stable, so ties stay in the order of first prediction
+    top_k = sorted(survivors, key=padded_confidences, reverse=True)[:k]
+    return [(names[i], float(best[i])) for i in top_k]
+
+
+def _top_k_settled(leading: List[float], k: int, confidence: float) -> bool:
+    """
+    Checking whether rules with (at most) the given confidence can still change the top-k candidates or their order.
+    Since rules are applied in descending order of confidence, candidates are first predicted in descending order
+    of their best confidence, and less confident rules can only add lower confidences.
+    So if the first k candidates have distinct best confidences, all above the best one of the next candidate
+    and the given confidence, their ranking is decided by the best confidences alone.
+    
+    :param leading: The best confidences of the first (up to k + 1) candidates, in order of first prediction.
+    :param k: Number of predictions to return.
+    :param confidence: Confidence of the next rule.
+    :return: True if the top-k is settled.
+    """
+    if k <= 0:
+        return True
+    if len(leading) < k:
+        return False
+    return leading[k - 1] > confidence and all(a > b for a, b in zip(leading, leading[1:]))
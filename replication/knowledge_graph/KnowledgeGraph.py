@@ -1,4 +1,4 @@
-from collections import defaultdict
+import numpy as np
 from .Triple import Triple
 
 class KnowledgeGraph:
@@ -6,31 +6,190 @@ class KnowledgeGraph:
         """
         :param triples: list of Triple objects or (subject, relation, object) tuples.
         """
-        self.triples = []
-        self.outgoing = defaultdict(list)
-        self.incoming = defaultdict(list)
-        self.adj = defaultdict(lambda: defaultdict(set))
-        # self.adj[relation][subject] = {object_1, object_2, ..., object_n}
-        self.adj_inv = defaultdict(lambda: defaultdict(set))
-        # self.adj_inv[relation][object] = {subject_1, subject_2, ..., subject_n}
-        self.relations = set()
-        self.entities = set()
-
-        for triple in triples:
-            if not isinstance(triple, Triple):
-                triple = Triple.from_tuple(triple)
-            self.triples.append(triple)
-            s, r, o = triple
-            self.outgoing[s].append((r, o))
-            self.incoming[o].append((r, s))
-            self.adj[r][s].add(o)
-            self.adj_inv[r][o].add(s)
-            self.relations.add(r)
-            self.entities.add(s)
-            self.entities.add(o)
-        
-        self.relations = list(self.relations)
-        self.entities = list(self.entities)
+        subjects, relations, objects = [], [], []
+        for s, r, o in triples:
+            subjects.append(s)
+            relations.append(r)
+            objects.append(o)
+        self._build(subjects, relations, objects)
+
+    @classmethod
+    def from_arrays(cls, subjects, relations, objects):
+        """
+        Build the KG directly from three parallel arrays (or lists) of subjects, relations and objects,
+        without going through Triple objects.
+        """
+        kg = cls.__new__(cls)
+        kg._build(subjects, relations, objects)
+        return kg
+
+    @classmethod
+    def from_ids(cls, triple_ids, entity_names, relation_names):
+        """
+        Build the KG from an (N, 3) integer array of (subject, relation, object) rows that index into the given
+        entity and relation vocabularies (e.g., as stored in an .npz file), without going through the names.
+        """
+        triple_ids = np.asarray(triple_ids)
+        kg = cls.__new__(cls)
+        kg._build(triple_ids[:, 0], triple_ids[:, 1], triple_ids[:, 2], entity_names, relation_names)
+        return kg
+
+    def _build(self, subjects, relations, objects, entity_names=None, relation_names=None):
+        subjects = np.asarray(subjects)
+        relations = np.asarray(relations)
+        objects = np.asarray(objects)
+
+        # Entities and relations are interned to contiguous integer IDs (in order of first appearance),
+        # the adjacency indices below are keyed by (and store) these IDs.
+        ent_ids, self.id2ent = self._factorize(np.stack([subjects, objects], axis=1).ravel())
+        rel_ids, self.id2rel = self._factorize(relations)
+        # If given as indices into vocabularies, the names are looked up only for the distinct ones
+        if entity_names is not None:
+            self.id2ent = [entity_names[i] for i in self.id2ent]
+        if relation_names is not None:
+            self.id2rel = [relation_names[i] for i in self.id2rel]
+        self.ent2id = {entity: i for i, entity in enumerate(self.id2ent)}
+        self.rel2id = {relation: i for i, relation in enumerate(self.id2rel)}
+        s_ids, o_ids = ent_ids[0::2], ent_ids[1::2]
+
+        # Dropping duplicate triples (keeping the first occurrence of each) by their packed keys (see `fact_key`)
+        keys, first_index = np.unique(self.fact_key(s_ids, rel_ids, o_ids), return_index=True)
+        if len(first_index) < len(s_ids):
+            first_index.sort()
+            s_ids, rel_ids, o_ids = s_ids[first_index], rel_ids[first_index], o_ids[first_index]
+
+        # The triples themselves are stored as an (N, 3) array of (subject_id, relation_id, object_id) rows,
+        # Triple objects are only created on demand (see `get_triple` and `iter_triples`)
+        self.triples = np.stack([s_ids, rel_ids, o_ids], axis=1).astype(np.int32)
+
+        # The edges of all entities laid out per direction as one contiguous CSR structure of int32 arrays,
+        # in input order: the outgoing edges of entity i are out_relations[out_indptr[i]:out_indptr[i + 1]],
+        # with their objects in out_neighbors. Same for in_* with the incoming edges and their subjects.
+        self.out_indptr, self.out_relations, self.out_neighbors = self._group_edges(s_ids, rel_ids, o_ids)
+        self.in_indptr, self.in_relations, self.in_neighbors = self._group_edges(o_ids, rel_ids, s_ids)
+
+        self.relations = list(self.id2rel)
+        self.entities = list(self.id2ent)
+
+        # Freezing the adjacency into one CSR structure per relation:
+        # self.adj_csr[relation_id] = (indptr, neighbors), where the (sorted) objects of a subject are
+        # neighbors[indptr[subject_id]:indptr[subject_id + 1]]. Same for adj_inv_csr with subjects of an object.
+        # Built from the (sorted) distinct packed keys.
+        num_entities, num_relations = len(self.id2ent), len(self.id2rel)
+        r_ids = keys % num_relations
+        o_ids = (keys // num_relations) % num_entities
+        s_ids = keys // num_relations // num_entities
+        self.adj_csr = self._to_csr(r_ids, s_ids, o_ids)
+        self.adj_inv_csr = self._to_csr(r_ids, o_ids, s_ids)
+
+        # Entities that have at least one outgoing edge with a given relation
+        self.relation_subjects = [np.flatnonzero(np.diff(indptr)).astype(np.int32) for indptr, _ in self.adj_csr]
+
+        # For has_fact, each (s, r, o) is also packed into a single integer key in a flat set,
+        # which makes the membership check a single O(1) lookup.
+        self.fact_keys = set(keys.tolist())
+
+        # The triples that can start a path of more than one body edge, per direction_allowed (see `_viable_heads`)
+        self.viable_heads = {
+            direction_allowed: self._viable_heads(direction_allowed)
+            for direction_allowed in ("both", "forward-only", "backward-only")
+        }
+
+        # Scratch mask over the entity IDs for the path sampler, marking the nodes visited by the current walk
+        # (see `sample_bottom_rule`, which resets it after each walk, so it is all False in between)
+        self.visited_mask = np.zeros(num_entities, dtype=bool)
+
+    @staticmethod
+    def _factorize(values):
+        """
+        Map each value to an integer ID (numbered by first appearance), returning the IDs and the vocabulary.
+        """
+        if len(values) == 0:
+            return np.zeros(0, dtype=np.int64), []
+        uniques, first_index, inverse = np.unique(values, return_index=True, return_inverse=True)
+        by_appearance = np.argsort(first_index)
+        remap = np.empty(len(uniques), dtype=np.int64)
+        remap[by_appearance] = np.arange(len(uniques))
+        return remap[inverse], uniques[by_appearance].tolist()
+
+    def _group_edges(self, node_ids, r_ids, neighbor_ids):
+        """
+        Group the edges node --r--> neighbor by node into CSR arrays (indptr, relation_ids, neighbor_ids),
+        keeping the order of the edges of each node.
+        """
+        order = np.argsort(node_ids, kind='stable')
+        relations = r_ids[order].astype(np.int32)
+        neighbors = neighbor_ids[order].astype(np.int32)
+        indptr = np.zeros(len(self.id2ent) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(node_ids, minlength=len(self.id2ent)), out=indptr[1:])
+        return indptr, relations, neighbors
+
+    def _to_csr(self, r_ids, node_ids, neighbor_ids):
+        """
+        Group the (distinct) edges node --r--> neighbor into a list of (indptr, neighbors) int32 arrays,
+        one per relation ID, with the neighbors of each node sorted.
+        """
+        num_entities = len(self.id2ent)
+        order = np.lexsort((neighbor_ids, node_ids, r_ids))
+        r_ids, node_ids, neighbor_ids = r_ids[order], node_ids[order], neighbor_ids[order]
+        bounds = np.searchsorted(r_ids, np.arange(len(self.id2rel) + 1))
+        csr = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            indptr = np.zeros(num_entities + 1, dtype=np.int32)
+            np.cumsum(np.bincount(node_ids[start:end], minlength=num_entities), out=indptr[1:])
+            csr.append((indptr, neighbor_ids[start:end].astype(np.int32)))
+        return csr
+
+    def _viable_heads(self, direction_allowed):
+        """
+        Return the indices (rows of self.triples) of the triples from which a path can take a first step
+        in the allowed direction(s) to a node other than the two head nodes. From the other triples,
+        only a single body edge (closing the cycle) can be sampled, so all longer paths starting there fail.
+        """
+        if not len(self.triples):
+            return np.zeros(0, dtype=np.int64)
+        num_entities = len(self.id2ent)
+        s_ids, o_ids = self.triples[:, 0].astype(np.int64), self.triples[:, 2].astype(np.int64)
+        out_degrees, in_degrees = np.diff(self.out_indptr), np.diff(self.in_indptr)
+
+        # Number of edges from subject to object, and from object to subject, of each triple
+        pair_keys, pair_counts = np.unique(s_ids * num_entities + o_ids, return_counts=True)
+        def count_edges(from_ids, to_ids):
+            keys = from_ids * num_entities + to_ids
+            index = np.minimum(np.searchsorted(pair_keys, keys), len(pair_keys) - 1)
+            return np.where(pair_keys[index] == keys, pair_counts[index], 0)
+        forward_edges, backward_edges = count_edges(s_ids, o_ids), count_edges(o_ids, s_ids)
+        # Self-loops of the head nodes (only counted once if the head itself is a self-loop)
+        is_loop = s_ids == o_ids
+        loops = np.bincount(s_ids[is_loop], minlength=num_entities)
+        subject_loops, object_loops = np.where(is_loop, 0, loops[s_ids]), np.where(is_loop, 0, loops[o_ids])
+
+        # Number of edges of each head node (in each direction) leading to other nodes
+        subject_out = out_degrees[s_ids] - forward_edges - subject_loops
+        subject_in = in_degrees[s_ids] - backward_edges - subject_loops
+        object_out = out_degrees[o_ids] - backward_edges - object_loops
+        object_in = in_degrees[o_ids] - forward_edges - object_loops
+        if direction_allowed == "forward-only":
+            is_viable = (subject_out > 0) | (object_out > 0)
+        elif direction_allowed == "backward-only":
+            is_viable = (subject_in > 0) | (object_in > 0)
+        else:
+            is_viable = (subject_out + subject_in + object_out + object_in) > 0
+        return np.flatnonzero(is_viable)
+
+    def get_triple(self, index):
+        """
+        Return the triple at the given row of self.triples as a Triple object (with entity and relation names).
+        """
+        s_id, r_id, o_id = self.triples[index].tolist()
+        return Triple(self.id2ent[s_id], self.id2rel[r_id], self.id2ent[o_id])
+
+    def iter_triples(self):
+        """
+        Lazily iterate over all triples of the KG as Triple objects.
+        """
+        for s_id, r_id, o_id in self.triples.tolist():
+            yield Triple(self.id2ent[s_id], self.id2rel[r_id], self.id2ent[o_id])
 
     def size(self):
         """
@@ -49,9 +208,73 @@ class KnowledgeGraph:
         Return the complete list (or set) of relations (relation IDs) in the KG.
         """
         return self.relations
-    
+
+    def neighbors_of(self, r_id, s_id):
+        """
+        Return the sorted object IDs o such that (s_id, r_id, o) is in the KG, as a view into the CSR arrays.
+        """
+        indptr, neighbors = self.adj_csr[r_id]
+        return neighbors[indptr[s_id]:indptr[s_id + 1]]
+
+    def inv_neighbors_of(self, r_id, o_id):
+        """
+        Return the sorted subject IDs s such that (s, r_id, o_id) is in the KG, as a view into the CSR arrays.
+        """
+        indptr, neighbors = self.adj_inv_csr[r_id]
+        return neighbors[indptr[o_id]:indptr[o_id + 1]]
+
     def has_fact(self, s, r, o):
         """
         Quickly check if a specific triple (s,r,o) is in the KG.
+        Entities and relations that are not in the KG simply give False.
+        """
+        s_id = self.ent2id.get(s)
+        r_id = self.rel2id.get(r)
+        o_id = self.ent2id.get(o)
+        if s_id is None or r_id is None or o_id is None:
+            return False
+        return self.has_fact_ids(s_id, r_id, o_id)
+
+    def fact_key(self, s_id, r_id, o_id):
+        """
+        Pack an (s,r,o) triple of integer IDs into a single integer (works elementwise on NumPy arrays too).
+        The packed key can exceed the int32 range, so the IDs have to be Python ints or int64 (arrays);
+        with int32 IDs (e.g., taken from `triples`), the key silently overflows.
+        """
+        return (s_id * len(self.id2ent) + o_id) * len(self.id2rel) + r_id
+
+    def has_fact_ids(self, s_id, r_id, o_id):
+        """
+        Same as has_fact, but for an (s,r,o) triple that is already given in (valid) integer IDs.
+        The IDs may also be NumPy integers (e.g., taken from `triples`), which are turned into Python ints first,
+        so that the packed key (see `fact_key`) can't overflow.
+        """
+        return (int(s_id) * len(self.id2ent) + int(o_id)) * len(self.id2rel) + int(r_id) in self.fact_keys
+
+    def has_facts_ids(self, s_ids, r_id, o_ids):
+        """
+        Vectorized has_fact_ids for a batch of (s, r_id, o) triples sharing the same relation.
+        
+        :param s_ids: integer array of subject IDs
+        :param r_id: relation ID
+        :param o_ids: integer array of object IDs (same length as s_ids)
+        :return: boolean array, True where (s_ids[i], r_id, o_ids[i]) is in the KG
         """
-        return o in self.adj[r][s]
+        indptr, neighbors = self.adj_csr[r_id]
+        s_ids = np.asarray(s_ids, dtype=np.int64)
+        o_ids = np.asarray(o_ids, dtype=np.int64)
+        # Each subject's (sorted) objects are the CSR slice [lo, hi), so we run
+        # a binary search in all of these slices at once, i.e., log(max degree) vectorized passes.
+        lo = indptr[s_ids].astype(np.int64)
+        hi = indptr[s_ids + 1].astype(np.int64)
+        end = hi.copy()
+        active = lo < hi
+        while active.any():
+            mid = np.minimum((lo + hi) // 2, len(neighbors) - 1)
+            go_right = neighbors[mid] < o_ids
+            lo = np.where(active & go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+            active = lo < hi
+        found = lo < end
+        found[found] = neighbors[lo[found]] == o_ids[found]
+        return found
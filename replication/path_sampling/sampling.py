@@ -1,4 +1,6 @@
 import random
+import numpy as np
+from typing import List, Optional
 from ..knowledge_graph import KnowledgeGraph, Triple
 from .BottomRule import BottomRule
 
@@ -16,25 +18,23 @@ def pick_step_direction(direction_allowed):
         raise ValueError(f"Unsupported direction_allowed: {direction_allowed}")
 
 
-def get_possible_moves(kg, current_node, step_direction):
+def get_possible_moves(kg, current_id, step_direction):
     """
-    Enumerate all possible edges from 'current_node' in the chosen direction.
+    Enumerate all possible edges from the entity with ID 'current_id' in the chosen direction,
+    as views into the KG's CSR arrays (no Triple objects are created, see `move_to_triple`).
     
     :param kg: KnowledgeGraph instance
-    :param current_node: The current entity node
+    :param current_id: The ID of the current entity node
     :param step_direction: 'forward' or 'backward'
-    :return: List of possible moves as tuples (subj, rel, obj).
+    :return: Parallel arrays (relation_ids, neighbor_ids) of the possible moves, where the neighbor is
+             the object of a forward move and the subject of a backward move.
     """
     if step_direction == 'forward':
-        return [
-            Triple.from_tuple((current_node, r, o)) 
-            for (r, o) in kg.outgoing.get(current_node, [])
-        ]
+        start, end = kg.out_indptr[current_id], kg.out_indptr[current_id + 1]
+        return kg.out_relations[start:end], kg.out_neighbors[start:end]
     else:
-        return [
-            Triple.from_tuple((s, r, current_node)) 
-            for (r, s) in kg.incoming.get(current_node, [])
-        ]
+        start, end = kg.in_indptr[current_id], kg.in_indptr[current_id + 1]
+        return kg.in_relations[start:end], kg.in_neighbors[start:end]
     
     ### OLD CODE: ###
     # We first want to create a list of possible moves that we can take from our current_node.
@@ -56,41 +56,43 @@ def get_possible_moves(kg, current_node, step_direction):
     # return possible_moves
 
 
-def filter_valid_moves(bottom_rule, possible_moves, step_direction, is_last_step):
+def filter_valid_moves(visited_mask, possible_moves, closing_id, is_last_step):
     """
     Filter out moves that revisit intermediate nodes unless it's the final step and cycles are allowed.
 
-    :param bottom_rule: BottomRule instance
-    :param possible_moves: List of possible moves as tuples (subj, rel, obj)
-    :param step_direction: 'forward' or 'backward'
+    :param visited_mask: Boolean mask over the entity IDs, True for the nodes visited so far
+    :param possible_moves: (relation_ids, neighbor_ids) of the possible moves (see `get_possible_moves`)
+    :param closing_id: ID of the node that closes a cycle (the head node the walk did not start from)
     :param is_last_step: Boolean indicating if it's the last step
-    :return: List of filtered valid moves
+    :return: Indices of the valid moves
     """
-    
-    filtered_possible_moves = []
-
-    for move in possible_moves:
-        if step_direction == 'forward':
-            next_node = move.object
-            if next_node in bottom_rule.visited:
-                if is_last_step:
-                    if bottom_rule.start_from == 'subject' and next_node == bottom_rule.head.object:
-                        filtered_possible_moves.append(move)
-                    elif bottom_rule.start_from == 'object' and next_node == bottom_rule.head.subject:
-                        filtered_possible_moves.append(move)
-            else:
-                filtered_possible_moves.append(move)
-        else:
-            prev_node = move.subject
-            if prev_node in bottom_rule.visited:
-                if is_last_step:
-                    if bottom_rule.start_from == 'subject' and prev_node == bottom_rule.head.object:
-                        filtered_possible_moves.append(move)
-                    elif bottom_rule.start_from == 'object' and prev_node == bottom_rule.head.subject:
-                        filtered_possible_moves.append(move)
-            else:
-                filtered_possible_moves.append(move)
-    return filtered_possible_moves
+    # A single lookup of all neighbors in the mask (instead of comparing them with each visited node)
+    _, neighbors = possible_moves
+    is_valid = ~visited_mask[neighbors]
+    # Only the other head node may be revisited, and only in the last step (closing a cycle)
+    if is_last_step:
+        is_valid |= neighbors == closing_id
+    return np.flatnonzero(is_valid)
+
+
+def move_to_triple(kg, current_node, possible_moves, move_index, step_direction):
+    """
+    Create the Triple of a single (picked) move.
+
+    :param kg: KnowledgeGraph instance
+    :param current_node: The current entity node
+    :param possible_moves: (relation_ids, neighbor_ids) of the possible moves (see `get_possible_moves`)
+    :param move_index: Index of the move
+    :param step_direction: 'forward' or 'backward'
+    :return: The move as a Triple (current_node, rel, next_node) if forward, (prev_node, rel, current_node) if backward.
+    """
+    relations, neighbors = possible_moves
+    relation = kg.id2rel[relations[move_index]]
+    neighbor = kg.id2ent[neighbors[move_index]]
+    if step_direction == 'forward':
+        return Triple(current_node, relation, neighbor)
+    else:
+        return Triple(neighbor, relation, current_node)
 
 
 def sample_bottom_rule(kg: KnowledgeGraph, n: int = 2, direction_allowed: str = "both"):
@@ -108,7 +110,16 @@ def sample_bottom_rule(kg: KnowledgeGraph, n: int = 2, direction_allowed: str =
     # -------------------
     # 1) Picking the HEAD triple
     # -------------------
-    head_triple = random.choice(kg.triples)
+    # Paths with more than one body edge can only start from the KG's viable heads (see `KnowledgeGraph._viable_heads`)
+    if n > 2:
+        if direction_allowed not in kg.viable_heads:
+            raise ValueError(f"Unsupported direction_allowed: {direction_allowed}")
+        viable_heads = kg.viable_heads[direction_allowed]
+        if not len(viable_heads):
+            return None
+        head_triple = kg.get_triple(viable_heads[random.randrange(len(viable_heads))])
+    else:
+        head_triple = kg.get_triple(random.randrange(len(kg.triples)))
     
     # ---------------------------
     # 2) Deciding the 'start node'
@@ -129,35 +140,46 @@ def sample_bottom_rule(kg: KnowledgeGraph, n: int = 2, direction_allowed: str =
         return bottom_rule
     
     # Else, loop for taking steps
-    for step_id in range(n - 1): 
+    # The walk itself runs on the integer entity IDs of the KG's CSR arrays,
+    # so that a Triple is only created for the move that is picked
+    current_id = kg.ent2id[current_node]
+    head_ids = (kg.ent2id[head_triple.subject], kg.ent2id[head_triple.object])
+    # Only this node may be revisited, and only in the last step (closing a cycle)
+    closing_id = head_ids[1] if start_from == 'subject' else head_ids[0]
+    # The visited nodes are marked in the KG's scratch mask, and unmarked again when the walk ends
+    visited_ids = list(head_ids)
+    visited_mask = kg.visited_mask
+    visited_mask[visited_ids] = True
+    try:
+        for step_id in range(n - 1): 
 
-        # 3A) We must first decide whether we are going to go forward or backward!
-        step_direction = pick_step_direction(direction_allowed)
+            # 3A) We must first decide whether we are going to go forward or backward!
+            step_direction = pick_step_direction(direction_allowed)
 
-        # 3B) Get a list of all possible moves in a (subj, rel, obj) format 
-        possible_moves = get_possible_moves(kg, current_node, step_direction)
-        if not possible_moves:
-            return None
+            # 3B) Get the (relation, neighbor) IDs of all possible moves in the chosen direction
+            possible_moves = get_possible_moves(kg, current_id, step_direction)
+            if not len(possible_moves[1]):
+                return None
 
-        # 3C) We then filter out this list to ensure straigth paths
-        is_last_step = (step_id == (n - 2))
-        filtered_moves = filter_valid_moves(bottom_rule, possible_moves, step_direction, is_last_step)
-        if not filtered_moves:
-            return None
+            # 3C) We then filter out the moves to previously visited nodes to ensure straight paths
+            is_last_step = (step_id == (n - 2))
+            valid_moves = filter_valid_moves(visited_mask, possible_moves, closing_id, is_last_step)
+            if not len(valid_moves):
+                return None
         
-        # 3D) Now, we can pick one triple from possible_moves at random, add that to our bottom-rule
-        if step_direction == 'forward':
-            triple = random.choice(filtered_moves) # (current_node, relation, next_node)
-            bottom_rule.add_triple(triple, step_direction)
-            # Updating the current node: Move forward to the tail
-            bottom_rule.visited.add(triple.object) # next_node
-            current_node = triple.object # next_node
-        else:
-            triple = random.choice(filtered_moves) # (prev_node, relation, current_node)
+            # 3D) Now, we can pick one of the valid moves at random, and add its triple to our bottom-rule
+            # (the only Triple created in this step)
+            move_index = valid_moves[random.randrange(len(valid_moves))]
+            triple = move_to_triple(kg, current_node, possible_moves, move_index, step_direction)
             bottom_rule.add_triple(triple, step_direction)
-            # Updating the current node: Move backward to the head
-            bottom_rule.visited.add(triple.subject) # prev_node
-            current_node = triple.subject # prev_node
+            # Updating the current node: moving forward to the tail, or backward to the head
+            current_node = triple.object if step_direction == 'forward' else triple.subject
+            current_id = int(possible_moves[1][move_index])
+            bottom_rule.visited.append(current_node)
+            visited_ids.append(current_id)
+            visited_mask[current_id] = True
+    finally:
+        visited_mask[visited_ids] = False
 
     # ---------------------------------
     # 4) Check if cyclic bottom rule, and add it as an attribute
@@ -168,8 +190,131 @@ def sample_bottom_rule(kg: KnowledgeGraph, n: int = 2, direction_allowed: str =
     # else:
     #     if current_node == bottom_rule.head.subject:
     #         bottom_rule.is_cyclical = True
-    if current_node == bottom_rule.head.object or current_node == bottom_rule.head.subject:
+    if current_id in head_ids:
         bottom_rule.is_cyclical = True
 
     # Return the bottom rule of length = (1) head + (length-1) body
     return bottom_rule
+
+
+def sample_bottom_rules_batch(kg: KnowledgeGraph,
+                              n: int = 2,
+                              batch_size: int = 1000,
+                              direction_allowed: str = "both",
+                              cyclic_only: bool = False,
+                              rng: Optional[np.random.Generator] = None) -> List[BottomRule]:
+    """
+    Sample up to batch_size bottom rules of length n at once, following the same procedure as
+    `sample_bottom_rule`, but advancing all paths together on the KG's CSR arrays with NumPy
+    (one vectorized step at a time). The paths are kept as integer IDs, and only the surviving ones
+    are turned into BottomRule objects at the end. Paths that hit a dead end are dropped.
+
+    :param kg: KnowledgeGraph
+    :param n: total number of edges for the resulting bottom rules (the HEAD triple counts as 1).
+    :param batch_size: number of paths to sample.
+    :param direction_allowed: "both", "forward-only", or "backward-only"
+    :param cyclic_only: If True, only the cyclic bottom rules are returned (the others are never decoded).
+    :param rng: NumPy random generator (by default, one seeded from the `random` module, so that
+                `random.seed` makes the batches reproducible as well).
+    :return: List of the sampled BottomRule objects.
+    """
+    if n < 1:
+        raise ValueError("n must be >= 1")
+    if direction_allowed not in ("both", "forward-only", "backward-only"):
+        raise ValueError(f"Unsupported direction_allowed: {direction_allowed}")
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    if not len(kg.triples):
+        return []
+
+    # 1) Picking the HEAD triples (only the viable ones for paths with more than one body edge)
+    if n > 2:
+        viable_heads = kg.viable_heads[direction_allowed]
+        if not len(viable_heads):
+            return []
+        heads = viable_heads[rng.integers(len(viable_heads), size=batch_size)]
+    else:
+        heads = rng.integers(len(kg.triples), size=batch_size)
+    head_ids = kg.triples[heads][:, [0, 2]]
+
+    # 2) Deciding the start nodes (a self-loop head always starts from its subject)
+    from_subject = (rng.random(batch_size) < 0.5) | (head_ids[:, 0] == head_ids[:, 1])
+    current = np.where(from_subject, head_ids[:, 0], head_ids[:, 1])
+    closing = np.where(from_subject, head_ids[:, 1], head_ids[:, 0])
+
+    # 3) Expanding all paths with (n - 1) edges; visited holds the nodes of each path (-1 = not yet)
+    visited = np.full((batch_size, n + 1), -1, dtype=np.int32)
+    visited[:, :2] = head_ids
+    moves = np.zeros((batch_size, n - 1), dtype=np.int64)
+    forward = np.zeros((batch_size, n - 1), dtype=bool)
+    rows = np.arange(batch_size)
+    for step_id in range(n - 1):
+        if direction_allowed == "both":
+            step_forward = rng.random(len(rows)) < 0.5
+        else:
+            step_forward = np.full(len(rows), direction_allowed == "forward-only")
+        is_last_step = (step_id == (n - 2))
+
+        # Each direction is handled separately, for the paths stepping in it
+        survived = np.zeros(len(rows), dtype=bool)
+        for indptr, all_neighbors, is_forward in ((kg.out_indptr, kg.out_neighbors, True),
+                                                  (kg.in_indptr, kg.in_neighbors, False)):
+            paths = np.flatnonzero(step_forward == is_forward)
+            path_ids = rows[paths]
+
+            # Enumerating the possible moves of these paths as flat arrays (grouped by path), where owners[i]
+            # is the (index in paths of the) path of move i, and positions[i] its index in the KG's CSR arrays
+            starts = indptr[current[path_ids]]
+            degrees = indptr[current[path_ids] + 1] - starts
+            owners = np.repeat(np.arange(len(paths)), degrees)
+            positions = np.repeat(starts - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+            neighbors = all_neighbors[positions]
+
+            # Filtering out moves to previously visited nodes (except closing a cycle in the last step),
+            # comparing with one visited node (column) at a time
+            move_ids = path_ids[owners]
+            is_valid = np.ones(len(neighbors), dtype=bool)
+            for column in range(step_id + 2):
+                is_valid &= neighbors != visited[:, column][move_ids]
+            if is_last_step:
+                is_valid |= neighbors == closing[move_ids]
+
+            # Picking one of the valid moves of each path uniformly at random (paths without one die)
+            valid_counts = np.bincount(owners[is_valid], minlength=len(paths))
+            alive = valid_counts > 0
+            picks = (rng.random(len(paths)) * valid_counts).astype(np.int64)
+            valid_positions = np.flatnonzero(is_valid)
+            first_valid = np.searchsorted(owners[valid_positions], np.arange(len(paths)))
+            chosen = valid_positions[first_valid[alive] + picks[alive]]
+
+            alive_ids = path_ids[alive]
+            moves[alive_ids, step_id] = positions[chosen]
+            forward[alive_ids, step_id] = is_forward
+            current[alive_ids] = neighbors[chosen]
+            visited[alive_ids, step_id + 2] = neighbors[chosen]
+            survived[paths[alive]] = True
+        rows = rows[survived]
+
+    # 4) Decoding the surviving paths into BottomRule objects
+    bottom_rules = []
+    is_cyclical = (current[rows] == head_ids[rows, 0]) | (current[rows] == head_ids[rows, 1])
+    if n == 1:
+        is_cyclical[:] = False
+    if cyclic_only:
+        rows, is_cyclical = rows[is_cyclical], is_cyclical[is_cyclical]
+    id2ent, id2rel = kg.id2ent, kg.id2rel
+    for row, cyclical in zip(rows.tolist(), is_cyclical.tolist()):
+        bottom_rule = BottomRule(kg.get_triple(heads[row]), 'subject' if from_subject[row] else 'object')
+        current_node = bottom_rule.visited[0] if from_subject[row] else bottom_rule.visited[1]
+        for move, step_forward in zip(moves[row].tolist(), forward[row].tolist()):
+            if step_forward:
+                next_node = id2ent[kg.out_neighbors[move]]
+                bottom_rule.add_triple(Triple(current_node, id2rel[kg.out_relations[move]], next_node), 'forward')
+            else:
+                next_node = id2ent[kg.in_neighbors[move]]
+                bottom_rule.add_triple(Triple(next_node, id2rel[kg.in_relations[move]], current_node), 'backward')
+            bottom_rule.visited.append(next_node)
+            current_node = next_node
+        bottom_rule.is_cyclical = cyclical
+        bottom_rules.append(bottom_rule)
+    return bottom_rules
@@ -1,10 +1,10 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, InitVar
 from typing import List, Tuple, Dict, Any, Optional
 import random
 from ..knowledge_graph import Triple, KnowledgeGraph
 from ..path_sampling import BottomRule
 
-@dataclass
+@dataclass(slots=True)
 class GeneralizedRule:
     bottom_rule: BottomRule
     rule_type: str  # "AC1", "AC2", or "C"
@@ -20,7 +20,11 @@ class GeneralizedRule:
     # (Approximate) Confidence score
     confidence: Optional[float] = None
 
-    def __post_init__(self):
+    # The generalization parts shared by all rules of the bottom rule (see `_base_generalization`),
+    # computed here if not given
+    base_generalization: InitVar[Optional[Tuple[List[str], Dict[str, str], List[Triple]]]] = None
+
+    def __post_init__(self, base_generalization):
         if self.bottom_rule is None:
             self.node_mappings = {}
             self.generalized_head = None
@@ -36,28 +40,10 @@ class GeneralizedRule:
         if self.rule_type != "AC1" and self.AC1_rule_variant is not None:
             raise ValueError("AC1_rule_variant should only be specified for C rules")
         
-        flattened_nodes = self.bottom_rule.get_flattened_nodes()
-        
-        self.node_mappings = dict.fromkeys(flattened_nodes)
-        self.node_mappings[flattened_nodes[0]] = "Y"
-        self.node_mappings[flattened_nodes[1]] = "X"
-
-        # First two nodes are mapped to "Y" and "X"
-        # Rest of the nodes are numbered with A{n+1}, i.e., starting from A2
-        A_index = 2
-        for unique_node_index, node in enumerate(self.node_mappings):
-            if unique_node_index == 0:
-                self.node_mappings[node] = "Y"
-            elif unique_node_index == 1:
-                self.node_mappings[node] = "X"
-            else:
-                ### Took this part out as it is nicely handled in the next step anyways
-                # if self.bottom_rule.is_cyclical and len(self.node_mappings) == unique_node_index + 1:
-                #     continue
-                # else:
-                while f"A{A_index}" in self.node_mappings.values():
-                    A_index += 1
-                self.node_mappings[node] = f"A{A_index}"
+        if base_generalization is None:
+            base_generalization = _base_generalization(self.bottom_rule)
+        flattened_nodes, base_mappings, base_body = base_generalization
+        self.node_mappings = dict(base_mappings)
 
         # Now, further adjusting the dictionary based on the rule type
         if self.rule_type == "C":
@@ -87,13 +73,17 @@ class GeneralizedRule:
             self.bottom_rule.head.relation,
             self.node_mappings[self.bottom_rule.head.object]
         )
+        # Only the body triples of the nodes that became constants differ from the shared base body
+        constant_nodes = {node for node in (flattened_nodes[0], flattened_nodes[1], flattened_nodes[-1])
+                          if self.node_mappings[node] != base_mappings[node]}
         self.generalized_body = [
             Triple(
                 self.node_mappings[triple.subject],
                 triple.relation,
                 self.node_mappings[triple.object]
             )
-            for triple in self.bottom_rule.body
+            if triple.subject in constant_nodes or triple.object in constant_nodes else base_triple
+            for triple, base_triple in zip(self.bottom_rule.body, base_body)
         ]
 
     def __str__(self) -> str:
@@ -124,6 +114,30 @@ class GeneralizedRule:
         
         return f"{head_str} <- {body_str}"
 
+def _base_generalization(bottom_rule: BottomRule) -> Tuple[List[str], Dict[str, str], List[Triple]]:
+    """
+    Return the parts of the generalization that all rules of a BottomRule share: its flattened nodes,
+    the mapping of its nodes to variables (without any constants), and the body generalized with that mapping.
+    """
+    flattened_nodes = bottom_rule.get_flattened_nodes()
+
+    # The unique nodes (in order) are mapped to "Y" and "X" (the first two),
+    # and the rest are numbered by their position with A{i}, i.e., starting from A2
+    node_mappings = {
+        node: ("Y", "X")[index] if index < 2 else f"A{index}"
+        for index, node in enumerate(dict.fromkeys(flattened_nodes))
+    }
+    body = [
+        Triple(
+            node_mappings[triple.subject],
+            triple.relation,
+            node_mappings[triple.object]
+        )
+        for triple in bottom_rule.body
+    ]
+    return flattened_nodes, node_mappings, body
+
+
 def generalize_bottom_rule(bottom_rule: BottomRule) -> List[GeneralizedRule]:
     """
     From a single BottomRule instance, generate the possible rules:
@@ -133,16 +147,17 @@ def generalize_bottom_rule(bottom_rule: BottomRule) -> List[GeneralizedRule]:
     if bottom_rule is None:
         return []
 
+    base_generalization = _base_generalization(bottom_rule)
     if bottom_rule.is_cyclical:
         # 3 rules: C, AC1 with Y as constant, and AC1 with X as constant.
         return [
-            GeneralizedRule(bottom_rule, "AC1", "Y_as_constant"),
-            GeneralizedRule(bottom_rule, "AC1", "X_as_constant"),
-            GeneralizedRule(bottom_rule, "C")
+            GeneralizedRule(bottom_rule, "AC1", "Y_as_constant", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule, "AC1", "X_as_constant", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule, "C", base_generalization=base_generalization)
         ]
     else:
         # 2 rules: AC1 and AC2
         return [
-            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC1"),
-            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC2")
+            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC1", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC2", base_generalization=base_generalization)
         ]
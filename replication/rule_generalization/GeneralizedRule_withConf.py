@@ -1,11 +1,22 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, InitVar
 from typing import List, Tuple, Dict, Set, Any, Optional
+import math
+import re
 import random
+import weakref
 from ..knowledge_graph import Triple, KnowledgeGraph
 from ..path_sampling import BottomRule
 
+# With a minimum confidence, the confidence bound is checked after every this many sampling attempts
+# (see `calculate_confidences_batch`)
+CONFIDENCE_CHECK_INTERVAL = 32
 
-@dataclass
+# The variables of a generalized rule: the head variables X and Y, and the auxiliary variables A2, A3, ...
+# Every other term is a constant (an entity), even if its name happens to start with an "A"
+VARIABLE_PATTERN = re.compile(r"X|Y|A\d+")
+
+
+@dataclass(slots=True)
 class GeneralizedRule:
     bottom_rule: BottomRule
     rule_type: str  # "AC1", "AC2", or "C"
@@ -23,7 +34,18 @@ class GeneralizedRule:
     body_groundings_count: int = field(init=False, default=0)
     head_groundings_count: int = field(init=False, default=0)
 
-    def __post_init__(self):
+    # Cached canonical string of the rule (see `to_logical_string`)
+    _canonical: Optional[str] = field(init=False, default=None, repr=False, compare=False)
+
+    # Integer-encoded head and body for a given KG, which is referenced weakly (see `encode`)
+    _encoded: Optional[Tuple[weakref.ref, Tuple[Any, int, Any], List[Tuple[Any, int, Any]]]] = field(
+        init=False, default=None, repr=False, compare=False)
+
+    # The generalization parts shared by all rules of the bottom rule (see `_base_generalization`),
+    # computed here if not given
+    base_generalization: InitVar[Optional[Tuple[List[str], Dict[str, str], List[Triple]]]] = None
+
+    def __post_init__(self, base_generalization):
         if self.bottom_rule is None:
             self.node_mappings = {}
             self.generalized_head = None
@@ -39,28 +61,10 @@ class GeneralizedRule:
         if self.rule_type != "AC1" and self.AC1_rule_variant is not None:
             raise ValueError("AC1_rule_variant should only be specified for C rules")
         
-        flattened_nodes = self.bottom_rule.get_flattened_nodes()
-        
-        self.node_mappings = dict.fromkeys(flattened_nodes)
-        self.node_mappings[flattened_nodes[0]] = "Y"
-        self.node_mappings[flattened_nodes[1]] = "X"
-
-        # First two nodes are mapped to "Y" and "X"
-        # Rest of the nodes are numbered with A{n+1}, i.e., starting from A2
-        A_index = 2
-        for unique_node_index, node in enumerate(self.node_mappings):
-            if unique_node_index == 0:
-                self.node_mappings[node] = "Y"
-            elif unique_node_index == 1:
-                self.node_mappings[node] = "X"
-            else:
-                ### Took this part out as it is nicely handled in the next step anyways
-                # if self.bottom_rule.is_cyclical and len(self.node_mappings) == unique_node_index + 1:
-                #     continue
-                # else:
-                while f"A{A_index}" in self.node_mappings.values():
-                    A_index += 1
-                self.node_mappings[node] = f"A{A_index}"
+        if base_generalization is None:
+            base_generalization = _base_generalization(self.bottom_rule)
+        flattened_nodes, base_mappings, base_body = base_generalization
+        self.node_mappings = dict(base_mappings)
 
         # Now, further adjusting the dictionary based on the rule type
         if self.rule_type == "C":
@@ -90,52 +94,74 @@ class GeneralizedRule:
             self.bottom_rule.head.relation,
             self.node_mappings[self.bottom_rule.head.object]
         )
+        # Only the body triples of the nodes that became constants differ from the shared base body
+        constant_nodes = {node for node in (flattened_nodes[0], flattened_nodes[1], flattened_nodes[-1])
+                          if self.node_mappings[node] != base_mappings[node]}
         self.generalized_body = [
             Triple(
                 self.node_mappings[triple.subject],
                 triple.relation,
                 self.node_mappings[triple.object]
             )
-            for triple in self.bottom_rule.body
+            if triple.subject in constant_nodes or triple.object in constant_nodes else base_triple
+            for triple, base_triple in zip(self.bottom_rule.body, base_body)
         ]
 
-    def calculate_confidence(self, kg: KnowledgeGraph, sample_size: int = 500, pc: float = 1.0) -> float:
+    def __getstate__(self):
+        # The weak reference of the encoding cannot be pickled (e.g., when sending rules between processes),
+        # so the encoding is dropped and redone on first use
+        state = {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+        state["_encoded"] = None
+        return None, state
+
+    def encode(self, kg: KnowledgeGraph) -> Tuple[Tuple[Any, int, Any], List[Tuple[Any, int, Any]]]:
+        """
+        Translate the generalized head and body into the integer IDs of the KG.
+        Relations and constants are mapped through kg.rel2id / kg.ent2id (-1 if unknown),
+        while the variables ("X", "Y", "A2", ...) are kept as they are.
+        The result is cached on the rule, so the translation only happens once per KG.
+        """
+        # Comparing the KG itself (not its id(), which can be reused by a new KG after garbage collection)
+        if self._encoded is None or self._encoded[0]() is not kg:
+            def encode_term(term):
+                return kg.ent2id.get(term, -1) if self._is_constant(str(term)) else term
+
+            def encode_triple(triple: Triple) -> Tuple[Any, int, Any]:
+                return (
+                    encode_term(triple.subject),
+                    kg.rel2id.get(triple.relation, -1),
+                    encode_term(triple.object)
+                )
+
+            self._encoded = (
+                weakref.ref(kg),
+                encode_triple(self.generalized_head),
+                [encode_triple(triple) for triple in self.generalized_body]
+            )
+        return self._encoded[1], self._encoded[2]
+
+    def calculate_confidence(self, kg: KnowledgeGraph, sample_size: int = 500, pc: float = 1.0,
+                             min_conf: Optional[float] = None) -> float:
         """
         Calculate approximate confidence based on sampling.
         
         :param kg: Knowledge Graph to sample from
         :param sample_size: Number of body groundings to sample
         :param pc: Pessimistic constant for confidence smoothing (Laplace-like)
+        :param min_conf: If given, the sampling stops early once the confidence clearly can't reach it
+                         (see `calculate_confidences_batch`)
         :return: Confidence score between 0 and 1
         """
-        # Reset counters
-        self.body_groundings_count = 0
-        self.head_groundings_count = 0
-        
-        # Get the variables that need to be bound
-        variable_bindings = self._get_variable_bindings()
-        
-        # Sampling body groundings
-        for _ in range(sample_size):
-            # Try to find a valid body grounding
-            grounding = self._sample_body_grounding(kg, variable_bindings)
-            if not grounding:
-                continue
-                
-            self.body_groundings_count += 1
-            
-            # Check if this grounding makes the head true
-            if self._check_head_grounding(kg, grounding):
-                self.head_groundings_count += 1
-        
-        # Calculate confidence with smoothing
-        if self.body_groundings_count > 0:
-            self.confidence = (self.head_groundings_count + pc) / (self.body_groundings_count + pc)
-        else:
-            self.confidence = 0.0
-            
+        calculate_confidences_batch([self], kg, sample_size=sample_size, pc=pc, min_conf=min_conf)
         return self.confidence
 
+    def body_signature(self) -> Tuple[Triple, ...]:
+        """
+        The generalized body of the rule.
+        Rules with the same signature have the same body groundings (see `calculate_confidences_batch`).
+        """
+        return tuple(self.generalized_body)
+
     def _get_variable_bindings(self) -> Set[str]:
         """
         Get all variables that need to be bound when sampling.
@@ -148,40 +174,38 @@ class GeneralizedRule:
             subj_str = str(triple.subject)
             obj_str = str(triple.object)
             
-            if not subj_str.startswith('A') and not self._is_constant(subj_str):
+            if not self._is_constant(subj_str):
                 variables.add(subj_str)
-            if not obj_str.startswith('A') and not self._is_constant(obj_str):
+            if not self._is_constant(obj_str):
                 variables.add(obj_str)
                 
         # Add auxiliary variables (A2, A3, etc.)
-        aux_vars = {str(v) for v in self.node_mappings.values() if str(v).startswith('A')}
+        aux_vars = {str(v) for v in self.node_mappings.values() if not self._is_constant(str(v))}
         variables.update(aux_vars)
         
         return variables
 
     def _is_constant(self, value: str) -> bool:
         """Check if a value is a constant (not a variable)."""
-        return not (value.startswith('A') or value in {'X', 'Y'})
+        return VARIABLE_PATTERN.fullmatch(value) is None
 
-    def _sample_body_grounding(self, kg: KnowledgeGraph, variables: Set[str]) -> Optional[Dict[str, Any]]:
+    def _sample_body_grounding(self, kg: KnowledgeGraph, encoded_body: List[Tuple[Any, int, Any]],
+                               variables: Set[str]) -> Optional[Dict[Any, int]]:
         """
-        Try to sample a valid grounding for the body.
+        Try to sample a valid grounding for the (integer-encoded) body.
         Returns None if no valid grounding could be found.
         """
+        # The constants (these are already entity IDs) are the same in every attempt
+        constants = {term: term for subj, _, obj in encoded_body for term in (subj, obj) if isinstance(term, int)}
+
         max_attempts = 50  # Prevent infinite loops
         for _ in range(max_attempts):
-            grounding = {}
-            
             # First bind any constants
-            for triple in self.generalized_body:
-                if self._is_constant(str(triple.subject)):
-                    grounding[str(triple.subject)] = triple.subject
-                if self._is_constant(str(triple.object)):
-                    grounding[str(triple.object)] = triple.object
+            grounding = dict(constants)
             
             # Try to bind all required variables
             success = True
-            for triple in self.generalized_body:
+            for triple in encoded_body:
                 if not self._bind_triple_variables(kg, triple, grounding):
                     success = False
                     break
@@ -191,60 +215,57 @@ class GeneralizedRule:
                 
         return None
 
-    def _bind_triple_variables(self, kg: KnowledgeGraph, triple: Triple, grounding: Dict[str, Any]) -> bool:
+    def _bind_triple_variables(self, kg: KnowledgeGraph, triple: Tuple[Any, int, Any], grounding: Dict[Any, int]) -> bool:
         """
-        Try to bind variables for a single triple in the body.
+        Try to bind variables for a single (integer-encoded) triple in the body.
         Returns False if no valid binding could be found.
         """
-        subj_key = str(triple.subject)
-        obj_key = str(triple.object)
+        subj_key, relation, obj_key = triple
         
         # Case 1: Both subject and object are already bound
         if subj_key in grounding and obj_key in grounding:
-            return kg.has_fact(grounding[subj_key], triple.relation, grounding[obj_key])
+            return kg.has_fact_ids(grounding[subj_key], relation, grounding[obj_key])
         
         # Case 2: Subject is bound, object needs binding
         elif subj_key in grounding:
-            possible_objects = kg.adj[triple.relation].get(grounding[subj_key], set())
-            if not possible_objects:
+            possible_objects = kg.neighbors_of(relation, grounding[subj_key])
+            if not len(possible_objects):
                 return False
-            grounding[obj_key] = random.choice(list(possible_objects))
+            grounding[obj_key] = int(possible_objects[random.randrange(len(possible_objects))])
             return True
             
         # Case 3: Object is bound, subject needs binding
         elif obj_key in grounding:
-            possible_subjects = kg.adj_inv[triple.relation].get(grounding[obj_key], set())
-            if not possible_subjects:
+            possible_subjects = kg.inv_neighbors_of(relation, grounding[obj_key])
+            if not len(possible_subjects):
                 return False
-            grounding[subj_key] = random.choice(list(possible_subjects))
+            grounding[subj_key] = int(possible_subjects[random.randrange(len(possible_subjects))])
             return True
             
         # Case 4: Neither is bound
         else:
             # Pick a random subject that has this relation
-            if not kg.adj[triple.relation]:
+            subjects = kg.relation_subjects[relation]
+            if not len(subjects):
                 return False
-            random_subject = random.choice(list(kg.adj[triple.relation].keys()))
+            random_subject = int(subjects[random.randrange(len(subjects))])
             grounding[subj_key] = random_subject
             
             # Then pick a random object for that subject
-            possible_objects = kg.adj[triple.relation][random_subject]
-            if not possible_objects:
+            possible_objects = kg.neighbors_of(relation, random_subject)
+            if not len(possible_objects):
                 return False
-            grounding[obj_key] = random.choice(list(possible_objects))
+            grounding[obj_key] = int(possible_objects[random.randrange(len(possible_objects))])
             return True
 
-    def _check_head_grounding(self, kg: KnowledgeGraph, grounding: Dict[str, Any]) -> bool:
-        """Check if the head triple is true given a grounding."""
-        head_subj_key = str(self.generalized_head.subject)
-        head_obj_key = str(self.generalized_head.object)
-        
-        head_subj = grounding.get(head_subj_key, self.generalized_head.subject)
-        head_obj = grounding.get(head_obj_key, self.generalized_head.object)
-        
-        return kg.has_fact(head_subj, self.generalized_head.relation, head_obj)
-
     def to_logical_string(self) -> str:
+        """
+        Canonical string of the rule, used as its key for duplicate detection.
+        Computed once and cached, since the rule does not change after construction.
+        """
+        if self._canonical is not None:
+            return self._canonical
+
         # Head
         head_triple = self.bottom_rule.head
         head_str = f"{head_triple.relation}({self.node_mappings[head_triple.subject]}, {self.node_mappings[head_triple.object]})"
@@ -256,9 +277,10 @@ class GeneralizedRule:
             body_parts.append(part)
 
         if body_parts:
-            return f"{head_str} <- {', '.join(body_parts)}"
+            self._canonical = f"{head_str} <- {', '.join(body_parts)}"
         else:
-            return head_str
+            self._canonical = head_str
+        return self._canonical
 
     def __str__(self) -> str:
         if self.bottom_rule is None:
@@ -288,6 +310,109 @@ class GeneralizedRule:
         
         return f"{head_str} <- {body_str}"
 
+def calculate_confidences_batch(rules: List[GeneralizedRule], kg: KnowledgeGraph,
+                                sample_size: int = 500, pc: float = 1.0,
+                                min_conf: Optional[float] = None) -> None:
+    """
+    Calculate the approximate confidence of rules sharing the same body (i.e., the same `body_signature`),
+    e.g., AC2 rules that only differ in the constant of their head.
+    The body groundings are sampled once, and the heads they predict are checked for each rule in batches.
+    
+    :param rules: Rules with the same body signature
+    :param kg: Knowledge Graph to sample from
+    :param sample_size: Number of body groundings to sample
+    :param pc: Pessimistic constant for confidence smoothing (Laplace-like)
+    :param min_conf: If given, the confidence bound is checked every CONFIDENCE_CHECK_INTERVAL attempts, and
+                     the sampling stops early once the upper bound of every rule's confidence is below min_conf
+                     (see `confidence_upper_bound`). The confidences are then based on the groundings so far.
+    """
+    # The body (and so the variables that need to be bound) is the same for all the rules,
+    # working on the integer-encoded rules
+    sampler = rules[0]
+    variable_bindings = sampler._get_variable_bindings()
+    _, encoded_body = sampler.encode(kg)
+    encoded_heads = [rule.encode(kg)[0] for rule in rules]
+
+    for rule in rules:
+        rule.body_groundings_count = 0
+        rule.head_groundings_count = 0
+
+    check_interval = CONFIDENCE_CHECK_INTERVAL if min_conf is not None else max(sample_size, 1)
+    for start in range(0, sample_size, check_interval):
+        # Sampling body groundings
+        groundings = []
+        for _ in range(min(check_interval, sample_size - start)):
+            # Try to find a valid body grounding
+            grounding = sampler._sample_body_grounding(kg, encoded_body, variable_bindings)
+            if grounding:
+                groundings.append(grounding)
+
+        for rule, (head_subj_key, head_relation, head_obj_key) in zip(rules, encoded_heads):
+            rule.body_groundings_count += len(groundings)
+
+            # Collecting the heads the groundings predict (a head variable left unbound can't be true)
+            head_subjects = []
+            head_objects = []
+            for grounding in groundings:
+                head_subj = grounding.get(head_subj_key, head_subj_key)
+                head_obj = grounding.get(head_obj_key, head_obj_key)
+                if not isinstance(head_subj, str) and not isinstance(head_obj, str):
+                    head_subjects.append(head_subj)
+                    head_objects.append(head_obj)
+
+            # Checking which groundings make the head true, in one batch
+            if head_subjects:
+                rule.head_groundings_count += int(kg.has_facts_ids(head_subjects, head_relation, head_objects).sum())
+
+        # Stopping early if none of the rules can reach the minimum confidence
+        if min_conf is not None and all(
+                confidence_upper_bound(rule.head_groundings_count, rule.body_groundings_count, pc) < min_conf
+                for rule in rules):
+            break
+
+    # Calculate confidence with smoothing
+    for rule in rules:
+        if rule.body_groundings_count > 0:
+            rule.confidence = (rule.head_groundings_count + pc) / (rule.body_groundings_count + pc)
+        else:
+            rule.confidence = 0.0
+
+
+def confidence_upper_bound(head_count: int, body_count: int, pc: float = 1.0, z: float = 1.96) -> float:
+    """
+    Upper bound (normal approximation, 95% by default) of a confidence estimated from body_count sampled
+    body groundings, of which head_count made the head true. 1.0 if no body grounding was found yet.
+    """
+    if body_count == 0:
+        return 1.0
+    p_hat = (head_count + pc) / (body_count + pc)
+    return p_hat + z * math.sqrt(p_hat * max(0.0, 1.0 - p_hat) / body_count)
+
+
+def _base_generalization(bottom_rule: BottomRule) -> Tuple[List[str], Dict[str, str], List[Triple]]:
+    """
+    Return the parts of the generalization that all rules of a BottomRule share: its flattened nodes,
+    the mapping of its nodes to variables (without any constants), and the body generalized with that mapping.
+    """
+    flattened_nodes = bottom_rule.get_flattened_nodes()
+
+    # The unique nodes (in order) are mapped to "Y" and "X" (the first two),
+    # and the rest are numbered by their position with A{i}, i.e., starting from A2
+    node_mappings = {
+        node: ("Y", "X")[index] if index < 2 else f"A{index}"
+        for index, node in enumerate(dict.fromkeys(flattened_nodes))
+    }
+    body = [
+        Triple(
+            node_mappings[triple.subject],
+            triple.relation,
+            node_mappings[triple.object]
+        )
+        for triple in bottom_rule.body
+    ]
+    return flattened_nodes, node_mappings, body
+
+
 def generalize_bottom_rule(bottom_rule: BottomRule) -> List[GeneralizedRule]:
     """
     From a single BottomRule instance, generate the possible rules:
@@ -298,16 +423,17 @@ def generalize_bottom_rule(bottom_rule: BottomRule) -> List[GeneralizedRule]:
         print("BottomRule is None")
         return []
 
+    base_generalization = _base_generalization(bottom_rule)
     if bottom_rule.is_cyclical:
         # 3 rules: C, AC1 with Y as constant, and AC1 with X as constant.
         return [
-            GeneralizedRule(bottom_rule, "AC1", "Y_as_constant"),
-            GeneralizedRule(bottom_rule, "AC1", "X_as_constant"),
-            GeneralizedRule(bottom_rule, "C")
+            GeneralizedRule(bottom_rule, "AC1", "Y_as_constant", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule, "AC1", "X_as_constant", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule, "C", base_generalization=base_generalization)
         ]
     else:
         # 2 rules: AC1 and AC2
         return [
-            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC1"),
-            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC2")
+            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC1", base_generalization=base_generalization),
+            GeneralizedRule(bottom_rule=bottom_rule, rule_type="AC2", base_generalization=base_generalization)
         ]
@@ -2,10 +2,30 @@ import os
 import time
 import json
 import pickle
+import random
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from typing import Callable, Dict, List, Optional
 from .knowledge_graph import KnowledgeGraph
-from .path_sampling import sample_bottom_rule
-from .rule_generalization import generalize_bottom_rule, GeneralizedRule
+from .path_sampling import sample_bottom_rules_batch
+from .rule_generalization import generalize_bottom_rule, calculate_confidences_batch, GeneralizedRule
+
+# Bottom rules are sampled in batches of this size (see `sample_bottom_rules_batch`)
+SAMPLE_BATCH_SIZE = 256
+
+# Buffer size (in bytes) of the session log file
+LOG_BUFFER_SIZE = 1 << 20
+
+# The KG of a worker process (see `_init_worker`)
+_worker_kg: Optional[KnowledgeGraph] = None
+
+
+def default_quality_function(rule: GeneralizedRule) -> bool:
+    """
+    The default quality criterion: the rule has to make at least two correct predictions.
+    """
+    return rule.head_groundings_count >= 2
+
 
 def AnyBURL(
     kg: KnowledgeGraph,
@@ -20,7 +40,9 @@ def AnyBURL(
     # only those rules that generate at least two correct predictions, 
     # which is a very lax criteria."
     # I defined this default quality function below
-    dataset_name: Optional[str] = None
+    dataset_name: Optional[str] = None,
+    num_workers: int = 1,
+    min_conf: Optional[float] = None
 ) -> Dict[str, GeneralizedRule]:
     """
     Anytime Bottom-up Rule Learning implementation that follows "Algorithm 1" in Meilicke et al. (2019). 
@@ -36,6 +58,11 @@ def AnyBURL(
       - pc: The pessimistic constant used for Laplace smoothing in the confidence calculation.
       - max_total_time: Total time (in seconds) to run the learning process.
       - alternate_cyclic_sampling: When True and n==3, alternate between sampling only cyclic paths and all paths.
+      - num_workers: Number of processes sampling in parallel during each time span (1 = no extra processes).
+                     With more than one, the quality function has to be picklable (i.e., a module-level function).
+      - min_conf: Optional minimum confidence. If given, the confidence sampling of a rule stops early once its
+                  confidence clearly can't reach it (see `calculate_confidences_batch`). Rules below it are still
+                  judged by the quality function, on the groundings sampled so far.
     
     Returns:
       A dictionary of learned rules (keyed by their canonical string) mapping to GeneralizedRule objects.
@@ -50,79 +77,134 @@ def AnyBURL(
         session_filename = f"rules_session_{dataset_name}.txt"
     session_filepath = os.path.join("rules", session_filename)
     
-    with open(session_filepath, "a", encoding="utf-8") as fout:
-        if dataset_name is None:
-            fout.write(f"# New training session started at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-        else:
-            fout.write(f"# New training session for dataset {dataset_name} started at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
-
     # Setting the default quality function:
     if quality_function is None:
-        def quality_fn(rule: GeneralizedRule) -> bool:
-            return rule.head_groundings_count >= 2
-        quality_function = quality_fn
+        quality_function = default_quality_function
 
     # Starting with path length = 2 (head triple + one body triple)
     n = 2
     # Dictionary to store all learned rules (for duplicate filtering)
     global_rules: Dict[str, GeneralizedRule] = {}
     
-    iteration = 0
-    total_start = time.time()
-    while time.time() - total_start < max_total_time:
-        iteration += 1
-
-        # Alternating between cyclic and all sampling
-        # Authors mention that it is difficult to find cyclics after n==3
-        # and they say they turn this off after n==3
-        if n == 3 and alternate_cyclic_sampling and iteration % 2 == 1:
-            sample_mode = "cyclic"
+    # The session log and the worker processes (each gets its own copy of the KG once) are kept for the whole run,
+    # in a context that closes and shuts them down however the learning ends (e.g., when a worker raises,
+    # or on a KeyboardInterrupt)
+    with ExitStack() as stack:
+        # The session log is kept open (and buffered), instead of being reopened every iteration
+        fout = stack.enter_context(open(session_filepath, "a", encoding="utf-8", buffering=LOG_BUFFER_SIZE))
+        if dataset_name is None:
+            fout.write(f"# New training session started at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
         else:
-            sample_mode = "all"
+            fout.write(f"# New training session for dataset {dataset_name} started at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
 
-        R_s: Dict[str, GeneralizedRule] = {}  # Rules discovered during this time span
-        span_start = time.time()
+        executor = None
+        if num_workers > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(kg,)))
 
-        # Sampling bottom rules for the duration of the time span
-        while time.time() - span_start < ts:
-            bottom_rule = sample_bottom_rule(kg, n, direction_allowed="both") ### p ###
-            if bottom_rule is None:
-                continue
+        iteration = 0
+        # Only differences of the clock matter, so a monotonic one is used (immune to wall-clock adjustments)
+        total_start = time.monotonic()
+        while time.monotonic() - total_start < max_total_time:
+            iteration += 1
 
-            # If in cyclic-only mode, we skip the acyclic bottom rules we find
-            if sample_mode == "cyclic" and not bottom_rule.is_cyclical:
-                continue
+            # Alternating between cyclic and all sampling
+            # Authors mention that it is difficult to find cyclics after n==3
+            # and they say they turn this off after n==3
+            if n == 3 and alternate_cyclic_sampling and iteration % 2 == 1:
+                sample_mode = "cyclic"
+            else:
+                sample_mode = "all"
 
-            # Generating generalized rules from the bottom rule we sampled
-            generalized_rules = generalize_bottom_rule(bottom_rule) ### R_p ###
+            # Rules discovered during this time span
+            if executor is None:
+                R_s = sample_rules(kg, n, sample_mode, ts, sample_size, pc, quality_function, min_conf)
+            else:
+                # Every worker samples for the whole time span (with its own random seed),
+                # equal rules found by several workers are merged by their canonical string
+                futures = [
+                    executor.submit(_sample_rules_in_worker, n, sample_mode, ts, sample_size, pc, quality_function,
+                                    min_conf, random.getrandbits(64))
+                    for _ in range(num_workers)
+                ]
+                R_s = {}
+                for future in futures:
+                    R_s.update(future.result())
 
-            # Calculating the confidence of each of these generalized rules
-            for rule in generalized_rules:
-                rule.calculate_confidence(kg, sample_size=sample_size, pc=pc)
+            # Checking saturation (the fraction of new rules that were already seen)
+            saturation = 0.0
+            if R_s:
+                # Counting directly against the global dictionary (O(1) membership), without building sets
+                common = sum(1 for rule_str in R_s if rule_str in global_rules)
+                saturation = common / len(R_s)
+                # Increase path length if saturation is above the threshold
+                if saturation > sat:
+                    n += 1  
 
-                if quality_function(rule):
-                    canonical_str = rule.to_logical_string()  # for duplicate detection
-                    R_s[canonical_str] = rule
-
-        # Checking saturation (the fraction of new rules that were already seen)
-        saturation = 0.0
-        if R_s:
-            common = set(R_s.keys()).intersection(set(global_rules.keys()))
-            saturation = len(common) / len(R_s)
-            # Increase path length if saturation is above the threshold
-            if saturation > sat:
-                n += 1  
-
-        global_rules.update(R_s)
-        print(f"Iteration {iteration}: n = {n}, new rules = {len(R_s)}, saturation = {saturation:.2f}, "
-              f"total rules learned = {len(global_rules)}")
+            global_rules.update(R_s)
+            print(f"Iteration {iteration}: n = {n}, new rules = {len(R_s)}, saturation = {saturation:.2f}, "
+                  f"total rules learned = {len(global_rules)}")
         
-        # ----------------------------------------------------
-        with open(session_filepath, "a", encoding="utf-8") as fout:
+            # Writing all rules of the iteration at once (flushing, so the log stays current during long runs)
             fout.write(f"\n# Iteration {iteration}: n = {n}, new rules = {len(R_s)}, "
                        f"saturation = {saturation:.4f}, total rules learned = {len(global_rules)}\n")
-            for rule_str in R_s.keys():
-                fout.write(rule_str + "\n")
-        # ----------------------------------------------------
+            fout.write("".join(rule_str + "\n" for rule_str in R_s))
+            fout.flush()
 
     return global_rules
+
+
+def sample_rules(
+    kg: KnowledgeGraph,
+    n: int,
+    sample_mode: str,
+    ts: float,
+    sample_size: int,
+    pc: float,
+    quality_function: Callable[[GeneralizedRule], bool],
+    min_conf: Optional[float] = None
+) -> Dict[str, GeneralizedRule]:
+    """
+    Sampling bottom rules of length n for one time span of ts seconds, and collecting the generalized rules
+    of sufficient quality (keyed by their canonical string). In "cyclic" mode, only cyclic bottom rules are used.
+    """
+    R_s: Dict[str, GeneralizedRule] = {}
+    span_start = time.monotonic()
+
+    # Sampling bottom rules for the duration of the time span
+    while time.monotonic() - span_start < ts:
+        # The paths are sampled in batches (failed samples are dropped by the sampler),
+        # if in cyclic-only mode, the acyclic bottom rules we find are skipped as well
+        bottom_rules = sample_bottom_rules_batch(kg, n, SAMPLE_BATCH_SIZE, direction_allowed="both",
+                                                 cyclic_only=(sample_mode == "cyclic")) ### p ###
+
+        # Generating generalized rules from the bottom rules we sampled, grouped by their body
+        # (since rules with the same body can share their body groundings) and by their canonical string
+        # (since equal rules found in the same batch only need to be evaluated once)
+        rules_by_body: Dict[tuple, Dict[str, GeneralizedRule]] = {}
+        for bottom_rule in bottom_rules:
+            for rule in generalize_bottom_rule(bottom_rule): ### R_p ###
+                rules_by_body.setdefault(rule.body_signature(), {}).setdefault(rule.to_logical_string(), rule)
+
+        # Calculating the confidence of each group of generalized rules
+        for rules in rules_by_body.values():
+            calculate_confidences_batch(list(rules.values()), kg, sample_size=sample_size, pc=pc, min_conf=min_conf)
+            for canonical_str, rule in rules.items():
+                if quality_function(rule):
+                    R_s[canonical_str] = rule
+
+            if time.monotonic() - span_start >= ts:
+                break
+
+    return R_s
+
+
+def _init_worker(kg: KnowledgeGraph) -> None:
+    global _worker_kg
+    _worker_kg = kg
+
+
+def _sample_rules_in_worker(n, sample_mode, ts, sample_size, pc, quality_function, min_conf, seed):
+    # Forked workers start from the same random state, so each task is seeded separately
+    random.seed(seed)
+    return sample_rules(_worker_kg, n, sample_mode, ts, sample_size, pc, quality_function, min_conf)
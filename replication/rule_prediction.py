@@ -1,229 +1,553 @@
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, List, Sequence, Set, Tuple, Optional
 from collections import defaultdict
-import heapq
-from .knowledge_graph import KnowledgeGraph, Triple
+from dataclasses import dataclass, field
+from functools import lru_cache
+from operator import attrgetter
+import numpy as np
+from .knowledge_graph import KnowledgeGraph
 from .rule_generalization import GeneralizedRule
 
+# Opcodes of the compiled body triples (see `CompiledRule`)
+CHECK = 0            # both slots bound: keeping the groundings whose triple is in the KG
+EXPAND_OBJECTS = 1   # subject slot bound: binding the object slot to each object of the subject
+EXPAND_SUBJECTS = 2  # object slot bound: binding the subject slot to each subject of the object
+FAIL = 3             # neither slot bound: no grounding can be completed
+
+_NO_PREDICTIONS = np.zeros(0, dtype=np.int32)
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    """
+    A rule compiled for grounding over the integer KG (see `RulePrediction._compile_rule`).
+    Every distinct term of the encoded rule gets a slot in the grounding rows (head terms first), and each
+    body triple becomes an (opcode, relation_id, subject_slot, object_slot) row of an int32 program.
+    Since the opcodes depend on which head term the query binds, there is one program per query direction.
+    """
+    num_slots: int
+    # Slots of the head subject and the head object
+    head_slots: Tuple[int, int]
+    # Entity IDs of the head subject and object if they are constants (-1 if not in the KG), None for variables
+    head_constants: Tuple[Optional[int], Optional[int]]
+    # Programs for queries binding the head subject (predicting tails) and the head object (predicting heads)
+    tail_program: np.ndarray
+    head_program: np.ndarray
+
+
+@dataclass
+class BodyPrefixNode:
+    """
+    A node of a body-prefix trie: the path from the root is a sequence of compiled body triples,
+    and the rules whose program is exactly this sequence are stored here by their predicted head term.
+    """
+    children: Dict[Tuple[int, int, int, int], "BodyPrefixNode"] = field(default_factory=dict)
+    # (id(rule), predicted_slot, predicted_constant) of the rules ending at this node
+    projections: List[Tuple[int, int, Optional[int]]] = field(default_factory=list)
+    # Number of grounding slots needed by the rules in the subtree (only maintained for the roots)
+    num_slots: int = 0
+    # The slots that are still needed in this subtree, if some of the bound ones are not (see `_mark_live_slots`)
+    live_slots: Optional[Tuple[int, ...]] = None
+
+
+@dataclass(frozen=True)
+class RulePath:
+    """
+    Where a rule is in the body-prefix tries of a query direction (see `RulePrediction._apply_rule`).
+    """
+    query_slot: int
+    # Entity ID of the constant in the queried head position, None for a variable
+    query_constant: Optional[int]
+    root: BodyPrefixNode
+    # (instruction, node) pairs from the root to the node of the rule
+    steps: Tuple[Tuple[Tuple[int, int, int, int], BodyPrefixNode], ...]
+    predicted_slot: int
+    # Entity ID of the constant in the predicted head position, None for a variable
+    predicted_constant: Optional[int]
+
+
 class RulePrediction:
-    def __init__(self, rules: Dict[str, GeneralizedRule], kg: KnowledgeGraph):
+    # Minimum number of groundings for which a fully bound body triple is checked in one vectorized batch
+    batch_check_threshold = 64
+    # Minimum number of groundings for which groundings that lead to the same predictions are merged
+    merge_threshold = 16
+    # Maximum number of queries whose predictions are memoized per direction
+    query_cache_size = 100_000
+
+    def __init__(self, rules: Dict[str, GeneralizedRule], kg: KnowledgeGraph, confidence_floor: float = 0.0):
         """
         Initializing the prediction engine with learned rules and the knowledge graph.
         
         :param rules: Dictionary of learned rules (from AnyBURL)
         :param kg: Knowledge graph containing training data
+        :param confidence_floor: Rules with a confidence below this are not used for predictions
         """
         self.rules = rules
         self.training_kg = kg
+        self.confidence_floor = confidence_floor
+        applied_rules = [rule for rule in rules.values() if rule.confidence >= confidence_floor]
+        # Compiling every rule once to integer programs for grounding, by id(rule) (see `_compile_rule`)
+        self.compiled_rules = {id(rule): self._compile_rule(rule) for rule in applied_rules}
         
         # Indexing rules by head relation for faster lookup during prediction
-        self.rules_by_relation = defaultdict(list)
-        for rule in rules.values():
+        rules_by_relation = defaultdict(list)
+        for rule in applied_rules:
             # Grouping rules under the key of their head relation
-            self.rules_by_relation[rule.generalized_head.relation].append(rule)
+            rules_by_relation[rule.generalized_head.relation].append(rule)
         
-        # Sorting rules by confidence for each relation in descending order
-        for relation in self.rules_by_relation:
-            self.rules_by_relation[relation].sort(key=lambda x: x.confidence, reverse=True)
+        # Sorting rules by confidence for each relation in descending order (once, so they are kept as tuples)
+        self.rules_by_relation = {
+            relation: tuple(sorted(relation_rules, key=attrgetter("confidence"), reverse=True))
+            for relation, relation_rules in rules_by_relation.items()
+        }
+
+        # Grouping the rules of each relation by their body prefixes (see `_build_prefix_trie`),
+        # once for tail and once for head queries, and keeping the path to each rule by id(rule)
+        self.tail_tries = {}
+        self.head_tries = {}
+        self.tail_paths = {}
+        self.head_paths = {}
+        for relation, relation_rules in self.rules_by_relation.items():
+            self.tail_tries[relation] = self._build_prefix_trie(relation_rules, 0, self.tail_paths)
+            self.head_tries[relation] = self._build_prefix_trie(relation_rules, 1, self.head_paths)
+
+        # The predictions of a query only depend on the (fixed) rules and training KG, so they are memoized
+        # per (entity, relation, k) with an LRU cache, and repeated queries (e.g., across test sets) are free
+        self._tail_queries = lru_cache(maxsize=self.query_cache_size)(self._predict_tail_query)
+        self._head_queries = lru_cache(maxsize=self.query_cache_size)(self._predict_head_query)
 
     def predict_tail(self, subject: str, relation: str, k: int = 10) -> List[Tuple[str, float]]:
         """
         Predicting top-k tail entities for a given (subject, relation) pair.
+        Repeated queries return the memoized list of predictions (which is shared, so it should not be modified).
         
         :param subject: Subject entity
         :param relation: Relation
         :param k: Number of predictions to return
         :return: List of (predicted_object, confidence) tuples, sorted by confidence
         """
-        # Creating a mapping from candidate objects to a list of confidence scores
-        candidates = defaultdict(list)
-        # Retrieving rules that are applicable for the specified relation
-        applicable_rules = self.rules_by_relation[relation]
-        
-        # Iterating over each applicable rule to generate predictions
-        for rule in applicable_rules:
-            # Applying the rule to predict tail entities given the subject
-            predictions = self._apply_rule_tail(rule, subject)
-            for obj, conf in predictions:
-                # Collecting confidence scores for each candidate object
-                candidates[obj].append(conf)
-        
-        # Aggregating confidences using the maximum strategy as described in the paper
-        aggregated = []
-        for obj, confidences in candidates.items():
-            # Sorting confidences in descending order
-            sorted_conf = sorted(confidences, reverse=True)
-            # Creating a tuple of confidences padded with zeros for lexicographic comparison
-            conf_tuple = tuple(sorted_conf + [0] * (k - len(sorted_conf)))
-            aggregated.append((obj, conf_tuple))
-        
-        # Selecting the top-k predictions based on the aggregated confidence tuples
-        top_k = heapq.nlargest(k, aggregated, key=lambda x: x[1])
+        return self._tail_queries(subject, relation, k)
+
+    def _predict_tail_query(self, subject: str, relation: str, k: int) -> List[Tuple[str, float]]:
+        """
+        Predicting the top-k tail entities of a query (see `predict_tail`), without the memoization.
+        """
+        # Translating the query subject to its integer ID (unknown entities can't be grounded),
+        # and returning right away for relations without rules
+        subject_id = self.training_kg.ent2id.get(subject)
+        applicable_rules = self.rules_by_relation.get(relation)
+        if subject_id is None or not applicable_rules:
+            return []
+
+        # Applying the applicable rules to predict tail entities given the subject,
+        # and aggregating their confidences using the maximum strategy as described in the paper
+        top_k = self._predict(self.tail_paths, applicable_rules, subject_id, k)
         
-        # Returning predictions with their highest confidence score
-        return [(obj, conf_tuple[0]) for obj, conf_tuple in top_k]
+        # Returning predictions (translated back to entity names) with their highest confidence score
+        return [(self.training_kg.id2ent[obj], conf) for obj, conf in top_k]
 
     def predict_head(self, relation: str, object: str, k: int = 10) -> List[Tuple[str, float]]:
         """
         Predicting top-k head entities for a given (relation, object) pair.
+        Repeated queries return the memoized list of predictions (which is shared, so it should not be modified).
         
         :param relation: Relation
         :param object: Object entity
         :param k: Number of predictions to return
         :return: List of (predicted_subject, confidence) tuples, sorted by confidence
         """
-        # Creating a mapping from candidate subjects to a list of confidence scores
-        candidates = defaultdict(list)
-        # Retrieving rules that are applicable for the specified relation
-        applicable_rules = self.rules_by_relation[relation]
-        
-        # Iterating over each applicable rule to generate head predictions
-        for rule in applicable_rules:
-            # Applying the rule to predict head entities given the object
-            predictions = self._apply_rule_head(rule, object)
-            for subj, conf in predictions:
-                # Collecting confidence scores for each candidate subject
-                candidates[subj].append(conf)
-        
-        # Aggregating confidences using the maximum strategy
-        aggregated = []
-        for subj, confidences in candidates.items():
-            # Sorting confidences in descending order
-            sorted_conf = sorted(confidences, reverse=True)
-            # Creating a tuple of confidences padded with zeros for lexicographic comparison
-            conf_tuple = tuple(sorted_conf + [0] * (k - len(sorted_conf)))
-            aggregated.append((subj, conf_tuple))
-        
-        # Selecting the top-k predictions based on the aggregated confidence tuples
-        top_k = heapq.nlargest(k, aggregated, key=lambda x: x[1])
-        # Returning predictions with their highest confidence score
-        return [(subj, conf_tuple[0]) for subj, conf_tuple in top_k]
+        return self._head_queries(relation, object, k)
 
-    def _apply_rule_tail(self, rule: GeneralizedRule, subject: str) -> List[Tuple[str, float]]:
+    def _predict_head_query(self, relation: str, object: str, k: int) -> List[Tuple[str, float]]:
         """
-        Applying a rule to predict tail entities for a given subject.
-        
-        :param rule: The generalized rule to be applied.
-        :param subject: The subject entity provided in the query.
-        :return: List of (predicted_tail, confidence) tuples.
+        Predicting the top-k head entities of a query (see `predict_head`), without the memoization.
         """
-        predictions = []
-        grounding = {}
-        
-        # Binding the provided subject to the appropriate variable in the rule head
-        if rule.generalized_head.subject == "Y":
-            grounding["Y"] = subject
-        elif rule.generalized_head.subject == "X":
-            grounding["X"] = subject
-        else:  # Handling a constant in the head subject position
-            if rule.generalized_head.subject != subject:
-                # Returning empty if the constant does not match the query subject
-                return []
-            grounding[subject] = subject
-            
-        # Attempting to complete the grounding using the rule body
-        completed_groundings = self._complete_grounding(rule, grounding)
+        # Translating the query object to its integer ID (unknown entities can't be grounded),
+        # and returning right away for relations without rules
+        object_id = self.training_kg.ent2id.get(object)
+        applicable_rules = self.rules_by_relation.get(relation)
+        if object_id is None or not applicable_rules:
+            return []
+
+        # Applying the applicable rules to predict head entities given the object,
+        # and aggregating their confidences using the maximum strategy
+        top_k = self._predict(self.head_paths, applicable_rules, object_id, k)
+        # Returning predictions (translated back to entity names) with their highest confidence score
+        return [(self.training_kg.id2ent[subj], conf) for subj, conf in top_k]
+
+    def predict_tail_batch(self, subjects: Sequence[str], relations: Sequence[str],
+                           k: int = 10) -> List[List[Tuple[str, float]]]:
+        """
+        Predicting top-k tail entities for many (subject, relation) pairs at once.
+        Repeated pairs are only predicted once (and share their list of predictions), and the pairs are
+        predicted grouped by relation, so the rules of a relation are applied to all of its queries in a row.
         
-        # Extracting predictions from each completed grounding
-        for grounding in completed_groundings:
-            if rule.generalized_head.object == "X":
-                if "X" in grounding:
-                    predictions.append((grounding["X"], rule.confidence))
-            elif rule.generalized_head.object == "Y":
-                if "Y" in grounding:
-                    predictions.append((grounding["Y"], rule.confidence))
-            else:  # Handling a constant in the head object position
-                predictions.append((rule.generalized_head.object, rule.confidence))
-                
-        return predictions
-
-    def _apply_rule_head(self, rule: GeneralizedRule, object: str) -> List[Tuple[str, float]]:
-        """
-        Applying a rule to predict head entities for a given object.
+        :param subjects: Subject entity of each query
+        :param relations: Relation of each query
+        :param k: Number of predictions to return per query
+        :return: For each query, the list of (predicted_object, confidence) tuples, sorted by confidence
+        """
+        queries = list(zip(subjects, relations))
+        unique_queries = sorted(dict.fromkeys(queries), key=lambda query: query[1])
+        predictions = {query: self.predict_tail(*query, k=k) for query in unique_queries}
+        return [predictions[query] for query in queries]
+
+    def _predict(self, paths: Dict[int, RulePath], applicable_rules: Sequence[GeneralizedRule], entity: int,
+                 k: int) -> List[Tuple[int, float]]:
+        """
+        Applying the rules of the queried relation (in descending order of confidence) to the query entity,
+        and selecting the top-k predictions based on the aggregated confidences.
+        Predictions are accumulated as one array of entity IDs per rule, and a candidate's confidences are
+        the confidences of the rules that predicted it (see `_top_k`).
         
-        :param rule: The generalized rule to be applied.
-        :param object: The object entity provided in the query.
-        :return: List of (predicted_head, confidence) tuples.
+        :param paths: The rule paths of the query direction (see `_build_prefix_trie`).
+        :param applicable_rules: The rules of the queried relation, sorted by confidence.
+        :param entity: The (integer ID of the) entity provided in the query.
+        :param k: Number of predictions to return.
+        :return: List of (predicted_entity_id, highest_confidence) tuples, best first.
         """
-        predictions = []
-        grounding = {}
+        # The predictions and the confidence of each rule that predicted something
+        predicted_ids = []
+        rule_confidences = []
+        # The candidates in order of their first prediction, which is by a rule with their highest confidence
+        seen = np.zeros(len(self.training_kg.id2ent), dtype=bool)
+        first_predicted = []
+        best_confidences = []
+        num_candidates = 0
+        # Groundings of the body prefixes for this query, shared by the rules (see `_apply_rule`)
+        prefix_groundings = {}
+
+        for i, rule in enumerate(applicable_rules):
+            # Stopping once the less confident rules can no longer change the top-k
+            if (i and rule.confidence < applicable_rules[i - 1].confidence
+                    and _top_k_settled(best_confidences, num_candidates, k, rule.confidence)):
+                break
+            predicted = self._apply_rule(paths[id(rule)], entity, prefix_groundings)
+            if not len(predicted):
+                continue
+            predicted_ids.append(predicted)
+            rule_confidences.append(rule.confidence)
+            new_candidates = predicted[~seen[predicted]]
+            if len(new_candidates):
+                seen[new_candidates] = True
+                first_predicted.append(new_candidates)
+                best_confidences.append(np.full(len(new_candidates), rule.confidence))
+                num_candidates += len(new_candidates)
+
+        if not num_candidates:
+            return []
+        return _top_k(np.concatenate(first_predicted), np.concatenate(best_confidences),
+                      predicted_ids, rule_confidences, k)
+
+    def _compile_rule(self, rule: GeneralizedRule) -> CompiledRule:
+        """
+        Compiling a rule to the integer programs that are run by `_apply_rule` (see `CompiledRule`).
         
-        # Binding the provided object to the appropriate variable in the rule head
-        if rule.generalized_head.object == "Y":
-            grounding["Y"] = object
-        elif rule.generalized_head.object == "X":
-            grounding["X"] = object
-        else:  # Handling a constant in the head object position
-            if rule.generalized_head.object != object:
-                # Returning empty if the constant does not match the query object
-                return []
-            grounding[object] = object
-            
-        # Attempting to complete the grounding using the rule body
-        completed_groundings = self._complete_grounding(rule, grounding)
+        :param rule: The generalized rule to be compiled.
+        :return: The compiled rule.
+        """
+        encoded_head, encoded_body = rule.encode(self.training_kg)
+        head_terms = (encoded_head[0], encoded_head[2])
+        head_constants = tuple(None if term in ("X", "Y") else term for term in head_terms)
+        # A constant left as a name (instead of an entity ID) would silently never match a query entity
+        if any(constant is not None and not isinstance(constant, int) for constant in head_constants):
+            raise ValueError(f"Head constants of rule {rule.to_logical_string()} are not encoded "
+                             f"as entity IDs: {encoded_head}")
+        slots = {}
+        for term in head_terms:
+            slots.setdefault(term, len(slots))
+        for subj, _, obj in encoded_body:
+            slots.setdefault(subj, len(slots))
+            slots.setdefault(obj, len(slots))
+        body = [(relation, slots[subj], slots[obj]) for subj, relation, obj in encoded_body]
+        return CompiledRule(
+            num_slots=len(slots),
+            head_slots=(slots[head_terms[0]], slots[head_terms[1]]),
+            head_constants=head_constants,
+            tail_program=_compile_program(body, slots[head_terms[0]]),
+            head_program=_compile_program(body, slots[head_terms[1]])
+        )
+
+    def _build_prefix_trie(self, rules: Sequence[GeneralizedRule], query_position: int,
+                           paths: Dict[int, RulePath]) -> Dict[Tuple[int, Optional[int]], BodyPrefixNode]:
+        """
+        Building the body-prefix tries of a relation's rules for queries binding the given head position.
+        Since the slots of a compiled rule are numbered in order of first appearance, rules whose programs
+        start with the same instructions also compute the same intermediate groundings for a query,
+        so these are computed only once for all of them (see `_apply_rule`).
+        There is one trie per (query slot, head constant) pair, where the head constant is None for
+        a variable in the queried head position, since constants only apply to queries of that entity.
         
-        # Iterating over each completed grounding to extract the head prediction
-        for grounding in completed_groundings:
-            if rule.generalized_head.subject == "X":
-                if "X" in grounding:
-                    predictions.append((grounding["X"], rule.confidence))
-            elif rule.generalized_head.subject == "Y":
-                if "Y" in grounding:
-                    predictions.append((grounding["Y"], rule.confidence))
-            else:  # Handling a constant in the head subject position
-                predictions.append((rule.generalized_head.subject, rule.confidence))
-                
-        return predictions
-
-    def _complete_grounding(self, rule: GeneralizedRule, partial_grounding: Dict[str, str]) -> List[Dict[str, str]]:
-        """
-        Completing a partial grounding using the rule body.
-        Iteratively binding variables by matching rule body triples with facts in the KG.
+        :param rules: The rules of a relation, sorted by confidence.
+        :param query_position: The head position bound by the query (0 for tail queries, 1 for head queries).
+        :param paths: Mapping from id(rule) to its RulePath, to be filled with the paths of the rules.
+        :return: Mapping from (query_slot, head_constant) to the root of the trie.
+        """
+        project_position = 1 - query_position
+        tries = {}
+        for rule in rules:
+            compiled = self.compiled_rules[id(rule)]
+            program = compiled.tail_program if query_position == 0 else compiled.head_program
+            query_slot = compiled.head_slots[query_position]
+            query_constant = compiled.head_constants[query_position]
+            root = tries.setdefault((query_slot, query_constant), BodyPrefixNode())
+            root.num_slots = max(root.num_slots, compiled.num_slots)
+            node = root
+            steps = []
+            for instruction in map(tuple, program.tolist()):
+                node = node.children.setdefault(instruction, BodyPrefixNode())
+                steps.append((instruction, node))
+            node.projections.append(
+                (id(rule), compiled.head_slots[project_position], compiled.head_constants[project_position]))
+            paths[id(rule)] = RulePath(query_slot, query_constant, root, tuple(steps),
+                                       compiled.head_slots[project_position],
+                                       compiled.head_constants[project_position])
+
+        for (query_slot, _), root in tries.items():
+            self._mark_live_slots(root, {query_slot})
+        return tries
+
+    def _mark_live_slots(self, node: BodyPrefixNode, bound: Set[int]) -> Set[int]:
+        """
+        Finding the slots that are still needed below a trie node, i.e., the slots of the remaining body triples
+        and the predicted head slots of its rules. When some of the slots bound at a node are not needed anymore
+        (an intermediate variable after its last use), groundings that only differ in these slots lead to the
+        same predictions, so they are merged (see `_apply_rule`), avoiding the repeated expansion of duplicates.
         
-        :param rule: The generalized rule being applied.
-        :param partial_grounding: Dictionary containing variables already bound.
-        :return: List of fully completed groundings (or empty if no valid completions exist).
-        """
-        def _bind_variables(triple: Triple, current_grounding: Dict[str, str]) -> List[Dict[str, str]]:
-            new_groundings = []
-            subj = str(triple.subject)
-            obj = str(triple.object)
-            
-            # Handling the case when both subject and object are already bound
-            if subj in current_grounding and obj in current_grounding:
-                # Checking if the fact exists in the knowledge graph
-                if self.training_kg.has_fact(current_grounding[subj], triple.relation, current_grounding[obj]):
-                    new_groundings.append(current_grounding.copy())
-            
-            # Handling the case when the subject is bound
-            elif subj in current_grounding:
-                # Iterating over all possible objects linked to the bound subject
-                for possible_obj in self.training_kg.adj[triple.relation].get(current_grounding[subj], []):
-                    new_grounding = current_grounding.copy()
-                    new_grounding[obj] = possible_obj
-                    new_groundings.append(new_grounding)
-            
-            # Handling the case when the object is bound
-            elif obj in current_grounding:
-                # Iterating over all possible subjects linked to the bound object
-                for possible_subj in self.training_kg.adj_inv[triple.relation].get(current_grounding[obj], []):
-                    new_grounding = current_grounding.copy()
-                    new_grounding[subj] = possible_subj
-                    new_groundings.append(new_grounding)
-            
-            return new_groundings
-
-        # Initializing the list of current groundings with the provided partial grounding
-        current_groundings = [partial_grounding]
+        :param node: The trie node.
+        :param bound: The slots bound by the groundings at this node.
+        :return: The needed slots of the node.
+        """
+        live = {slot for _, slot, constant in node.projections if constant is None}
+        for (_, _, subj_slot, obj_slot), child in node.children.items():
+            live |= self._mark_live_slots(child, bound | {subj_slot, obj_slot})
+            live |= {subj_slot, obj_slot}
+        node.live_slots = tuple(sorted(bound & live)) if bound - live else None
+        return live
+
+    def _apply_rule(self, path: RulePath, entity: int, prefix_groundings: Dict[int, np.ndarray]) -> np.ndarray:
+        """
+        Applying a rule to a query entity, reusing the groundings of the body prefixes it shares with
+        the rules that were already applied to the same query.
         
-        # Iterating over each triple in the rule body to extend the grounding
-        for body_triple in rule.generalized_body:
-            new_groundings = []
-            for grounding in current_groundings:
-                # Extending the current grounding using available facts
-                new_groundings.extend(_bind_variables(body_triple, grounding))
-            current_groundings = new_groundings
-            if not current_groundings:
+        :param path: The path of the rule in the body-prefix tries of the query direction.
+        :param entity: The (integer ID of the) entity provided in the query.
+        :param prefix_groundings: Groundings of the trie nodes for this query, by id(node) (updated in place).
+        :return: Array of the distinct predictions of the rule (in order of first appearance).
+        """
+        # Returning empty if the constant does not match the query entity
+        if path.query_constant is not None and path.query_constant != entity:
+            return _NO_PREDICTIONS
+
+        groundings = prefix_groundings.get(id(path.root))
+        if groundings is None:
+            # Binding the provided entity to its slot (variable or constant) in the rule head
+            groundings = np.full((1, path.root.num_slots), -1, dtype=np.int32)
+            groundings[0, path.query_slot] = entity
+            prefix_groundings[id(path.root)] = groundings
+        for instruction, node in path.steps:
+            if not len(groundings):
                 # Stopping early if no valid groundings can be formed
-                break
-                
-        return current_groundings
+                return _NO_PREDICTIONS
+            parent_groundings = groundings
+            groundings = prefix_groundings.get(id(node))
+            if groundings is None:
+                # Completing the groundings of this prefix once for all rules sharing it
+                groundings = _run_instruction(self.training_kg, instruction, parent_groundings,
+                                              self.batch_check_threshold)
+                if node.live_slots is not None and len(groundings) >= self.merge_threshold:
+                    groundings = _distinct_groundings(groundings, node.live_slots)
+                prefix_groundings[id(node)] = groundings
+
+        # Extracting the distinct predictions of the completed groundings (in order of first appearance)
+        if not len(groundings):
+            return _NO_PREDICTIONS
+        if path.predicted_constant is None:
+            predicted = groundings[:, path.predicted_slot]
+            predicted = predicted[predicted >= 0]
+            if len(predicted) > 1:
+                _, first = np.unique(predicted, return_index=True)
+                predicted = predicted[np.sort(first)]
+            return predicted
+        # Handling a constant in the predicted head position (unless it is not in the KG)
+        if path.predicted_constant < 0:
+            return _NO_PREDICTIONS
+        return np.array([path.predicted_constant], dtype=np.int32)
+
+
+def _compile_program(body: List[Tuple[int, int, int]], query_slot: int) -> np.ndarray:
+    """
+    Compiling (relation_id, subject_slot, object_slot) body triples to an (n, 4) int32 program
+    for groundings that initially only bind the query slot (see `CompiledRule`).
+    """
+    bound = {query_slot}
+    program = np.empty((len(body), 4), dtype=np.int32)
+    for i, (relation, subj_slot, obj_slot) in enumerate(body):
+        if subj_slot in bound and obj_slot in bound:
+            opcode = CHECK
+        elif subj_slot in bound:
+            opcode = EXPAND_OBJECTS
+            bound.add(obj_slot)
+        elif obj_slot in bound:
+            opcode = EXPAND_SUBJECTS
+            bound.add(subj_slot)
+        else:
+            opcode = FAIL
+        program[i] = (opcode, relation, subj_slot, obj_slot)
+    return program
+
+
+def _expand_groundings(indptr: np.ndarray, neighbors: np.ndarray, groundings: np.ndarray,
+                       bound_slot: int, new_slot: int) -> np.ndarray:
+    """
+    Extending every grounding with each neighbor (in CSR form) of the entity in its bound slot.
+    A grounding with k neighbors is repeated k times, with new_slot holding the different neighbors.
+    """
+    if len(groundings) == 1:
+        # Common case (first body triple): a single grounding, i.e., a single CSR slice
+        entity = groundings[0, bound_slot]
+        start, end = indptr[entity], indptr[entity + 1]
+        expanded = np.repeat(groundings, end - start, axis=0)
+        expanded[:, new_slot] = neighbors[start:end]
+        return expanded
+    starts = indptr[groundings[:, bound_slot]]
+    counts = indptr[groundings[:, bound_slot] + 1] - starts
+    expanded = np.repeat(groundings, counts, axis=0)
+    # Position of each expanded row inside the neighbor slice of the grounding it came from
+    offsets = np.arange(len(expanded)) - np.repeat(np.cumsum(counts) - counts, counts)
+    expanded[:, new_slot] = neighbors[np.repeat(starts, counts) + offsets]
+    return expanded
+
+
+def _distinct_groundings(groundings: np.ndarray, slots: Tuple[int, ...]) -> np.ndarray:
+    """
+    Keeping only the first of the groundings that agree on the given slots.
+    """
+    if len(groundings) <= 1:
+        return groundings
+    if not slots:
+        return groundings[:1]
+    if len(slots) == 1:
+        _, first = np.unique(groundings[:, slots[0]], return_index=True)
+    else:
+        _, first = np.unique(groundings[:, list(slots)], axis=0, return_index=True)
+    return groundings[np.sort(first)]
+
+
+def _run_instruction(kg: KnowledgeGraph, instruction: Tuple[int, int, int, int], groundings: np.ndarray,
+                     batch_check_threshold: int = 64) -> np.ndarray:
+    """
+    Running a single (opcode, relation_id, subject_slot, object_slot) instruction on partial groundings.
+    """
+    opcode, relation, subj_slot, obj_slot = instruction
+    if opcode == CHECK:
+        if len(groundings) >= batch_check_threshold:
+            holds = kg.has_facts_ids(groundings[:, subj_slot], relation, groundings[:, obj_slot])
+        else:
+            holds = [kg.has_fact_ids(s, relation, o)
+                     for s, o in zip(groundings[:, subj_slot].tolist(), groundings[:, obj_slot].tolist())]
+        return groundings[np.asarray(holds, dtype=bool)]
+    elif opcode == EXPAND_OBJECTS:
+        indptr, neighbors = kg.adj_csr[relation]
+        return _expand_groundings(indptr, neighbors, groundings, subj_slot, obj_slot)
+    elif opcode == EXPAND_SUBJECTS:
+        indptr, neighbors = kg.adj_inv_csr[relation]
+        return _expand_groundings(indptr, neighbors, groundings, obj_slot, subj_slot)
+    return groundings[:0]
+
+
+def _top_k(candidate_ids: np.ndarray, best_confidences: np.ndarray, predicted_ids: List[np.ndarray],
+           rule_confidences: List[float], k: int) -> List[Tuple[int, float]]:
+    """
+    Selecting the top-k candidates under the maximum aggregation strategy: candidates are compared by their
+    confidences in descending order (the best one first, then the second best, and so on).
+    Only candidates whose best confidence reaches the k-th largest one can make it into the top-k,
+    so these are found with a partition first. Unless their best confidences already rank them, their k best
+    confidences are then laid out as a (num_candidates, k) score matrix (padded with zeros) that is sorted
+    lexicographically.
+    
+    :param candidate_ids: The candidates, in order of their first prediction.
+    :param best_confidences: The best confidence of each candidate.
+    :param predicted_ids: The predictions of each rule (in descending order of confidence).
+    :param rule_confidences: The confidence of each rule.
+    :param k: Number of predictions to return.
+    :return: List of (candidate, highest_confidence) tuples, best first.
+    """
+    if k <= 0:
+        return []
+    rows = np.arange(len(candidate_ids))
+    if len(candidate_ids) > k:
+        # Keeping only the candidates whose best confidence reaches the k-th largest one (ties included)
+        kth_best = np.partition(best_confidences, len(rows) - k)[len(rows) - k]
+        rows = rows[best_confidences >= kth_best]
+
+    # If their best confidences are all distinct, these alone decide the ranking (as the first column),
+    # which is the common case, so the score matrix is only built when there are ties
+    best = best_confidences[rows]
+    if len(np.unique(best)) == len(best):
+        order = np.argsort(-best, kind='stable')[:k].tolist()
+        return [(int(candidate_ids[rows[i]]), float(best[i])) for i in order]
+
+    # Collecting the confidences of these candidates, grouped by candidate (row), each group in descending order
+    by_id = np.argsort(candidate_ids[rows])
+    sorted_ids = candidate_ids[rows][by_id]
+    ids = np.concatenate(predicted_ids)
+    confidences = np.repeat(rule_confidences, [len(predicted) for predicted in predicted_ids])
+    positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    is_kept = sorted_ids[positions] == ids
+    owners = by_id[positions[is_kept]]
+    confidences = confidences[is_kept]
+    order = np.argsort(owners, kind='stable')
+    owners, confidences = owners[order], confidences[order]
+    group_starts = np.searchsorted(owners, np.arange(len(rows) + 1))
+    ranks = np.arange(len(owners)) - group_starts[owners]
+
+    scores = np.zeros((len(rows), k), dtype=np.float64)
+    in_top = ranks < k
+    scores[owners[in_top], ranks[in_top]] = confidences[in_top]
+    # np.lexsort uses the last key as the primary one, hence the reversed columns
+    # (being stable, candidates with equal scores stay in the order they were predicted in)
+    order = np.lexsort(-scores[:, ::-1].T)
+
+    # Candidates that are equal in all k columns are still ordered by their remaining confidences
+    sorted_scores = scores[order]
+    run_starts = np.flatnonzero(np.r_[True, (sorted_scores[1:] != sorted_scores[:-1]).any(axis=1)]).tolist()
+    run_starts.append(len(order))
+    order = order.tolist()
+    for start, end in zip(run_starts, run_starts[1:]):
+        if start >= k:
+            break
+        if end - start > 1:
+            def all_confidences(i):
+                row_confidences = confidences[group_starts[i]:group_starts[i + 1]].tolist()
+                return row_confidences + [0] * (k - len(row_confidences))
+            order[start:end] = sorted(order[start:end], key=all_confidences, reverse=True)
+    return [(int(candidate_ids[rows[i]]), float(scores[i, 0])) for i in order[:k]]
+
+
+def _top_k_settled(best_confidences: List[np.ndarray], num_candidates: int, k: int, confidence: float) -> bool:
+    """
+    Checking whether rules with (at most) the given confidence can still change the top-k candidates or their order.
+    Since rules are applied in descending order of confidence, candidates are collected in descending order of
+    their best confidence, and rules that are less confident can only add lower confidences.
+    So if the first k candidates have distinct best confidences, all above the best one of the next candidate
+    and the given confidence, their ranking is decided by the best confidences alone.
+    
+    :param best_confidences: The best confidences of the candidates so far, one array per rule that added candidates.
+    :param num_candidates: The number of candidates so far.
+    :param k: Number of predictions to return.
+    :param confidence: Confidence of the next rule.
+    :return: True if the top-k is settled.
+    """
+    if k <= 0:
+        return True
+    if num_candidates < k:
+        return False
+    leading = []
+    for chunk in best_confidences:
+        # A rule adding several candidates at once gives them equal best confidences
+        if len(chunk) > 1 and len(leading) < k:
+            return False
+        leading.append(chunk[0])
+        if len(leading) > k:
+            break
+    return leading[k - 1] > confidence and all(a > b for a, b in zip(leading, leading[1:]))
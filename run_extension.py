@@ -1,81 +1,180 @@
+import hashlib
 import os
+import sys
 import time
 import pickle
-from typing import List, Tuple, Optional
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple, Optional
+import numpy as np
 
-from extension import Triple, KnowledgeGraph, AnyBURL, RulePrediction
+from extension import Triple, KnowledgeGraph, AnyBURL, RulePrediction, GeneralizedRule
 
-def load_triples(file_path: str) -> List[Tuple[str, str, str, float]]:
-    triples = []
+# Default directory of the cached test predictions (see `prediction_cache_path`)
+PREDICTION_CACHE_DIR = ".cache"
+
+# The predictor of an evaluation worker process (see `_init_eval_worker`)
+_eval_predictor: Optional[RulePrediction] = None
+
+def load_triples(file_path: str) -> Iterator[Tuple[str, str, str, float]]:
+    # The tuples are generated line by line, so that they can be turned into Triples without a list of them in between.
+    # The entity and relation names are interned, so that each name is a single string object across
+    # all lines and files (instead of a new one per occurrence), and comparing two equal names is an identity check
+    intern = sys.intern
     with open(file_path, 'r') as f:
         for line in f:
             parts = line.strip().split('\t')
             if len(parts) < 4:
                 continue
             # Ensuring the timestamp is parsed as a float:
-            triples.append((parts[0], parts[1], parts[2], float(parts[3])))
-    return triples
+            yield intern(parts[0]), intern(parts[1]), intern(parts[2]), float(parts[3])
 
-def evaluate_predictions(predictor: RulePrediction, kg: KnowledgeGraph, test_triples: List[Triple], k: int = 10) -> dict:
+def evaluate_predictions(predictor: RulePrediction, kg: KnowledgeGraph, test_triples: List[Triple], k: int = 10,
+                         num_workers: int = 1, cache_path: Optional[Path] = None) -> dict:
     """
     Evaluate the predictor on test triples, computing Hits@1, Hits@10, and MRR.
+    With num_workers > 1, the predictions are computed by that many processes (see `predict_tail_parallel`),
+    and with a cache_path, the predictions cached there are reused (see `predict_tail_cached`).
     """
-    hits_at_k = 0
-    hits_at_1 = 0
-    reciprocal_ranks = []
-    total = 0
+    # The filtered predictions of every test triple as a row of entity IDs (padded with -1),
+    # and the IDs of the true objects, so that the metrics are computed for all test triples at once
+    entity_ids = {}
+    predicted_ids = np.full((len(test_triples), k), -1, dtype=np.int64)
+    true_ids = np.empty(len(test_triples), dtype=np.int64)
 
-    for test_triple in test_triples:
+    # (1) Getting raw predictions for all test triples at once (each ranked by confidence in descending order)
+    subjects = [t.subject for t in test_triples]
+    relations = [t.relation for t in test_triples]
+    if cache_path is not None:
+        all_predictions = predict_tail_cached(predictor, subjects, relations, k, num_workers, cache_path)
+    elif num_workers > 1:
+        all_predictions = predict_tail_parallel(predictor, subjects, relations, k, num_workers)
+    else:
+        all_predictions = predictor.predict_tail_batch(subjects, relations, k=k)
+
+    for i, (test_triple, predictions) in enumerate(zip(test_triples, all_predictions)):
         subject = test_triple.subject
         relation = test_triple.relation
         true_object = test_triple.object
 
-        # (1) Geting raw predictions
-        predictions = predictor.predict_tail(subject, relation, k=k)
-        
-        # (2) Filtering out known objects (except for the test triple's true object)
+        # (2) Filtering out known objects (except for the test triple's true object), and (3) mapping the
+        # remaining ones to IDs, in one pass over the (already ranked) predictions that stops at the true object,
+        # since the predictions after it can't change its rank
+        true_ids[i] = entity_ids.setdefault(true_object, len(entity_ids))
         known_objs = kg.adj.get(relation, {}).get(subject, set())
-        filtered_candidates = []
-        for (obj, conf) in predictions:
-            # Keeping if not already known (or if it is the test triple's object)
-            if (obj == true_object) or (obj not in known_objs):
-                filtered_candidates.append((obj, conf))
-        
-        # (3) Ranking candidates by confidence in descending order
-        filtered_candidates.sort(key=lambda x: x[1], reverse=True)
-        
-        # (4) Extracting candidate objects and computing Hits and reciprocal rank
-        pred_objects = [p[0] for p in filtered_candidates]
-        if len(pred_objects) > 0 and pred_objects[0] == true_object:
-            hits_at_1 += 1
-        if true_object in pred_objects[:k]:
-            hits_at_k += 1
-        if true_object in pred_objects:
-            rank = pred_objects.index(true_object) + 1
-            reciprocal_ranks.append(1.0 / rank)
+        row = []
+        for obj, conf in predictions:
+            if obj == true_object or obj not in known_objs:
+                row.append(entity_ids.setdefault(obj, len(entity_ids)))
+                if obj == true_object or len(row) == k:
+                    break
+        predicted_ids[i, :len(row)] = row
+
+    return ranking_metrics(predicted_ids, true_ids, k)
+
+def prediction_cache_path(dataset_name: str, predictor: RulePrediction,
+                          cache_dir: str = PREDICTION_CACHE_DIR) -> Path:
+    """
+    The file of the cached test predictions of a dataset for the rule set of a predictor.
+    The rule set is identified by a hash over its sorted rule strings and their confidences,
+    so the cache is only reused for the exact same rules (e.g., when re-running an evaluation).
+    """
+    digest = hashlib.sha1()
+    # Unlike the replication predictor (with its confidence floor), the extension predictor has no settings
+    # that change predictions, and the evaluated queries carry no query time, so the rules alone identify them
+    for rule_str in sorted(predictor.rules):
+        digest.update(f"{rule_str}\t{predictor.rules[rule_str].confidence!r}\n".encode())
+    return Path(cache_dir) / f"preds_{dataset_name}_{digest.hexdigest()}.pkl"
+
+def predict_tail_cached(predictor: RulePrediction, subjects: List[str], relations: List[str], k: int,
+                        num_workers: int, cache_path: Path) -> List[List[Tuple[str, float]]]:
+    """
+    Predicting top-k tail entities for many (subject, relation) pairs, reusing the predictions stored in the
+    cache file (keyed by (subject, relation, k)), and adding the missing ones to it.
+    """
+    cache = {}
+    if cache_path.exists():
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+
+    missing = [query for query in dict.fromkeys(zip(subjects, relations)) if (*query, k) not in cache]
+    if missing:
+        missing_subjects, missing_relations = [query[0] for query in missing], [query[1] for query in missing]
+        if num_workers > 1:
+            predictions = predict_tail_parallel(predictor, missing_subjects, missing_relations, k, num_workers)
         else:
-            reciprocal_ranks.append(0.0)
-        
-        total += 1
+            predictions = predictor.predict_tail_batch(missing_subjects, missing_relations, k=k)
+        cache.update(((*query, k), prediction) for query, prediction in zip(missing, predictions))
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, 'wb') as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass  # the cache is optional (e.g., the working directory is read-only)
+
+    return [cache[(subject, relation, k)] for subject, relation in zip(subjects, relations)]
+
+def predict_tail_parallel(predictor: RulePrediction, subjects: List[str], relations: List[str], k: int,
+                          num_workers: int) -> List[List[Tuple[str, float]]]:
+    """
+    Predicting top-k tail entities for many (subject, relation) pairs with several processes.
+    The distinct pairs are grouped by relation and split into one contiguous shard per process,
+    and each process answers its shard with its own predictor (built from the rules and KG of the given one).
+    """
+    queries = list(zip(subjects, relations))
+    unique_queries = sorted(dict.fromkeys(queries), key=lambda query: query[1])
+    shard_size = max(1, -(-len(unique_queries) // num_workers))
+    shards = [unique_queries[i:i + shard_size] for i in range(0, len(unique_queries), shard_size)]
+
+    predictions = {}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_eval_worker,
+                             initargs=(predictor.rules, predictor.training_kg)) as executor:
+        for shard, shard_predictions in zip(shards, executor.map(_predict_tail_in_worker, shards, [k] * len(shards))):
+            predictions.update(zip(shard, shard_predictions))
+    return [predictions[query] for query in queries]
+
+def _init_eval_worker(rules: Dict[str, GeneralizedRule], kg: KnowledgeGraph) -> None:
+    global _eval_predictor
+    _eval_predictor = RulePrediction(rules, kg)
+
+def _predict_tail_in_worker(queries: List[Tuple[str, str]], k: int) -> List[List[Tuple[str, float]]]:
+    subjects, relations = zip(*queries)
+    return _eval_predictor.predict_tail_batch(subjects, relations, k=k)
+
+def ranking_metrics(predicted_ids: np.ndarray, true_ids: np.ndarray, k: int = 10) -> dict:
+    """
+    Computing Hits@1, Hits@k, and MRR from the ranked predictions of each query (one row of entity IDs each,
+    padded with -1) and the true entity ID of each query.
+    """
+    total = len(true_ids)
+    if total == 0:
+        return {'hits@1': 0, 'hits@10': 0, 'mrr': 0}
+
+    # The rank of the true entity in each row (0 if it is not predicted)
+    matches = predicted_ids == true_ids[:, None]
+    found = matches.any(axis=1)
+    ranks = np.where(found, matches.argmax(axis=1) + 1, 0)
 
     return {
-        'hits@1': hits_at_1 / total if total > 0 else 0,
-        'hits@10': hits_at_k / total if total > 0 else 0,
-        'mrr': sum(reciprocal_ranks) / total if total > 0 else 0
+        'hits@1': float(np.mean(ranks == 1)),
+        'hits@10': float(np.mean(found & (ranks <= k))),
+        'mrr': float(np.sum(1.0 / ranks[found]) / total)
     }
 
 def run_experiment(train_path: str, test_path: str, dataset_name: str, learning_time: float,
                    sample_size: int, sat_threshold: float, time_span: float, pessimistic_constant: float,
-                   temporal_window: Optional[float] = None):
+                   temporal_window: Optional[float] = None, num_workers: int = 1,
+                   prediction_cache_dir: Optional[str] = None):
+    """
+    Running a single experiment. With a prediction_cache_dir, the test predictions are cached there per dataset
+    and rule set (see `prediction_cache_path`), which only pays off when the exact same rules are evaluated again,
+    so it is off by default (every run learns a new rule set, and thus writes a new file).
+    """
     print(f"\n==================== Dataset: {dataset_name} | Learning Time: {learning_time} sec ====================")
     
-    # Load data
-    train_triples = load_triples(train_path)
-    test_triples = load_triples(test_path)
-    
-    # Raw tuples into Triple objects
-    train_triples = [Triple.from_tuple(t) for t in train_triples]
-    test_triples = [Triple.from_tuple(t) for t in test_triples]
+    # Load data (raw tuples straight into Triple objects)
+    train_triples = [Triple.from_tuple(t) for t in load_triples(train_path)]
+    test_triples = [Triple.from_tuple(t) for t in load_triples(test_path)]
     
     # KG
     print("Creating knowledge graph...")
@@ -92,7 +191,8 @@ def run_experiment(train_path: str, test_path: str, dataset_name: str, learning_
         pc=pessimistic_constant,
         max_total_time=learning_time,
         dataset_name=dataset_name,
-        temporal_window=temporal_window
+        temporal_window=temporal_window,
+        num_workers=num_workers
     )
     elapsed_learning = time.time() - start_time
     print(f"Rule learning completed in {elapsed_learning:.2f} seconds")
@@ -105,7 +205,11 @@ def run_experiment(train_path: str, test_path: str, dataset_name: str, learning_
     # Evaluating on the test set
     print("Evaluating on test set...")
     start_eval = time.time()
-    metrics = evaluate_predictions(predictor, kg, test_triples, k=10)
+    cache_path = None
+    if prediction_cache_dir is not None:
+        cache_path = prediction_cache_path(dataset_name, predictor, prediction_cache_dir)
+    metrics = evaluate_predictions(predictor, kg, test_triples, k=10, num_workers=num_workers,
+                                   cache_path=cache_path)
     elapsed_eval = time.time() - start_eval
     
     print("\nResults:")
@@ -128,6 +232,7 @@ def replication():
     TIME_SPAN = 1.0
     PESSIMISTIC_CONSTANT = 5.0
     TEMPORAL_WINDOW = 2 # <---         
+    NUM_WORKERS = os.cpu_count() or 1  # sampling processes (one per core)
     
     # Running experiments at different learning time limits for each dataset
     results = {}
@@ -143,7 +248,8 @@ def replication():
                 sat_threshold=SAT_THRESHOLD,
                 time_span=TIME_SPAN,
                 pessimistic_constant=PESSIMISTIC_CONSTANT,
-                temporal_window=TEMPORAL_WINDOW
+                temporal_window=TEMPORAL_WINDOW,
+                num_workers=NUM_WORKERS
             )
             results[ds_name][lt] = metrics
     
@@ -1,80 +1,208 @@
+import hashlib
 import os
 import pickle
+import sys
 import time
 from pathlib import Path
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
 
-from replication import Triple, KnowledgeGraph, AnyBURL, RulePrediction
+from replication import Triple, KnowledgeGraph, AnyBURL, RulePrediction, GeneralizedRule
 
-def load_triples(file_path: str) -> List[Tuple[str, str, str]]:
-    """Loading triples from a pickle file."""
-    with open(file_path, 'rb') as f:
-        return pickle.load(f)
+# Default directory of the cached test predictions (see `prediction_cache_path`)
+PREDICTION_CACHE_DIR = ".cache"
 
-def evaluate_predictions(predictor: RulePrediction, kg: KnowledgeGraph, test_triples: List[Triple], k: int = 10) -> dict:
+# The predictor of an evaluation worker process (see `_init_eval_worker`)
+_eval_predictor: Optional[RulePrediction] = None
+
+def load_triple_ids(file_path: str) -> Tuple[np.ndarray, List[str], List[str]]:
+    """
+    Loading triples from a pickle file as an (N, 3) int32 array of (subject, relation, object) rows that
+    index into the returned entity and relation vocabularies.
+    The first load also stores these next to the pickle as an .npz file, which later loads read instead of
+    unpickling. The names are interned, so that each name is a single string object across all loaded files
+    (e.g., train and test), and comparing two equal names is an identity check.
+    """
+    cache_path = Path(file_path).with_suffix('.npz')
+    if cache_path.exists() and cache_path.stat().st_mtime >= Path(file_path).stat().st_mtime:
+        with np.load(cache_path) as data:
+            ids, entities, relations = data['triples'], data['entities'], data['relations']
+    else:
+        with open(file_path, 'rb') as f:
+            names = np.array(pickle.load(f), dtype=object).reshape(-1, 3)
+        entities, entity_ids = np.unique(names[:, [0, 2]], return_inverse=True)
+        relations, relation_ids = np.unique(names[:, 1], return_inverse=True)
+        entity_ids = entity_ids.reshape(-1, 2)
+        ids = np.stack([entity_ids[:, 0], relation_ids, entity_ids[:, 1]], axis=1).astype(np.int32)
+        entities, relations = entities.astype(str), relations.astype(str)
+        try:
+            np.savez(cache_path, triples=ids, entities=entities, relations=relations)
+        except OSError:
+            pass  # the cache is optional (e.g., the data directory is read-only)
+
+    intern = sys.intern
+    return ids, [intern(entity) for entity in entities.tolist()], [intern(relation) for relation in relations.tolist()]
+
+def load_triples(file_path: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    Loading triples from a pickle file (or its .npz cache, see `load_triple_ids`) as (s, r, o) tuples of names.
+    The tuples are generated one at a time, so that they can be turned into Triples without a list of them in between.
+    """
+    ids, entities, relations = load_triple_ids(file_path)
+    for s, r, o in ids.tolist():
+        yield entities[s], relations[r], entities[o]
+
+def evaluate_predictions(predictor: RulePrediction, kg: KnowledgeGraph, test_triples: List[Triple], k: int = 10,
+                         num_workers: int = 1, cache_path: Optional[Path] = None) -> dict:
     """
     Evaluating the predictor on test triples, computing Hits@k, Hits@1, and MRR.
+    With num_workers > 1, the predictions are computed by that many processes (see `predict_tail_parallel`),
+    and with a cache_path, the predictions cached there are reused (see `predict_tail_cached`).
+    """
+    # (1) Getting raw predictions for all test triples at once (each ranked by confidence in descending order)
+    subjects = [t.subject for t in test_triples]
+    relations = [t.relation for t in test_triples]
+    if cache_path is not None:
+        all_predictions = predict_tail_cached(predictor, subjects, relations, k, num_workers, cache_path)
+    elif num_workers > 1:
+        all_predictions = predict_tail_parallel(predictor, subjects, relations, k, num_workers)
+    else:
+        all_predictions = predictor.predict_tail_batch(subjects, relations, k=k)
+
+    # (2) Laying out the predictions of every test triple as a row of the KG's entity IDs (padded with -1),
+    # next to the IDs of the query and the true object (-2 for names that are not in the KG, which match nothing)
+    ent2id = kg.ent2id
+    predicted_ids = np.full((len(test_triples), k), -1, dtype=np.int64)
+    for i, predictions in enumerate(all_predictions):
+        predicted_ids[i, :len(predictions[:k])] = [ent2id[obj] for obj, conf in predictions[:k]]
+    subject_ids = np.array([ent2id.get(subject, -2) for subject in subjects], dtype=np.int64)
+    relation_ids = np.array([kg.rel2id.get(relation, -2) for relation in relations], dtype=np.int64)
+    true_ids = np.array([ent2id.get(t.object, -2) for t in test_triples], dtype=np.int64)
+
+    # (3) Filtering out known objects (except for the test triple's true object): the predicted triples are
+    # looked up with one vectorized has_facts_ids call per relation, and each row is then compacted to the
+    # kept predictions (in their order), so that the metrics are computed for all test triples at once
+    known = np.zeros(predicted_ids.shape, dtype=bool)
+    checked = (predicted_ids >= 0) & (subject_ids >= 0)[:, None]
+    for relation_id in np.unique(relation_ids[relation_ids >= 0]).tolist():
+        rows, cols = np.nonzero(checked & (relation_ids == relation_id)[:, None])
+        known[rows, cols] = kg.has_facts_ids(subject_ids[rows], relation_id, predicted_ids[rows, cols])
+    keep = (predicted_ids >= 0) & (~known | (predicted_ids == true_ids[:, None]))
+    order = np.argsort(~keep, axis=1, kind='stable')
+    filtered_ids = np.take_along_axis(np.where(keep, predicted_ids, -1), order, axis=1)
+
+    return ranking_metrics(filtered_ids, true_ids, k)
+
+def prediction_cache_path(dataset_name: str, predictor: RulePrediction,
+                          cache_dir: str = PREDICTION_CACHE_DIR) -> Path:
+    """
+    The file of the cached test predictions of a dataset for the rule set of a predictor.
+    The rule set is identified by a hash over its sorted rule strings and their confidences,
+    so the cache is only reused for the exact same rules (e.g., when re-running an evaluation).
+    """
+    digest = hashlib.sha1()
+    digest.update(f"confidence_floor={predictor.confidence_floor!r}\n".encode())
+    for rule_str in sorted(predictor.rules):
+        digest.update(f"{rule_str}\t{predictor.rules[rule_str].confidence!r}\n".encode())
+    return Path(cache_dir) / f"preds_{dataset_name}_{digest.hexdigest()}.pkl"
+
+def predict_tail_cached(predictor: RulePrediction, subjects: List[str], relations: List[str], k: int,
+                        num_workers: int, cache_path: Path) -> List[List[Tuple[str, float]]]:
     """
-    hits_at_k = 0
-    hits_at_1 = 0
-    reciprocal_ranks = []
-    total = 0
-
-    for test_triple in test_triples:
-        subject = test_triple.subject
-        relation = test_triple.relation
-        true_object = test_triple.object
-
-        # (1) Getting raw predictions
-        predictions = predictor.predict_tail(subject, relation, k=k)
-        
-        # (2) Filtering out known objects (except for the test triple's true object)
-        known_objs = kg.adj.get(relation, {}).get(subject, set())
-        filtered_candidates = []
-        for (obj, conf) in predictions:
-            # Keeping if not already known (or if it is the test triple's object)
-            if (obj == true_object) or (obj not in known_objs):
-                filtered_candidates.append((obj, conf))
-        
-        # (3) Ranking candidates by confidence in descending order
-        filtered_candidates.sort(key=lambda x: x[1], reverse=True)
-        
-        # (4) Extracting candidate objects and computing Hits and reciprocal rank
-        pred_objects = [p[0] for p in filtered_candidates]
-        if len(pred_objects) > 0 and pred_objects[0] == true_object:
-            hits_at_1 += 1
-        if true_object in pred_objects[:k]:
-            hits_at_k += 1
-        
-        if true_object in pred_objects:
-            rank = pred_objects.index(true_object) + 1
-            reciprocal_ranks.append(1.0 / rank)
+    Predicting top-k tail entities for many (subject, relation) pairs, reusing the predictions stored in the
+    cache file (keyed by (subject, relation, k)), and adding the missing ones to it.
+    """
+    cache = {}
+    if cache_path.exists():
+        with open(cache_path, 'rb') as f:
+            cache = pickle.load(f)
+
+    missing = [query for query in dict.fromkeys(zip(subjects, relations)) if (*query, k) not in cache]
+    if missing:
+        missing_subjects, missing_relations = [query[0] for query in missing], [query[1] for query in missing]
+        if num_workers > 1:
+            predictions = predict_tail_parallel(predictor, missing_subjects, missing_relations, k, num_workers)
         else:
-            reciprocal_ranks.append(0.0)
-        
-        total += 1
+            predictions = predictor.predict_tail_batch(missing_subjects, missing_relations, k=k)
+        cache.update(((*query, k), prediction) for query, prediction in zip(missing, predictions))
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_path, 'wb') as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass  # the cache is optional (e.g., the working directory is read-only)
+
+    return [cache[(subject, relation, k)] for subject, relation in zip(subjects, relations)]
+
+def predict_tail_parallel(predictor: RulePrediction, subjects: List[str], relations: List[str], k: int,
+                          num_workers: int) -> List[List[Tuple[str, float]]]:
+    """
+    Predicting top-k tail entities for many (subject, relation) pairs with several processes.
+    The distinct pairs are grouped by relation and split into one contiguous shard per process,
+    and each process answers its shard with its own predictor (built from the rules and KG of the given one).
+    """
+    queries = list(zip(subjects, relations))
+    unique_queries = sorted(dict.fromkeys(queries), key=lambda query: query[1])
+    shard_size = max(1, -(-len(unique_queries) // num_workers))
+    shards = [unique_queries[i:i + shard_size] for i in range(0, len(unique_queries), shard_size)]
+
+    predictions = {}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_eval_worker,
+                             initargs=(predictor.rules, predictor.training_kg, predictor.confidence_floor)) as executor:
+        for shard, shard_predictions in zip(shards, executor.map(_predict_tail_in_worker, shards, [k] * len(shards))):
+            predictions.update(zip(shard, shard_predictions))
+    return [predictions[query] for query in queries]
+
+def _init_eval_worker(rules: Dict[str, GeneralizedRule], kg: KnowledgeGraph, confidence_floor: float) -> None:
+    global _eval_predictor
+    _eval_predictor = RulePrediction(rules, kg, confidence_floor)
+
+def _predict_tail_in_worker(queries: List[Tuple[str, str]], k: int) -> List[List[Tuple[str, float]]]:
+    subjects, relations = zip(*queries)
+    return _eval_predictor.predict_tail_batch(subjects, relations, k=k)
+
+def ranking_metrics(predicted_ids: np.ndarray, true_ids: np.ndarray, k: int = 10) -> dict:
+    """
+    Computing Hits@1, Hits@k, and MRR from the ranked predictions of each query (one row of entity IDs each,
+    padded with -1) and the true entity ID of each query.
+    """
+    total = len(true_ids)
+    if total == 0:
+        return {'hits@1': 0, 'hits@10': 0, 'mrr': 0}
+
+    # The rank of the true entity in each row (0 if it is not predicted)
+    matches = predicted_ids == true_ids[:, None]
+    found = matches.any(axis=1)
+    ranks = np.where(found, matches.argmax(axis=1) + 1, 0)
 
     return {
-        'hits@1': hits_at_1 / total if total > 0 else 0,
-        'hits@10': hits_at_k / total if total > 0 else 0,
-        'mrr': sum(reciprocal_ranks) / total if total > 0 else 0
+        'hits@1': float(np.mean(ranks == 1)),
+        'hits@10': float(np.mean(found & (ranks <= k))),
+        'mrr': float(np.sum(1.0 / ranks[found]) / total)
     }
 
 def run_experiment(train_path: str, test_path: str, dataset_name: str, learning_time: float,
-                   sample_size: int, sat_threshold: float, time_span: float, pessimistic_constant: float):
+                   sample_size: int, sat_threshold: float, time_span: float, pessimistic_constant: float,
+                   num_workers: int = 1,
+                   prediction_cache_dir: Optional[str] = None):
+    """
+    Running a single experiment. With a prediction_cache_dir, the test predictions are cached there per dataset
+    and rule set (see `prediction_cache_path`), which only pays off when the exact same rules are evaluated again,
+    so it is off by default (every run learns a new rule set, and thus writes a new file).
+    """
     print(f"\n==================== Dataset: {dataset_name} | Learning Time: {learning_time} sec ====================")
     
     # Load data
-    train_triples = load_triples(train_path)
-    test_triples = load_triples(test_path)
+    train_ids, entities, relations = load_triple_ids(train_path)
     
-    # Raw tuples into Triple objects
-    train_triples = [Triple.from_tuple(t) for t in train_triples]
-    test_triples = [Triple.from_tuple(t) for t in test_triples]
+    # Raw tuples into Triple objects (only for the test set, since the KG is built straight from the
+    # training IDs and keeps its triples as an integer array anyway)
+    test_triples = [Triple.from_tuple(t) for t in load_triples(test_path)]
     
     # KG
     print("Creating knowledge graph...")
-    kg = KnowledgeGraph(train_triples)
+    kg = KnowledgeGraph.from_ids(train_ids, entities, relations)
     
     # Learning rules using AnyBURL
     print("Learning rules...")
@@ -85,7 +213,8 @@ def run_experiment(train_path: str, test_path: str, dataset_name: str, learning_
         sat=sat_threshold,
         ts=time_span,
         pc=pessimistic_constant,
-        max_total_time=learning_time
+        max_total_time=learning_time,
+        num_workers=num_workers
     )
     elapsed_learning = time.time() - start_time
     print(f"Rule learning completed in {elapsed_learning:.2f} seconds")
@@ -98,7 +227,11 @@ def run_experiment(train_path: str, test_path: str, dataset_name: str, learning_
     # Evaluating on the test set
     print("Evaluating on test set...")
     start_eval = time.time()
-    metrics = evaluate_predictions(predictor, kg, test_triples, k=10)
+    cache_path = None
+    if prediction_cache_dir is not None:
+        cache_path = prediction_cache_path(dataset_name, predictor, prediction_cache_dir)
+    metrics = evaluate_predictions(predictor, kg, test_triples, k=10, num_workers=num_workers,
+                                   cache_path=cache_path)
     elapsed_eval = time.time() - start_eval
     
     print("\nResults:")
@@ -122,6 +255,7 @@ def replication():
     SAT_THRESHOLD = 0.20
     TIME_SPAN = 1.0
     PESSIMISTIC_CONSTANT = 5.0
+    NUM_WORKERS = os.cpu_count() or 1  # sampling processes (one per core)
     
     # Running experiments at different learning time limits for each dataset
     results = {}
@@ -136,6 +270,7 @@ def replication():
                 sat_threshold=SAT_THRESHOLD,
                 time_span=TIME_SPAN,
                 pessimistic_constant=PESSIMISTIC_CONSTANT,
+                num_workers=NUM_WORKERS,
                 dataset_name=ds_name,
             )
             results[ds_name][lt] = metrics
@@ -0,0 +1,73 @@
+import random
+
+import numpy as np
+import pytest
+
+import extension
+import replication
+import run_extension
+import run_replication
+
+
+def baseline_evaluation(predictor, kg, test_triples, k=10):
+    """
+    The original evaluation loop: filtering known objects (except the true one) out of each query's predictions,
+    and averaging the hits and reciprocal ranks of the true objects.
+    """
+    hits_at_k = hits_at_1 = 0
+    reciprocal_ranks = []
+    for test_triple in test_triples:
+        predictions = predictor.predict_tail(test_triple.subject, test_triple.relation, k=k)
+        pred_objects = [obj for obj, _ in predictions
+                        if obj == test_triple.object
+                        or not kg.has_fact(test_triple.subject, test_triple.relation, obj)]
+        hits_at_1 += bool(pred_objects) and pred_objects[0] == test_triple.object
+        hits_at_k += test_triple.object in pred_objects[:k]
+        reciprocal_ranks.append(1.0 / (pred_objects.index(test_triple.object) + 1)
+                                if test_triple.object in pred_objects else 0.0)
+    total = len(test_triples)
+    return {'hits@1': hits_at_1 / total, 'hits@10': hits_at_k / total, 'mrr': sum(reciprocal_ranks) / total}
+
+
+def experiment(package, seed=0, num_entities=25, num_triples=300):
+    rnd = random.Random(seed)
+    facts = [(f"e{rnd.randrange(num_entities)}", f"r{rnd.randrange(3)}", f"e{rnd.randrange(num_entities)}")
+             + ((float(rnd.randrange(5)),) if package is extension else ())
+             for _ in range(num_triples)]
+    kg = package.KnowledgeGraph(facts[:250])
+
+    random.seed(seed)
+    rules = {}
+    for _ in range(60):
+        bottom_rule = package.sample_bottom_rule(kg, random.choice([2, 3]))
+        if bottom_rule is not None:
+            for rule in package.generalize_bottom_rule(bottom_rule):
+                rule_str = rule.to_logical_string()
+                rule.confidence = (sum(map(ord, rule_str)) % 7 + 1) / 8
+                rules[rule_str] = rule
+
+    # Held-out facts, training facts (whose true object is known, but still counts), and queries or answers
+    # that are not in the KG
+    test_triples = [package.Triple(*fact[:3]) for fact in facts[250:] + facts[:20]]
+    test_triples += [package.Triple("unknown", "r0", "e1"), package.Triple("e1", "unknown", "e2"),
+                     package.Triple("e1", "r0", "unknown")]
+    return package.RulePrediction(rules, kg), kg, test_triples
+
+
+@pytest.mark.parametrize("package, runner", [(replication, run_replication), (extension, run_extension)])
+@pytest.mark.parametrize("k", [1, 3, 10])
+def test_evaluation_matches_baseline_loop(package, runner, k):
+    predictor, kg, test_triples = experiment(package)
+    expected = baseline_evaluation(predictor, kg, test_triples, k=k)
+    assert expected['mrr'] > 0
+    assert runner.evaluate_predictions(predictor, kg, test_triples, k=k) == pytest.approx(expected)
+
+
+def test_ranking_metrics():
+    predicted_ids = np.array([[3, 1, -1], [2, 4, 5], [1, -1, -1], [-1, -1, -1]])
+    true_ids = np.array([1, 2, 7, 0])
+    metrics = run_replication.ranking_metrics(predicted_ids, true_ids, k=3)
+    assert metrics == pytest.approx({'hits@1': 1 / 4, 'hits@10': 2 / 4, 'mrr': (1 / 2 + 1) / 4})
+    # Only ranks up to k count as hits
+    assert run_replication.ranking_metrics(predicted_ids, true_ids, k=1)['hits@10'] == pytest.approx(1 / 4)
+    assert run_replication.ranking_metrics(predicted_ids[:0], true_ids[:0]) == {'hits@1': 0, 'hits@10': 0, 'mrr': 0}
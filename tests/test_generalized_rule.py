@@ -0,0 +1,108 @@
+import pickle
+import random
+
+from replication import (BottomRule, KnowledgeGraph, RulePrediction, Triple, calculate_confidences_batch,
+                         generalize_bottom_rule, sample_bottom_rule)
+from replication.rule_generalization.GeneralizedRule_withConf import CONFIDENCE_CHECK_INTERVAL
+
+
+def amy_kg():
+    # Entity names starting with an "A" must not be mistaken for the auxiliary variables A2, A3, ...
+    return KnowledgeGraph([("Zed", "likes", "Amy"), ("Zed", "knows", "Amy"), ("Carl", "likes", "Amy")])
+
+
+def amy_rules():
+    bottom_rule = BottomRule(Triple("Zed", "knows", "Amy"), "subject")
+    bottom_rule.add_triple(Triple("Zed", "likes", "Amy"), "forward")
+    rules = {}
+    for rule in generalize_bottom_rule(bottom_rule):
+        rule.confidence = 0.5
+        rules[rule.to_logical_string()] = rule
+    return rules
+
+
+def test_encode_maps_constants_starting_with_a_to_entity_ids():
+    kg = amy_kg()
+    rule = amy_rules()["knows(X, Amy) <- likes(X, Amy)"]
+    head, body = rule.encode(kg)
+    assert head == ("X", kg.rel2id["knows"], kg.ent2id["Amy"])
+    assert body == [("X", kg.rel2id["likes"], kg.ent2id["Amy"])]
+
+
+def test_encode_is_redone_for_another_kg():
+    rule = amy_rules()["knows(X, Amy) <- likes(X, Amy)"]
+    kg = amy_kg()
+    rule.encode(kg)
+    # The same names with different IDs
+    other_kg = KnowledgeGraph([("Amy", "likes", "Amy"), ("Zed", "knows", "Carl")])
+    head, body = rule.encode(other_kg)
+    assert head == ("X", other_kg.rel2id["knows"], other_kg.ent2id["Amy"])
+    assert body == [("X", other_kg.rel2id["likes"], other_kg.ent2id["Amy"])]
+
+
+def test_encoded_rules_can_be_pickled():
+    kg = amy_kg()
+    rule = amy_rules()["knows(X, Amy) <- likes(X, Amy)"]
+    encoded = rule.encode(kg)
+    copied = pickle.loads(pickle.dumps(rule))
+    assert copied.to_logical_string() == rule.to_logical_string()
+    assert copied.confidence == rule.confidence
+    assert copied.encode(kg) == encoded
+
+
+def test_predicting_entities_starting_with_a():
+    kg = amy_kg()
+    predictor = RulePrediction(amy_rules(), kg)
+    assert predictor.predict_tail("Carl", "knows") == [("Amy", 0.5)]
+    assert predictor.predict_head("knows", "Amy") == [("Zed", 0.5), ("Carl", 0.5)]
+
+
+def test_batched_confidences_match_single_rule_confidences():
+    rnd = random.Random(0)
+    names = [f"Ann{i}" if i % 2 else f"e{i}" for i in range(20)]
+    kg = KnowledgeGraph([(rnd.choice(names), f"r{rnd.randrange(3)}", rnd.choice(names)) for _ in range(200)])
+    random.seed(0)
+    rules_by_body = {}
+    for _ in range(100):
+        bottom_rule = sample_bottom_rule(kg, random.choice([2, 3]))
+        if bottom_rule is not None:
+            for rule in generalize_bottom_rule(bottom_rule):
+                rules_by_body.setdefault(rule.body_signature(), {}).setdefault(rule.to_logical_string(), rule)
+    assert any(len(rules) > 1 for rules in rules_by_body.values())
+
+    for rules in rules_by_body.values():
+        rules = list(rules.values())
+        # Sampling the body groundings once for all rules gives the same as sampling them again for each rule
+        random.seed(1)
+        calculate_confidences_batch(rules, kg, sample_size=100)
+        batched = [(rule.confidence, rule.body_groundings_count, rule.head_groundings_count) for rule in rules]
+        single = []
+        for rule in rules:
+            random.seed(1)
+            rule.calculate_confidence(kg, sample_size=100)
+            single.append((rule.confidence, rule.body_groundings_count, rule.head_groundings_count))
+        assert batched == single
+
+
+def test_min_conf_stops_sampling_once_the_confidence_bound_is_below_it():
+    people = [f"p{i}" for i in range(10)]
+    rule = amy_rules()["knows(X, Amy) <- likes(X, Amy)"]
+    # Every body grounding (X likes Amy) makes the head true in the first KG, and none does in the second
+    likes = [(person, "likes", "Amy") for person in people]
+    kg_true = KnowledgeGraph(likes + [(person, "knows", "Amy") for person in people])
+    kg_false = KnowledgeGraph(likes + [("Amy", "knows", person) for person in people])
+
+    random.seed(0)
+    rule.calculate_confidence(kg_false, sample_size=500)
+    assert (rule.body_groundings_count, rule.head_groundings_count) == (500, 0)
+
+    random.seed(0)
+    rule.calculate_confidence(kg_false, sample_size=500, min_conf=0.5)
+    assert (rule.body_groundings_count, rule.head_groundings_count) == (CONFIDENCE_CHECK_INTERVAL, 0)
+    assert rule.confidence == 1 / (CONFIDENCE_CHECK_INTERVAL + 1)
+
+    # A rule that can reach the minimum confidence is sampled in full
+    random.seed(0)
+    rule.calculate_confidence(kg_true, sample_size=500, min_conf=0.5)
+    assert (rule.body_groundings_count, rule.head_groundings_count) == (500, 500)
+    assert rule.confidence == 1.0
@@ -0,0 +1,88 @@
+import random
+
+import numpy as np
+import pytest
+
+from replication import KnowledgeGraph
+
+
+def random_triples(seed=0, num_entities=40, num_relations=4, num_triples=300):
+    rnd = random.Random(seed)
+    triples = [(f"e{rnd.randrange(num_entities)}", f"r{rnd.randrange(num_relations)}", f"e{rnd.randrange(num_entities)}")
+               for _ in range(num_triples)]
+    # A few self-loops and duplicates, which the KG has to handle as well
+    triples += [("e0", "r0", "e0"), ("e1", "r1", "e1")] + triples[:10]
+    return triples
+
+
+def facts_of(kg):
+    return {(kg.id2ent[s], kg.id2rel[r], kg.id2ent[o]) for s, r, o in kg.triples.tolist()}
+
+
+def test_from_ids_matches_construction_from_names():
+    triples = random_triples()
+    entities = sorted({t[0] for t in triples} | {t[2] for t in triples})
+    relations = sorted({t[1] for t in triples})
+    ent_index = {entity: i for i, entity in enumerate(entities)}
+    rel_index = {relation: i for i, relation in enumerate(relations)}
+    triple_ids = np.array([(ent_index[s], rel_index[r], ent_index[o]) for s, r, o in triples], dtype=np.int32)
+
+    kg = KnowledgeGraph(triples)
+    kg_from_ids = KnowledgeGraph.from_ids(triple_ids, entities, relations)
+
+    assert kg_from_ids.id2ent == kg.id2ent
+    assert kg_from_ids.id2rel == kg.id2rel
+    assert np.array_equal(kg_from_ids.triples, kg.triples)
+    assert facts_of(kg_from_ids) == set(triples)
+    for s, r, o in triples[:50]:
+        assert kg_from_ids.has_fact(s, r, o)
+
+
+def test_has_facts_ids_matches_has_fact_ids():
+    kg = KnowledgeGraph(random_triples(seed=1))
+    rnd = np.random.default_rng(0)
+    num_entities = len(kg.id2ent)
+    for r_id in range(len(kg.id2rel)):
+        # Random pairs (mostly absent), plus all facts of the relation
+        s_ids = rnd.integers(0, num_entities, size=500)
+        o_ids = rnd.integers(0, num_entities, size=500)
+        is_relation = kg.triples[:, 1] == r_id
+        s_ids = np.concatenate([s_ids, kg.triples[is_relation, 0]])
+        o_ids = np.concatenate([o_ids, kg.triples[is_relation, 2]])
+
+        expected = [kg.has_fact_ids(s, r_id, o) for s, o in zip(s_ids.tolist(), o_ids.tolist())]
+        assert kg.has_facts_ids(s_ids, r_id, o_ids).tolist() == expected
+        assert all(expected[500:])
+
+
+def test_has_fact_ids_accepts_numpy_int32():
+    kg = KnowledgeGraph(random_triples(seed=2))
+    assert all(kg.has_fact_ids(s, r, o) for s, r, o in kg.triples)
+
+
+@pytest.mark.parametrize("direction_allowed", ["both", "forward-only", "backward-only"])
+def test_viable_heads_match_brute_force(direction_allowed):
+    kg = KnowledgeGraph(random_triples(seed=3, num_entities=25, num_triples=60))
+    out_edges, in_edges = {}, {}
+    for s, _, o in kg.triples.tolist():
+        out_edges.setdefault(s, []).append(o)
+        in_edges.setdefault(o, []).append(s)
+
+    expected = []
+    for index, (s, _, o) in enumerate(kg.triples.tolist()):
+        # Neighbors reachable in one step (in the allowed direction) from either head node
+        steps = []
+        for node in (s, o):
+            if direction_allowed != "backward-only":
+                steps += out_edges.get(node, [])
+            if direction_allowed != "forward-only":
+                steps += in_edges.get(node, [])
+        if any(neighbor not in (s, o) for neighbor in steps):
+            expected.append(index)
+
+    assert kg.viable_heads[direction_allowed].tolist() == expected
+
+
+def test_viable_heads_of_empty_kg():
+    kg = KnowledgeGraph([])
+    assert len(kg.viable_heads["both"]) == 0
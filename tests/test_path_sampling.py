@@ -0,0 +1,86 @@
+import random
+
+import numpy as np
+import pytest
+
+from replication import KnowledgeGraph, sample_bottom_rule, sample_bottom_rules_batch
+
+
+def small_kg(seed=0, num_entities=8, num_triples=20):
+    rnd = random.Random(seed)
+    triples = [(f"e{rnd.randrange(num_entities)}", f"r{rnd.randrange(2)}", f"e{rnd.randrange(num_entities)}")
+               for _ in range(num_triples)]
+    return KnowledgeGraph(triples)
+
+
+def assert_valid_path(kg, bottom_rule, n, direction_allowed="both"):
+    """
+    Checking that the bottom rule is a path of n facts (the head and n - 1 body triples) from the start node
+    of the head that visits every node at most once, except for closing a cycle in the last step.
+    """
+    assert kg.has_fact(*bottom_rule.head)
+    assert len(bottom_rule.body) == len(bottom_rule.steps) == n - 1
+    head_nodes = (bottom_rule.head.subject, bottom_rule.head.object)
+    current = head_nodes[0] if bottom_rule.start_from == "subject" else head_nodes[1]
+    visited = set(head_nodes)
+    for index, (triple, step) in enumerate(zip(bottom_rule.body, bottom_rule.steps)):
+        assert kg.has_fact(*triple)
+        assert step in ("forward", "backward")
+        if direction_allowed != "both":
+            assert step == direction_allowed.split("-")[0]
+        if step == "forward":
+            assert triple.subject == current
+            current = triple.object
+        else:
+            assert triple.object == current
+            current = triple.subject
+        if index < n - 2:
+            assert current not in visited
+        visited.add(current)
+    assert bottom_rule.is_cyclical == (n > 1 and current in head_nodes)
+
+
+def path_of(bottom_rule):
+    return tuple(bottom_rule.head), bottom_rule.start_from, tuple(map(tuple, bottom_rule.body))
+
+
+@pytest.mark.parametrize("direction_allowed", ["both", "forward-only", "backward-only"])
+@pytest.mark.parametrize("n", [1, 2, 3, 4])
+def test_sampled_paths_are_valid(n, direction_allowed):
+    kg = small_kg(num_entities=12, num_triples=60)
+    random.seed(0)
+    bottom_rules = sample_bottom_rules_batch(kg, n, batch_size=500, direction_allowed=direction_allowed)
+    assert bottom_rules
+    for _ in range(200):
+        bottom_rule = sample_bottom_rule(kg, n, direction_allowed=direction_allowed)
+        if bottom_rule is not None:
+            bottom_rules.append(bottom_rule)
+    for bottom_rule in bottom_rules:
+        assert_valid_path(kg, bottom_rule, n, direction_allowed)
+
+
+def test_batched_and_single_samplers_reach_the_same_paths():
+    kg = small_kg()
+    random.seed(1)
+    batched = {path_of(bottom_rule) for bottom_rule in sample_bottom_rules_batch(kg, 3, batch_size=20000)}
+    single = {path_of(bottom_rule) for bottom_rule in (sample_bottom_rule(kg, 3) for _ in range(20000))
+              if bottom_rule is not None}
+    assert batched == single
+
+
+def test_cyclic_only_keeps_the_cyclic_paths():
+    kg = small_kg(num_entities=5, num_triples=30)
+    random.seed(2)
+    all_rules = sample_bottom_rules_batch(kg, 3, batch_size=2000, rng=np.random.default_rng(0))
+    cyclic_rules = sample_bottom_rules_batch(kg, 3, batch_size=2000, cyclic_only=True, rng=np.random.default_rng(0))
+    assert cyclic_rules
+    assert [path_of(rule) for rule in cyclic_rules] == [path_of(rule) for rule in all_rules if rule.is_cyclical]
+
+
+def test_batches_are_reproducible_with_random_seed():
+    kg = small_kg()
+    random.seed(3)
+    first = [path_of(bottom_rule) for bottom_rule in sample_bottom_rules_batch(kg, 3, batch_size=100)]
+    random.seed(3)
+    second = [path_of(bottom_rule) for bottom_rule in sample_bottom_rules_batch(kg, 3, batch_size=100)]
+    assert first == second
@@ -0,0 +1,161 @@
+import random
+from itertools import groupby
+
+import numpy as np
+import pytest
+
+from replication import KnowledgeGraph, RulePrediction, generalize_bottom_rule, sample_bottom_rule
+from replication.rule_generalization.GeneralizedRule_withConf import VARIABLE_PATTERN
+from replication.rule_prediction import _top_k, _top_k_settled
+
+
+def named_kg(seed=0, num_entities=30, num_triples=250):
+    rnd = random.Random(seed)
+    # Half of the entity names start with an "A", like the auxiliary variables of the rules
+    names = [f"Ann{i}" if i % 2 else f"e{i}" for i in range(num_entities)]
+    triples = [(rnd.choice(names), f"r{rnd.randrange(3)}", rnd.choice(names)) for _ in range(num_triples)]
+    return KnowledgeGraph(triples)
+
+
+def learned_rules(kg, seed=0, num_bottom_rules=60, distinct_confidences=False):
+    random.seed(seed)
+    rules = {}
+    while len(rules) < 3 * num_bottom_rules:
+        bottom_rule = sample_bottom_rule(kg, random.choice([2, 3]))
+        if bottom_rule is None:
+            continue
+        for rule in generalize_bottom_rule(bottom_rule):
+            rule_str = rule.to_logical_string()
+            # Either (almost surely) distinct confidences, or deterministic ones with plenty of ties
+            rule.confidence = random.random() if distinct_confidences else (sum(map(ord, rule_str)) % 7 + 1) / 8
+            rules[rule_str] = rule
+    return rules
+
+
+def brute_force_predictions(rules, kg, entity, relation, query_position):
+    """
+    The aggregated confidences of every candidate, by grounding each rule body one triple at a time
+    (a constant is only bound in the queried head position, and predicted as it is), best candidate first.
+    """
+    facts = {tuple(kg.get_triple(i)) for i in range(len(kg.triples))}
+    entities = kg.id2ent
+    candidates = {}
+    applicable = [rule for rule in rules.values() if rule.generalized_head.relation == relation]
+    for rule in sorted(applicable, key=lambda rule: rule.confidence, reverse=True):
+        head = (rule.generalized_head.subject, rule.generalized_head.object)
+        query_term, predicted_term = head[query_position], head[1 - query_position]
+        if not VARIABLE_PATTERN.fullmatch(query_term) and query_term != entity:
+            continue
+        groundings = [{query_term: entity}]
+        for triple in rule.generalized_body:
+            subj, obj = triple.subject, triple.object
+            groundings = [
+                {**grounding, subj: s, obj: o}
+                for grounding in groundings if subj in grounding or obj in grounding
+                for s in ([grounding[subj]] if subj in grounding else entities)
+                for o in ([grounding[obj]] if obj in grounding else entities)
+                if (s, triple.relation, o) in facts
+            ]
+        if VARIABLE_PATTERN.fullmatch(predicted_term):
+            predicted = {grounding[predicted_term] for grounding in groundings if predicted_term in grounding}
+        else:
+            predicted = {predicted_term} if groundings else set()
+        for candidate in predicted:
+            candidates.setdefault(candidate, []).append(rule.confidence)
+    return sorted(((candidate, tuple(confidences)) for candidate, confidences in candidates.items()),
+                  key=lambda item: item[1], reverse=True)
+
+
+def assert_ranking(predictions, expected, k):
+    """
+    Checking the predictions against the expected (candidate, confidences) ranking, where candidates with equal
+    confidences can be in any order (and only some of them can make it into the top-k).
+    """
+    assert len(predictions) == min(k, len(expected))
+    assert [confidence for _, confidence in predictions] == [confidences[0] for _, confidences in expected[:k]]
+    position = 0
+    for _, group in groupby(expected, key=lambda item: item[1]):
+        group = {candidate for candidate, _ in group}
+        predicted = {candidate for candidate, _ in predictions[position:position + len(group)]}
+        if position + len(group) <= k:
+            assert predicted == group
+        else:
+            assert predicted <= group
+            break
+        position += len(group)
+
+
+@pytest.mark.parametrize("distinct_confidences", [False, True])
+@pytest.mark.parametrize("k", [1, 3, 10, 1000])
+def test_predictions_match_brute_force(distinct_confidences, k):
+    kg = named_kg()
+    rules = learned_rules(kg, distinct_confidences=distinct_confidences)
+    predictor = RulePrediction(rules, kg)
+    for entity in kg.id2ent:
+        for relation in kg.id2rel:
+            assert_ranking(predictor.predict_tail(entity, relation, k=k),
+                           brute_force_predictions(rules, kg, entity, relation, 0), k)
+            assert_ranking(predictor.predict_head(relation, entity, k=k),
+                           brute_force_predictions(rules, kg, entity, relation, 1), k)
+
+
+def test_unknown_queries_have_no_predictions():
+    kg = named_kg(seed=1)
+    predictor = RulePrediction(learned_rules(kg, seed=1), kg)
+    assert predictor.predict_tail("unknown", "r0") == []
+    assert predictor.predict_head("unknown_relation", "e0") == []
+
+
+def test_confidence_floor_drops_rules():
+    kg = named_kg(seed=2)
+    rules = learned_rules(kg, seed=2, distinct_confidences=True)
+    floor = 0.5
+    predictor = RulePrediction(rules, kg, confidence_floor=floor)
+    kept = {rule_str: rule for rule_str, rule in rules.items() if rule.confidence >= floor}
+    for entity in kg.id2ent:
+        assert_ranking(predictor.predict_tail(entity, "r1", k=10),
+                       brute_force_predictions(kept, kg, entity, "r1", 0), 10)
+
+
+def test_rules_with_unencoded_head_constants_are_rejected():
+    kg = named_kg(seed=3)
+    rule = next(rule for rule in learned_rules(kg, seed=3).values()
+                if not VARIABLE_PATTERN.fullmatch(rule.generalized_head.object))
+    head, body = rule.encode(kg)
+    # As if a constant had been kept as its name (see `GeneralizedRule.encode`)
+    rule._encoded = (rule._encoded[0], (head[0], head[1], rule.generalized_head.object), body)
+    with pytest.raises(ValueError):
+        RulePrediction({rule.to_logical_string(): rule}, kg)
+
+
+def test_top_k_matches_sorting_all_confidences():
+    rnd = np.random.default_rng(0)
+    for _ in range(200):
+        # Few distinct confidences and candidates, so that there are plenty of ties
+        rule_confidences = sorted(rnd.choice([0.2, 0.4, 0.6, 0.8], size=rnd.integers(1, 8)).tolist(), reverse=True)
+        predicted_ids = [rnd.choice(12, size=rnd.integers(1, 6), replace=False) for _ in rule_confidences]
+        confidences = {}
+        for predicted, confidence in zip(predicted_ids, rule_confidences):
+            for candidate in predicted.tolist():
+                confidences.setdefault(candidate, []).append(confidence)
+        candidate_ids = np.array(list(confidences))
+        best_confidences = np.array([candidate_confidences[0] for candidate_confidences in confidences.values()])
+        k = int(rnd.integers(1, 8))
+
+        # Sorting is stable, so candidates with equal confidences stay in the order they were predicted in
+        expected = sorted(confidences.items(), key=lambda item: item[1], reverse=True)[:k]
+        assert _top_k(candidate_ids, best_confidences, predicted_ids, rule_confidences, k) == \
+            [(candidate, candidate_confidences[0]) for candidate, candidate_confidences in expected]
+
+
+def test_top_k_settled():
+    best_confidences = [np.array([0.9]), np.array([0.8]), np.array([0.7])]
+    assert _top_k_settled(best_confidences, 3, 2, 0.7)
+    # A rule as confident as the second candidate could still add a second confidence to the third one
+    assert not _top_k_settled(best_confidences, 3, 2, 0.8)
+    # Too few candidates yet
+    assert not _top_k_settled(best_confidences, 3, 4, 0.1)
+    # Candidates added by the same rule are tied until later rules tell them apart
+    assert not _top_k_settled([np.array([0.9, 0.9]), np.array([0.8])], 3, 2, 0.5)
+    # The k-th candidate is only settled if it is ahead of the next one
+    assert not _top_k_settled([np.array([0.9]), np.array([0.8]), np.array([0.8])], 3, 2, 0.5)
@@ -0,0 +1,64 @@
+import copy
+import random
+
+from extension import KnowledgeGraph, RulePrediction, generalize_bottom_rule, sample_bottom_rule
+
+
+def temporal_kg(seed=0, num_entities=30, num_triples=400):
+    rnd = random.Random(seed)
+    triples = [(f"e{rnd.randrange(num_entities)}", f"r{rnd.randrange(4)}", f"e{rnd.randrange(num_entities)}",
+                float(rnd.randrange(10)))
+               for _ in range(num_triples)]
+    return KnowledgeGraph(triples)
+
+
+def learned_rules(kg, seed=0, num_bottom_rules=80):
+    random.seed(seed)
+    rules = {}
+    while len(rules) < 3 * num_bottom_rules:
+        bottom_rule = sample_bottom_rule(kg, random.choice([2, 3]))
+        for rule in generalize_bottom_rule(bottom_rule):
+            # Deterministic confidences with plenty of ties (which have to be broken in insertion order)
+            rule_str = rule.to_logical_string()
+            rule.confidence = (sum(map(ord, rule_str)) % 7 + 1) / 8
+            rules[rule_str] = rule
+    return rules
+
+
+def all_predictions(predictor, kg):
+    return [
+        (predictor.predict_tail(entity, relation, k=10), predictor.predict_head(relation, entity, k=10))
+        for entity in sorted(kg.entities) for relation in sorted(kg.relations)
+    ]
+
+
+def test_incremental_add_rules_matches_bulk_construction():
+    kg = temporal_kg()
+    rules = learned_rules(kg)
+    items = list(rules.items())
+    bulk = RulePrediction(rules, kg)
+
+    half = len(items) // 2
+    incremental = RulePrediction(dict(items[:half]), kg)
+    # Querying in between, so that memoized results have to be invalidated by the additions
+    all_predictions(incremental, kg)
+    incremental.add_rules(dict(items[half:]))
+
+    assert all_predictions(incremental, kg) == all_predictions(bulk, kg)
+
+
+def test_add_rules_replaces_known_rules():
+    kg = temporal_kg(seed=1)
+    rules = learned_rules(kg, seed=1)
+    items = list(rules.items())
+    predictor = RulePrediction(rules, kg)
+
+    # Replacing a rule by a new version with a different confidence gives the same as using it from the start
+    rule_str, rule = items[0]
+    new_rule = copy.copy(rule)
+    new_rule.confidence = 0.99
+    predictor.add_rules({rule_str: new_rule})
+    expected = RulePrediction({**rules, rule_str: new_rule}, kg)
+
+    assert predictor.rules[rule_str] is new_rule
+    assert all_predictions(predictor, kg) == all_predictions(expected, kg)